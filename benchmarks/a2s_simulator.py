@@ -0,0 +1,428 @@
+"""Simulate a fleet of Source servers over asyncio UDP, and load test against it.
+
+Every simulated server answers A2S_INFO, A2S_PLAYER and A2S_RULES with a
+challenge handshake, sends replies larger than the split size as split
+packets (bzip2 compressed with --compress), and can be made slow or lossy:
+
+    --latency-ms / --jitter-ms  delay before each reply is sent
+    --loss                      chance of each reply packet being lost
+    --drop                      chance of a request being silently ignored
+    --dead                      fraction of servers which never answer
+    --boot                      up to this many seconds before each server
+                                starts answering, like SRCDS loading a map
+
+Usage:
+
+    # Host 2000 servers on 127.0.0.1:30000-31999 until interrupted
+    python benchmarks/a2s_simulator.py serve --count 2000 --base-port 30000
+
+    # Host them in-process and measure SourceQuery against them
+    python benchmarks/a2s_simulator.py load --count 2000 --rounds 5 \\
+        --queries info,player,rules --loss 0.01 --output load.json
+
+    # Measure against servers hosted by another process
+    python benchmarks/a2s_simulator.py load --target 127.0.0.1:30000-31999
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csgo_lambda'))
+
+from fixtures import (PLAYERS, RULES, encode_challenge, encode_info, encode_players,
+                      encode_rules, encode_split)
+
+A2S_INFO = ord('T')
+A2S_PLAYER = ord('U')
+A2S_RULES = ord('V')
+MAPS = ['de_dust2', 'de_mirage', 'de_inferno', 'de_nuke', 'de_overpass',
+        'de_vertigo', 'de_ancient']
+
+
+class SimulationOptions:
+    """ How the simulated servers behave.
+
+    Args:
+        latency (float): Seconds before each reply is sent
+        jitter (float): Up to this many seconds are added to each reply
+        loss (float): Chance of each reply packet being lost
+        drop (float): Chance of a request being silently ignored
+        dead (float): Fraction of servers which never answer
+        boot (float): Up to this many seconds after the fleet starts before
+                      each server answers, picked at random for each server
+        split_size (int): Largest payload sent in a single packet
+        compress (bool): Whether split replies are bzip2 compressed
+        rotate (float): Seconds between challenge changes, or 0 to never change
+        seed (int): Seed for the contents of each server and the faults
+    """
+
+    __slots__ = ('latency', 'jitter', 'loss', 'drop', 'dead', 'boot', 'split_size',
+                 'compress', 'rotate', 'seed')
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, drop=0.0, dead=0.0,
+                 boot=0.0, split_size=1248, compress=False, rotate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.drop = drop
+        self.dead = dead
+        self.boot = boot
+        self.split_size = split_size
+        self.compress = compress
+        self.rotate = rotate
+        self.seed = seed
+
+
+def split_reply(data, reqid, size, compress):
+    """Split a whole reply into the packets a server would send for it."""
+    if len(data) <= size:
+        return [data]
+    return encode_split(data, reqid, size, compress)
+
+
+class SimulatedServer(asyncio.DatagramProtocol):
+    """ A single Source server answering A2S queries.
+
+    Args:
+        index (int): Number of the server in the fleet
+        options (SimulationOptions): How the server behaves
+        stats (dict): Counters shared by the whole fleet
+    """
+
+    def __init__(self, index, options, stats):
+        self.options = options
+        self.stats = stats
+        self.rng = random.Random(options.seed * 1000003 + index)
+        self.dead = self.rng.random() < options.dead
+        self.up_at = time.monotonic() + self.rng.uniform(0, options.boot)
+        self.reqid = 0
+        self.challenge = self.rng.randrange(1, 2**31)
+        self.rotated_at = time.monotonic()
+        self.transport = None
+
+        humans = self.rng.randrange(0, 11)
+        bots = self.rng.randrange(0, 3)
+        self.replies = {
+            A2S_INFO: encode_info(hostname=f"csgo{index}", map=self.rng.choice(MAPS),
+                                  numplayers=humans + bots, numbots=bots),
+            A2S_PLAYER: encode_players(PLAYERS[:humans + bots]),
+            A2S_RULES: encode_rules(RULES),
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.stats['requests'] += 1
+        if self.dead or time.monotonic() < self.up_at \
+                or self.rng.random() < self.options.drop:
+            self.stats['dropped'] += 1
+            return
+
+        packets = self.answer(data)
+        if not packets:
+            return
+
+        delay = self.options.latency + self.rng.uniform(0, self.options.jitter)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.send, packets, addr)
+        else:
+            self.send(packets, addr)
+
+    def answer(self, data):
+        """Get the packets to send back for a request."""
+        if len(data) < 5 or data[:4] != b'\xff\xff\xff\xff':
+            return []
+
+        kind = data[4]
+        if kind == A2S_INFO:
+            challenge = struct.unpack_from('<l', data, 25)[0] if len(data) >= 29 else None
+        elif kind in (A2S_PLAYER, A2S_RULES) and len(data) >= 9:
+            challenge = struct.unpack_from('<l', data, 5)[0]
+        else:
+            return []
+
+        if self.options.rotate and time.monotonic() - self.rotated_at > self.options.rotate:
+            self.challenge = self.rng.randrange(1, 2**31)
+            self.rotated_at = time.monotonic()
+
+        if challenge != self.challenge:
+            self.stats['challenges'] += 1
+            return [encode_challenge(self.challenge)]
+
+        self.reqid = (self.reqid + 1) & 0x7fffffff
+        return split_reply(self.replies[kind], self.reqid, self.options.split_size,
+                           self.options.compress)
+
+    def send(self, packets, addr):
+        for packet in packets:
+            if self.rng.random() < self.options.loss:
+                self.stats['lost'] += 1
+                continue
+            self.transport.sendto(packet, addr)
+            self.stats['packets'] += 1
+
+
+class SimulatedFleet:
+    """ Many simulated servers, either on consecutive ports of one address or
+    on port 27015 of consecutive loopback addresses.
+
+    Args:
+        count (int): The number of servers
+        options (SimulationOptions): How the servers behave
+        host (str): Address the servers listen on when using consecutive ports
+        base_port (int): Port of the first server, or None to use 27015 on
+                         127.0.0.2 onwards
+    """
+
+    def __init__(self, count, options=None, host='127.0.0.1', base_port=None):
+        self.options = options or SimulationOptions()
+        self.stats = dict.fromkeys(('requests', 'dropped', 'challenges', 'packets', 'lost'), 0)
+        if base_port is None:
+            self.addresses = [(ip, 27015) for ip in fleet_ips(count)]
+        else:
+            self.addresses = [(host, base_port + i) for i in range(count)]
+        self.transports = []
+        self.servers = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for index, address in enumerate(self.addresses):
+            transport, server = await loop.create_datagram_endpoint(
+                lambda index=index: SimulatedServer(index, self.options, self.stats),
+                local_addr=address)
+            self.transports.append(transport)
+            self.servers.append(server)
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+        self.servers = []
+
+
+class FleetThread:
+    """ Runs a SimulatedFleet on an event loop in a background thread.
+
+    Args:
+        fleet (SimulatedFleet): The fleet to run
+    """
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(fleet.start(), self.loop).result()
+
+    @property
+    def addresses(self):
+        return self.fleet.addresses
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close_fleet(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _close_fleet(self):
+        self.fleet.close()
+        # Closing a transport only releases its socket on the next loop pass
+        await asyncio.sleep(0)
+
+
+def fleet_ips(count, offset=2):
+    """Loopback addresses for a fleet of `count` servers."""
+    return [f"127.{(offset + i) // 65536}.{(offset + i) // 256 % 256}.{(offset + i) % 256}"
+            for i in range(count)]
+
+
+def raise_file_limit(needed):
+    """Raise the open file limit as far as allowed, as each server is a socket."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = min(needed, hard) if hard != resource.RLIM_INFINITY else needed
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    if soft < needed:
+        print(f"Open file limit is {soft}, fewer than the {needed} sockets needed")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def run_load(servers, queries, rounds, timeout, batch, keep_sessions):
+    """ Query every server repeatedly with SourceQueryMulti.
+
+    Args:
+        servers (list): (host, port) of each server
+        queries (list): Which of 'info', 'player' and 'rules' to query
+        rounds (int): How many times to query every server
+        timeout (float): Deadline for each batch of servers
+        batch (int): Servers queried together by one SourceQueryMulti
+        keep_sessions (bool): Whether sessions and challenges are reused
+
+    Returns:
+        dict: Throughput, answer rate and latency percentiles
+    """
+
+    from SourceQuery import SourceQueryMulti
+
+    sessions = {} if keep_sessions else None
+    pings = []
+    batch_times = []
+    answered = 0
+    sent = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for i in range(0, len(servers), batch):
+            group = servers[i:i+batch]
+            batch_start = time.perf_counter()
+            results = SourceQueryMulti(group, timeout, sessions).query(queries)
+            batch_times.append(time.perf_counter() - batch_start)
+
+            for result in results.values():
+                sent += len(queries)
+                answered += sum(1 for query in queries if result[query] is not None)
+                if result.get('info') is not None:
+                    pings.append(result['info']['ping'])
+    elapsed = time.perf_counter() - start
+
+    if sessions:
+        for session in sessions.values():
+            session.close()
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        'servers': len(servers),
+        'rounds': rounds,
+        'queries': list(queries),
+        'elapsed_s': round(elapsed, 3),
+        'queries_sent': sent,
+        'queries_answered': answered,
+        'answer_rate': round(answered / sent, 4) if sent else None,
+        'throughput_qps': round(answered / elapsed, 1) if elapsed else None,
+        'info_latency_ms': {f"p{pct}": ms(percentile(pings, pct)) for pct in (50, 95, 99)},
+        'batch_time_ms': {f"p{pct}": ms(percentile(batch_times, pct)) for pct in (50, 95, 99)},
+    }
+
+
+def parse_target(target):
+    host, ports = target.rsplit(':', 1)
+    first, _, last = ports.partition('-')
+    return [(host, port) for port in range(int(first), int(last or first) + 1)]
+
+
+def get_options(args):
+    return SimulationOptions(
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, loss=args.loss,
+        drop=args.drop, dead=args.dead, boot=args.boot, split_size=args.split_size,
+        compress=args.compress, rotate=args.rotate, seed=args.seed)
+
+
+def serve(args):
+    raise_file_limit(args.count + 64)
+    fleet = SimulatedFleet(args.count, get_options(args), args.host, args.base_port)
+
+    async def run():
+        await fleet.start()
+        first, last = fleet.addresses[0], fleet.addresses[-1]
+        print(f"Serving {args.count} servers from {first[0]}:{first[1]} "
+              f"to {last[0]}:{last[1]}, press Ctrl-C to stop")
+        try:
+            while True:
+                await asyncio.sleep(10)
+                print(json.dumps(fleet.stats))
+        finally:
+            fleet.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def load(args):
+    queries = args.queries.split(',')
+    runner = None
+    if args.target:
+        servers = parse_target(args.target)
+    else:
+        raise_file_limit(2 * args.count + 64)
+        runner = FleetThread(SimulatedFleet(args.count, get_options(args), args.host,
+                                            args.base_port))
+        servers = runner.addresses
+
+    try:
+        result = run_load(servers, queries, args.rounds, args.timeout,
+                          args.batch or len(servers), not args.no_sessions)
+    finally:
+        if runner is not None:
+            runner.close()
+    if runner is not None:
+        result['simulator'] = runner.fleet.stats
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='mode', required=True)
+    for mode in ('serve', 'load'):
+        p = sub.add_parser(mode)
+        p.add_argument('--count', type=int, default=100)
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--base-port', type=int, default=30000,
+                       help='port of the first server, or 0 to use 27015 on 127.0.0.2 onwards')
+        p.add_argument('--latency-ms', type=float, default=0.0)
+        p.add_argument('--jitter-ms', type=float, default=0.0)
+        p.add_argument('--loss', type=float, default=0.0)
+        p.add_argument('--drop', type=float, default=0.0)
+        p.add_argument('--dead', type=float, default=0.0)
+        p.add_argument('--boot', type=float, default=0.0)
+        p.add_argument('--split-size', type=int, default=1248)
+        p.add_argument('--compress', action='store_true')
+        p.add_argument('--rotate', type=float, default=0.0,
+                       help='seconds between challenge changes')
+        p.add_argument('--seed', type=int, default=0)
+        if mode == 'load':
+            p.add_argument('--target', help='host:first-last ports of servers to query '
+                                            'instead of simulating them')
+            p.add_argument('--queries', default='info')
+            p.add_argument('--rounds', type=int, default=3)
+            p.add_argument('--timeout', type=float, default=1.0)
+            p.add_argument('--batch', type=int, default=0,
+                           help='servers queried together, defaults to all of them')
+            p.add_argument('--no-sessions', action='store_true',
+                           help='start every round with new sockets and challenges')
+            p.add_argument('--output')
+    args = parser.parse_args()
+    if args.base_port == 0:
+        args.base_port = None
+
+    if args.mode == 'serve':
+        serve(args)
+    else:
+        load(args)
+
+
+if __name__ == '__main__':
+    main()
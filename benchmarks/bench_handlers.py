@@ -0,0 +1,332 @@
+"""Run every Lambda handler against in-process AWS fakes and local A2S servers.
+
+Each handler is invoked against a fleet of 1, 5, 20 and 100 servers, with
+every AWS API call delayed by the configured latency and every server
+answering A2S queries from its own loopback address. The p50 and p95 handler
+latency and the AWS calls made per invocation are printed and saved as JSON,
+so the results of two runs can be compared.
+
+Usage:
+
+    python benchmarks/bench_handlers.py [--sizes 1,5,20,100] [--iterations N]
+        [--latency-ms MS] [--udp-latency-ms MS] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [os.path.join(ROOT, 'src', 'python'), os.path.join(ROOT, 'csgo_lambda')]
+
+# The handlers read their configuration when they're imported
+ENV = {
+    'AWS_REGION': 'eu-west-1',
+    'ECS_CLUSTER': 'csgo-bench-cluster',
+    'TASK_DEFN': 'csgo-bench-task:1',
+    'TASK_FAMILY': 'csgo-bench-task',
+    'SUBNETS': 'subnet-1,subnet-2',
+    'SECURITY_GROUPS': 'sg-1',
+    'CONTAINER_NAME': 'csgo-bench-container',
+    'GET_HOSTNAME_QUEUE': 'https://sqs.eu-west-1.amazonaws.com/000000000000/get-hostname',
+    'HOSTED_ZONE_ID': 'ZBENCH',
+    'DNS_HOSTNAME': 'bench.example.com',
+    'WARM_POOL_TABLE': 'warm-pool',
+    'WARM_POOL_SIZE': '0',
+    'HOSTNAME_SLOT_TABLE': 'hostname-slots',
+    'HOSTNAME_OWNER_TABLE': 'hostname-owners',
+    'IDLE_HISTORY_TABLE': 'idle-history',
+    'FLEET_STATE_TABLE': 'fleet-state',
+    'SERVER_VERSION_PARAM': 'csgo-bench-version',
+    'FILL_WARM_POOL_FUNCTION': 'csgo-bench-fill-warm-pool',
+    'READINESS_PROBE_FUNCTION': 'csgo-bench-probe-readiness',
+    'STATUS_CACHE_TTL': '0',
+    'HOSTNAME_CACHE_TTL': '0',
+}
+os.environ.update(ENV)
+
+import fake_aws
+from a2s_simulator import FleetThread, SimulatedFleet, SimulationOptions, fleet_ips
+from fake_aws import FakeAws
+
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                              'handlers.json')
+
+
+class VersionHandler(BaseHTTPRequestHandler):
+    """Answers the Steam UpToDateCheck call of the version checker."""
+
+    def do_GET(self):
+        body = json.dumps({'response': {'success': True, 'up_to_date': True}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def seed_fleet(fake, ips, hostnames=True):
+    arns = []
+    for slot, ip in enumerate(ips, 1):
+        hostname = f"csgo{slot}.{ENV['DNS_HOSTNAME']}" if hostnames else None
+        arn = fake.add_task(ip, hostname=hostname)
+        if hostnames:
+            fake.tables['hostname-slots'][slot] = {'slot': slot, 'task_arn': arn}
+            fake.tables['hostname-owners'][arn] = {'task_arn': arn, 'slot': slot}
+        arns.append(arn)
+    return arns
+
+
+def api_event(resource, body=None, params=None):
+    return {'resource': resource, 'headers': {}, 'queryStringParameters': params,
+            'body': json.dumps(body) if body is not None else None}
+
+
+def status(fake, ips):
+    seed_fleet(fake, ips)
+    return api_event('/status')
+
+
+def status_stored(fake, ips):
+    for arn in seed_fleet(fake, ips):
+        task = fake.tasks[arn]
+        fake.tables['fleet-state'][arn] = {
+            'fleet': ENV['TASK_FAMILY'], 'task_arn': arn, 'public_ip': None,
+            'hostnames': [], 'last_status': task['lastStatus'],
+            'desired_status': task['desiredStatus'], 'server_ready': True,
+            'map': 'de_dust2', 'idle_pool': False}
+    fake.tables['fleet-state']['#sweep'] = {
+        'fleet': ENV['TASK_FAMILY'], 'task_arn': '#sweep', 'swept_at': int(time.time())}
+    return api_event('/status')
+
+
+def status_detailed(fake, ips):
+    seed_fleet(fake, ips)
+    return api_event('/status', params={'detail': 'true'})
+
+
+def start(fake, ips):
+    seed_fleet(fake, ips)
+    return api_event('/start', [{'name': 'MAP', 'value': 'de_mirage'}])
+
+
+def start_bulk(fake, ips):
+    seed_fleet(fake, ips)
+    maps = ['de_mirage', 'de_inferno']
+    specs = [[{'name': 'MAP', 'value': maps[i % 2]}] for i in range(len(ips))]
+    return api_event('/start', {'servers': specs})
+
+
+def stop(fake, ips):
+    arns = seed_fleet(fake, ips)
+    return api_event('/stop', {'task_arn': arns[0]})
+
+
+def stop_bulk(fake, ips):
+    arns = seed_fleet(fake, ips)
+    return api_event('/stop', {'task_arns': arns})
+
+
+def get_hostname(fake, ips):
+    # As many messages as the event source mapping's batch size
+    arns = seed_fleet(fake, ips, hostnames=False)
+    start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {'Records': [{'messageId': str(n), 'body': json.dumps({
+        'task_arn': arn, 'start_time': start_time})} for n, arn in enumerate(arns[:50])]}
+
+
+def task_state_change(fake, ips):
+    seed_fleet(fake, ips[1:])
+    arn = fake.add_task(ips[0])
+    return {'detail-type': 'ECS Task State Change', 'source': 'aws.ecs',
+            'detail': fake.tasks[arn]}
+
+
+def reap_idle(fake, ips):
+    seed_fleet(fake, ips)
+    return {}
+
+
+def probe_fleet(fake, ips):
+    seed_fleet(fake, ips)
+    return {}
+
+
+def fill_warm_pool(fake, ips):
+    import csgo_fill_warm_pool
+    csgo_fill_warm_pool.WARM_POOL_SIZE = len(ips)
+    seed_fleet(fake, ips)
+    return {}
+
+
+def check_server_version(fake, ips):
+    fake.parameters[ENV['SERVER_VERSION_PARAM']] = '1.38.2.2'
+    return {}
+
+
+def no_fleet(fake, ips):
+    return {}
+
+
+# Name of each benchmark, the handler module it runs, and a function which
+# seeds the fake fleet and returns the event to invoke the handler with
+SCENARIOS = [
+    ('status', 'csgo_get_server_status', status),
+    ('status_stored', 'csgo_get_server_status', status_stored),
+    ('status_detailed', 'csgo_get_server_status', status_detailed),
+    ('start', 'csgo_start_server', start),
+    ('start_bulk', 'csgo_start_server', start_bulk),
+    ('stop', 'csgo_stop_server', stop),
+    ('stop_bulk', 'csgo_stop_server', stop_bulk),
+    ('get_hostname', 'csgo_get_hostname', get_hostname),
+    ('task_state_change', 'csgo_task_state_change', task_state_change),
+    ('reap_idle', 'csgo_reap_idle_servers', reap_idle),
+    ('probe_fleet', 'csgo_probe_fleet', probe_fleet),
+    ('fill_warm_pool', 'csgo_fill_warm_pool', fill_warm_pool),
+    ('check_server_version', 'csgo_check_server_version', check_server_version),
+    ('update_image', 'csgo_update_image', no_fleet),
+    ('delete_volume', 'csgo_delete_volume', no_fleet),
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def run_scenario(module, seed, ips, args):
+    """ Invoke a handler repeatedly against a freshly seeded fleet.
+
+    Args:
+        module (module): The handler module
+        seed (function): Seeds the fleet and returns the event
+        ips (list): The addresses of the A2S servers in the fleet
+        args (argparse.Namespace): The command line options
+
+    Returns:
+        dict: Latency percentiles and AWS calls per invocation
+    """
+
+    durations = []
+    calls = {}
+    for iteration in range(args.iterations + 1):
+        fake = FakeAws(args.latency_ms / 1000, args.jitter_ms / 1000)
+        event = seed(fake, ips)
+        fake_aws.install(fake)
+        if hasattr(module, '_snapshots'):
+            module._snapshots.clear()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            module.handler(event, None)
+            duration = time.perf_counter() - start
+
+        # The first invocation only warms the container up
+        if iteration == 0:
+            continue
+        durations.append(duration * 1000)
+        for operation, count in fake.reset_calls().items():
+            calls[operation] = calls.get(operation, 0) + count
+
+    return {
+        'p50_ms': round(percentile(durations, 50), 2),
+        'p95_ms': round(percentile(durations, 95), 2),
+        'aws_calls': round(sum(calls.values()) / args.iterations, 2),
+        'calls_by_operation': {op: round(count / args.iterations, 2)
+                               for op, count in sorted(calls.items())},
+    }
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = json.load(f)['results']
+
+    print(f"\nCompared with {path}")
+    print(f"{'handler':<24}{'servers':>8}{'p50 before':>12}{'p50 now':>10}{'change':>9}")
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            before = previous.get(name, {}).get(size)
+            if before is None:
+                continue
+            change = (result['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100
+            print(f"{name:<24}{size:>8}{before['p50_ms']:>12.1f}"
+                  f"{result['p50_ms']:>10.1f}{change:>+8.0f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,5,20,100')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help='time taken by each AWS API call')
+    parser.add_argument('--jitter-ms', type=float, default=0.0,
+                        help='extra time added at random to each AWS API call')
+    parser.add_argument('--udp-latency-ms', type=float, default=5.0,
+                        help='time taken by each server to answer a query')
+    parser.add_argument('--only', help='comma separated benchmarks to run')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = set(args.only.split(',')) if args.only else None
+    scenarios = [s for s in SCENARIOS if only is None or s[0] in only]
+
+    http = HTTPServer(('127.0.0.1', 0), VersionHandler)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    import csgo_check_server_version
+    csgo_check_server_version.URL = \
+        f"http://127.0.0.1:{http.server_port}/?appid=730&version={{VERSION}}"
+
+    results = {}
+    print(f"{'handler':<24}{'servers':>8}{'p50 ms':>10}{'p95 ms':>10}{'AWS calls':>11}")
+    for size in sizes:
+        ips = fleet_ips(size)
+        options = SimulationOptions(latency=args.udp_latency_ms / 1000)
+        servers = FleetThread(SimulatedFleet(size, options))
+        try:
+            for name, module_name, seed in scenarios:
+                module = __import__(module_name)
+                result = run_scenario(module, seed, ips, args)
+                results.setdefault(name, {})[str(size)] = result
+                print(f"{name:<24}{size:>8}{result['p50_ms']:>10.1f}"
+                      f"{result['p95_ms']:>10.1f}{result['aws_calls']:>11.1f}")
+        finally:
+            servers.close()
+    http.shutdown()
+
+    output = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'iterations': args.iterations,
+            'latency_ms': args.latency_ms,
+            'jitter_ms': args.jitter_ms,
+            'udp_latency_ms': args.udp_latency_ms,
+        },
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+        f.write('\n')
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Check the cold import time of every Lambda handler against a baseline.
+
+Each handler is imported in a fresh interpreter with `python -X importtime`
+several times. The run fails if any run of a handler imports a module that
+should only be loaded on first use, such as boto3, which is what actually
+makes a cold start slow. The median time of each handler is also compared
+with its baseline, and only fails when it's slower by both the relative
+tolerance and an absolute noise floor, as a few ms either way is just the
+machine. The baseline is scaled up, but never down, by the median import
+time of a stdlib reference module, so a slower machine doesn't fail the
+check by itself.
+
+Usage:
+
+    python benchmarks/bench_import_time.py [--runs N] [--tolerance T] [--update]
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import_time_baseline.json')
+PATHS = [os.path.join(ROOT, 'src', 'python'), os.path.join(ROOT, 'csgo_lambda'),
+         os.path.join(ROOT, 'reporting')]
+
+# Modules which must not be imported when a handler is loaded
+DEFERRED = ('boto3', 'botocore', 'requests')
+
+# Slowdowns smaller than this are noise from the machine, whatever the tolerance
+NOISE_FLOOR_MS = 25.0
+
+# Imported on its own to measure how fast the machine is at the time
+REFERENCE = 'json'
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def get_handlers():
+    handlers = [os.path.basename(path)[:-3]
+                for path in glob.glob(os.path.join(ROOT, 'csgo_lambda', 'csgo_*.py'))]
+    return sorted(handlers) + ['error_reporting']
+
+
+def import_time(module):
+    """ Import a module in a fresh interpreter.
+
+    Args:
+        module (str): Name of the module to import
+
+    Returns:
+        tuple: The cumulative import time in ms, and every module imported
+    """
+
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(PATHS)}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {module}:\n{result.stderr}")
+
+    total = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        imported.add(match.group(4))
+        if match.group(4) == module and not match.group(3):
+            total = int(match.group(2)) / 1000
+    return total, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown over the baseline, as a fraction')
+    parser.add_argument('--update', action='store_true',
+                        help='write the results as the new baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    failures = []
+    results = {REFERENCE: round(statistics.median(
+        import_time(REFERENCE)[0] for _ in range(args.runs)), 2)}
+    scale = max(1.0, results[REFERENCE] / baseline[REFERENCE]) if REFERENCE in baseline else 1.0
+    print(f"Reference import of {REFERENCE} took {results[REFERENCE]}ms, "
+          f"scaling the baseline by {scale:.2f}")
+
+    print(f"{'handler':<32}{'baseline ms':>12}{'now ms':>10}")
+    for handler in get_handlers():
+        runs = [import_time(handler) for _ in range(args.runs)]
+        results[handler] = round(statistics.median(total for total, _ in runs), 2)
+
+        imported = set().union(*(imported for _, imported in runs))
+        deferred = sorted(set(DEFERRED) & imported)
+        if deferred:
+            failures.append(f"{handler} imports {', '.join(deferred)} at load time")
+
+        expected = baseline.get(handler)
+        limit = None
+        if expected is not None:
+            expected *= scale
+            limit = max(expected * (1 + args.tolerance), expected + NOISE_FLOOR_MS)
+        if limit is not None and results[handler] > limit:
+            failures.append(f"{handler} took {results[handler]}ms, limit {limit:.2f}ms")
+
+        shown = f"{expected:.2f}" if expected is not None else '-'
+        print(f"{handler:<32}{shown:>12}{results[handler]:>10.2f}")
+
+    if args.update:
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {BASELINE}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
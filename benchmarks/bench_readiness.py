@@ -0,0 +1,141 @@
+"""Run the readiness prober against simulated servers which take a while to load.
+
+A fake fleet of tasks is given ECS timestamps spread over a boot and EFS
+mount stage, and each task is served by a local A2S server which only starts
+answering after a random SRCDS load time. One prober runs per task, as the
+Lambda would, and a histogram of each stage of the start is printed along
+with how long after a server came up the prober noticed, and how many
+queries it took.
+
+Usage:
+
+    python benchmarks/bench_readiness.py [--count N] [--boot-s MIN-MAX]
+        [--efs-s MIN-MAX] [--srcds-s MAX] [--output FILE]
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Sets up the environment and import path the handlers need
+import bench_handlers
+import fake_aws
+from a2s_simulator import FleetThread, SimulatedFleet, SimulationOptions, fleet_ips
+from fake_aws import FakeAws
+
+import csgo_probe_readiness
+
+
+def parse_range(value):
+    low, _, high = value.partition('-')
+    return float(low), float(high or low)
+
+
+def histogram(values, bins=10, width=40):
+    """ Draw a text histogram of some values.
+
+    Args:
+        values (list): The values to draw
+        bins (int): The number of bars
+        width (int): Length of the longest bar
+
+    Returns:
+        list: The lines of the histogram
+    """
+
+    low, high = min(values), max(values)
+    size = (high - low) / bins or 1
+    counts = [0] * bins
+    for value in values:
+        counts[min(int((value - low) / size), bins - 1)] += 1
+
+    most = max(counts)
+    return [f"  {low + i * size:8.2f} - {low + (i + 1) * size:8.2f} "
+            f"{'#' * round(count / most * width):<{width}} {count}"
+            for i, count in enumerate(counts)]
+
+
+def seed_tasks(fake, ips, args, started_at):
+    """ Add a task for each server, with the times ECS would have recorded.
+
+    Returns:
+        list: The ARN of each task
+    """
+
+    rng = random.Random(args.seed)
+    arns = []
+    for ip in ips:
+        arn = fake.add_task(ip)
+        task = fake.tasks[arn]
+        pulled_at = started_at - datetime.timedelta(seconds=rng.uniform(*args.efs_s))
+        task['startedAt'] = started_at
+        task['pullStoppedAt'] = pulled_at
+        task['createdAt'] = pulled_at - datetime.timedelta(seconds=rng.uniform(*args.boot_s))
+        arns.append(arn)
+    return arns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--boot-s', type=parse_range, default=(20.0, 40.0),
+                        help='range of ECS provisioning and image pull times to record')
+    parser.add_argument('--efs-s', type=parse_range, default=(1.0, 5.0),
+                        help='range of EFS mount times to record')
+    parser.add_argument('--srcds-s', type=float, default=10.0,
+                        help='longest time a server takes to start answering')
+    parser.add_argument('--udp-latency-ms', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write every result to as JSON')
+    args = parser.parse_args()
+
+    fake = FakeAws(latency=0.0)
+    ips = fleet_ips(args.count)
+    started_at = datetime.datetime.now()
+    started = time.monotonic()
+    options = SimulationOptions(latency=args.udp_latency_ms / 1000, boot=args.srcds_s,
+                                seed=args.seed)
+    servers = FleetThread(SimulatedFleet(args.count, options))
+    arns = seed_tasks(fake, ips, args, started_at)
+    loaded = [server.up_at - started for server in servers.fleet.servers]
+    fake_aws.install(fake)
+
+    print(f"Probing {args.count} servers which answer within {args.srcds_s}s")
+    events = [{'task_arn': arn, 'public_ip': ip} for arn, ip in zip(arns, ips)]
+    with contextlib.redirect_stdout(io.StringIO()), \
+            ThreadPoolExecutor(max_workers=args.count) as executor:
+        responses = list(executor.map(lambda event: csgo_probe_readiness.handler(event, None),
+                                      events))
+    servers.close()
+
+    results = [json.loads(response['body']) for response in responses]
+    ready = [(result, load) for result, load in zip(results, loaded) if result['readyAt']]
+    print(f"{len(ready)} of {args.count} servers became ready")
+    if len(ready) == 0:
+        return
+
+    series = {name: [result['phases'][name] for result, _ in ready]
+              for name in ('Boot', 'EfsMount', 'SrcdsLoad', 'TimeToReady')}
+    series['DetectionLag'] = [result['phases']['SrcdsLoad'] - load for result, load in ready]
+    series['Probes'] = [result['probes'] for result, _ in ready]
+
+    for name, values in series.items():
+        values = sorted(values)
+        print(f"\n{name}: min {values[0]:.2f}  p50 {values[len(values) // 2]:.2f}  "
+              f"max {values[-1]:.2f}")
+        print('\n'.join(histogram(values)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'loaded': loaded}, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
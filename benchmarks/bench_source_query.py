@@ -0,0 +1,108 @@
+"""Compare the memoryview codec in SourceQuery with the BytesIO packet class.
+
+Usage:
+
+    python benchmarks/bench_source_query.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'csgo_lambda'))
+
+import SourceQuery
+from SourceQuery import SourceQueryPacket
+from fixtures import INFO_REPLY, PLAYER_REPLY, RULES_REPLY
+
+
+def legacy_info(data):
+    packet = SourceQueryPacket(data)
+    packet.getLong()
+    packet.getByte()
+    result = {}
+    result['network_version'] = packet.getByte()
+    result['hostname'] = packet.getString()
+    result['map'] = packet.getString()
+    result['gamedir'] = packet.getString()
+    result['gamedesc'] = packet.getString()
+    result['appid'] = packet.getShort()
+    result['numplayers'] = packet.getByte()
+    result['maxplayers'] = packet.getByte()
+    result['numbots'] = packet.getByte()
+    result['dedicated'] = chr(packet.getByte())
+    result['os'] = chr(packet.getByte())
+    result['passworded'] = packet.getByte()
+    result['secure'] = packet.getByte()
+    result['version'] = packet.getString()
+    edf = packet.getByte()
+    result['edf'] = edf
+    if edf & 0x80:
+        result['port'] = packet.getShort()
+    if edf & 0x10:
+        result['steamid'] = packet.getLongLong()
+    if edf & 0x40:
+        result['specport'] = packet.getShort()
+        result['specname'] = packet.getString()
+    if edf & 0x20:
+        result['tag'] = packet.getString()
+    return result
+
+
+def legacy_player(data):
+    packet = SourceQueryPacket(data)
+    packet.getLong()
+    packet.getByte()
+    result = []
+    for x in range(packet.getByte()):
+        player = {}
+        player['index'] = packet.getByte()
+        player['name'] = packet.getString()
+        player['kills'] = packet.getLong()
+        player['time'] = packet.getFloat()
+        result.append(player)
+    return result
+
+
+def legacy_rules(data):
+    packet = SourceQueryPacket(data)
+    packet.getLong()
+    packet.getByte()
+    packet.getShort()
+    rules = {}
+    while packet.tell() < len(data):
+        key = packet.getString()
+        rules[key] = packet.getString()
+    return rules
+
+
+CASES = [
+    ('info', INFO_REPLY, legacy_info, SourceQuery.decode_info),
+    ('player', PLAYER_REPLY, legacy_player, SourceQuery.decode_player),
+    ('rules', RULES_REPLY, legacy_rules, SourceQuery.decode_rules),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'reply':<8}{'bytes':>7}{'legacy us':>12}{'codec us':>12}{'speedup':>9}")
+    for name, data, legacy, decode in CASES:
+        expected = legacy(data)
+        actual = decode(data)
+        if isinstance(actual, dict):
+            actual.pop('ping', None)
+        assert actual == expected, f"{name} replies differ"
+
+        old = min(timeit.repeat(lambda: legacy(data), number=args.number, repeat=5))
+        new = min(timeit.repeat(lambda: decode(data), number=args.number, repeat=5))
+        old_us = old / args.number * 1e6
+        new_us = new / args.number * 1e6
+        print(f"{name:<8}{len(data):>7}{old_us:>12.2f}{new_us:>12.2f}{old / new:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
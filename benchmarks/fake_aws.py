@@ -0,0 +1,500 @@
+"""In-process stand-ins for the AWS APIs the handlers call.
+
+A FakeAws holds the state of a whole fleet: ECS tasks, their network
+interfaces, the Route53 zone, SQS messages, DynamoDB tables, SSM parameters
+and secrets. `install()` puts it in place of the boto3 session used by
+aws.py, so every client and resource the handlers create talks to it instead
+of AWS, and boto3 is never imported. Every API call, including each page of
+a paginated call, sleeps for the configured latency and is counted.
+"""
+
+import collections
+import datetime
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+import aws
+
+CLUSTER = 'csgo-bench-cluster'
+TASK_FAMILY = 'csgo-bench-task'
+HOSTED_ZONE_ID = 'ZBENCH'
+DNS_HOSTNAME = 'bench.example.com'
+
+# Key attribute of each table the handlers use
+TABLE_KEYS = {
+    'warm-pool': 'task_arn',
+    'hostname-slots': 'slot',
+    'hostname-owners': 'task_arn',
+    'idle-history': 'task_arn',
+    'fleet-state': 'task_arn',
+}
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class TransactionCanceledException(Exception):
+
+    def __init__(self, reasons):
+        super().__init__(f"Transaction cancelled: {[reason['Code'] for reason in reasons]}")
+        self.response = {'Error': {'Code': 'TransactionCanceledException'},
+                         'CancellationReasons': reasons}
+
+
+class FakeAwsError(Exception):
+    pass
+
+
+class FakeAws:
+    """ The state of a fleet along with the fake API calls that change it.
+
+    Args:
+        latency (float): Seconds each API call takes
+        jitter (float): Up to this many seconds are added to each call at random
+    """
+
+    def __init__(self, latency=0.02, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.tasks = {}
+        self.enis = {}
+        self.records = {}
+        self.messages = []
+        # Failures to inject: messages SQS rejects, tasks ECS can't place,
+        # run_task calls which raise, and tasks ECS can't stop
+        self.rejected_messages = 0
+        self.unplaced_tasks = 0
+        self.run_task_errors = 0
+        self.unstoppable = set()
+        self.tables = {name: {} for name in TABLE_KEYS}
+        self.parameters = {}
+        self.secrets = {}
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reset_calls(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = collections.Counter()
+        return calls
+
+    def add_task(self, public_ip=None, started_by=None, hostname=None):
+        """ Add a running task to the fleet.
+
+        Args:
+            public_ip (str): IP of the task's interface, none is attached if None
+            started_by (str): The startedBy value of the task
+            hostname (str): A record to point at the IP of the task
+
+        Returns:
+            str: The ARN of the task
+        """
+
+        n = next(self.ids)
+        task_arn = f"arn:aws:ecs:eu-west-1:000000000000:task/{CLUSTER}/{n:032x}"
+        eni_id = f"eni-{n:017x}"
+        task = {
+            'taskArn': task_arn,
+            'lastStatus': 'RUNNING',
+            'desiredStatus': 'RUNNING',
+            'group': f"family:{TASK_FAMILY}",
+            'startedAt': datetime.datetime.now(),
+            'cpu': '2048',
+            'memory': '4096',
+            'overrides': {'containerOverrides': []},
+            'attachments': [{
+                'type': 'ElasticNetworkInterface',
+                'details': [{'name': 'networkInterfaceId', 'value': eni_id}]
+            }]
+        }
+        if started_by:
+            task['startedBy'] = started_by
+        self.tasks[task_arn] = task
+        self.enis[eni_id] = public_ip
+        if hostname and public_ip:
+            self.records[(hostname.rstrip('.') + '.', 'A')] = public_ip
+        return task_arn
+
+
+class FakePaginator:
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = self.method(NextToken=token, **kwargs) if token else self.method(**kwargs)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+
+
+class FakeWaiter:
+
+    def __init__(self, fake, operation):
+        self.fake = fake
+        self.operation = operation
+
+    def wait(self, **kwargs):
+        self.fake.call(self.operation)
+
+
+class FakeClient:
+    """ A client for one service, with the operations the handlers use. """
+
+    def __init__(self, fake, service):
+        self.fake = fake
+        self.service = service
+        self.exceptions = type('Exceptions', (), {
+            'ConditionalCheckFailedException': ConditionalCheckFailedException,
+            'TransactionCanceledException': TransactionCanceledException
+        })
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def get_waiter(self, name):
+        return FakeWaiter(self.fake, f"{self.service}.GetChange")
+
+    # ECS
+
+    def list_tasks(self, cluster, family=None, startedBy=None, desiredStatus=None,
+                   NextToken=None):
+        self.fake.call('ecs.ListTasks')
+        arns = [arn for arn, task in self.fake.tasks.items()
+                if (desiredStatus is None or task['desiredStatus'] == desiredStatus)
+                and (startedBy is None or task.get('startedBy') == startedBy)]
+        start = int(NextToken or 0)
+        page = {'taskArns': arns[start:start+100]}
+        if start + 100 < len(arns):
+            page['NextToken'] = str(start + 100)
+        return page
+
+    def describe_tasks(self, cluster, tasks):
+        if len(tasks) > 100:
+            raise FakeAwsError('describe_tasks takes at most 100 tasks')
+        self.fake.call('ecs.DescribeTasks')
+        return {'tasks': [self.fake.tasks[arn] for arn in tasks if arn in self.fake.tasks],
+                'failures': []}
+
+    def run_task(self, cluster, taskDefinition, count=1, startedBy=None, overrides=None,
+                 **kwargs):
+        if count > 10:
+            raise FakeAwsError('run_task starts at most 10 tasks')
+        self.fake.call('ecs.RunTask')
+        with self.fake.lock:
+            if self.fake.run_task_errors > 0:
+                self.fake.run_task_errors -= 1
+                raise FakeAwsError('run_task failed')
+            unplaced = min(self.fake.unplaced_tasks, count)
+            self.fake.unplaced_tasks -= unplaced
+            arns = [self.fake.add_task(started_by=startedBy) for _ in range(count - unplaced)]
+        return {'tasks': [self.fake.tasks[arn] for arn in arns],
+                'failures': [{'reason': 'RESOURCE:FARGATE'}] * unplaced}
+
+    def stop_task(self, cluster, task):
+        self.fake.call('ecs.StopTask')
+        if task in self.fake.unstoppable:
+            raise FakeAwsError(f"{task} could not be stopped")
+        details = self.fake.tasks[task]
+        details['desiredStatus'] = 'STOPPED'
+        return {'task': details}
+
+    # EC2
+
+    def describe_network_interfaces(self, Filters, NextToken=None):
+        self.fake.call('ec2.DescribeNetworkInterfaces')
+        wanted = Filters[0]['Values']
+        interfaces = []
+        for eni_id in wanted:
+            if eni_id not in self.fake.enis:
+                continue
+            eni = {'NetworkInterfaceId': eni_id}
+            if self.fake.enis[eni_id]:
+                eni['Association'] = {'PublicIp': self.fake.enis[eni_id]}
+            interfaces.append(eni)
+        return {'NetworkInterfaces': interfaces}
+
+    # Route53
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.fake.call('route53.ChangeResourceRecordSets')
+        with self.fake.lock:
+            records = dict(self.fake.records)
+            for change in ChangeBatch['Changes']:
+                record = change['ResourceRecordSet']
+                key = (record['Name'], record['Type'])
+                value = record['ResourceRecords'][0]['Value']
+                if change['Action'] == 'CREATE' and key in records:
+                    raise FakeAwsError(f"{key} already exists")
+                if change['Action'] == 'DELETE':
+                    if records.get(key) != value:
+                        raise FakeAwsError(f"{key} not found")
+                    del records[key]
+                else:
+                    records[key] = value
+            self.fake.records = records
+        return {'ChangeInfo': {'Id': f"/change/C{next(self.fake.ids)}", 'Status': 'PENDING'}}
+
+    def list_resource_record_sets(self, HostedZoneId, NextToken=None):
+        self.fake.call('route53.ListResourceRecordSets')
+        records = sorted(self.fake.records.items())
+        start = int(NextToken or 0)
+        page = {'ResourceRecordSets': [
+            {'Name': name, 'Type': record_type, 'TTL': 60,
+             'ResourceRecords': [{'Value': value}]}
+            for (name, record_type), value in records[start:start+300]]}
+        if start + 300 < len(records):
+            page['NextToken'] = str(start + 300)
+        return page
+
+    # DynamoDB
+
+    def transact_write_items(self, TransactItems):
+        if len(TransactItems) > 100:
+            raise FakeAwsError('transact_write_items takes at most 100 items')
+        self.fake.call('dynamodb.TransactWriteItems')
+        with self.fake.lock:
+            reasons = []
+            writes = []
+            for entry in TransactItems:
+                (action, request), = entry.items()
+                table = FakeTable(self.fake, request['TableName'])
+                item = dict(request['Item']) if action == 'Put' else None
+                key = (item or request['Key'])[table.key]
+                try:
+                    table._check(table.items.get(key), request.get('ConditionExpression'),
+                                 request.get('ExpressionAttributeValues'))
+                    reasons.append({'Code': 'None'})
+                except ConditionalCheckFailedException:
+                    reasons.append({'Code': 'ConditionalCheckFailed'})
+                writes.append((table, key, item))
+
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise TransactionCanceledException(reasons)
+            for table, key, item in writes:
+                if item is None:
+                    table.items.pop(key, None)
+                else:
+                    table.items[key] = item
+        return {}
+
+    # SQS
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=None):
+        self.fake.call('sqs.SendMessage')
+        self.fake.messages.append(MessageBody)
+        return {'MessageId': str(next(self.fake.ids))}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if len(Entries) > 10:
+            raise FakeAwsError('send_message_batch takes at most 10 messages')
+        self.fake.call('sqs.SendMessageBatch')
+        with self.fake.lock:
+            rejected = min(self.fake.rejected_messages, len(Entries))
+            self.fake.rejected_messages -= rejected
+        self.fake.messages += [entry['MessageBody'] for entry in Entries[rejected:]]
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries[rejected:]],
+                'Failed': [{'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError'}
+                           for entry in Entries[:rejected]]}
+
+    # SSM, Secrets Manager and Lambda
+
+    def get_parameter(self, Name):
+        self.fake.call('ssm.GetParameter')
+        return {'Parameter': {'Name': Name, 'Value': self.fake.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, Overwrite=False):
+        self.fake.call('ssm.PutParameter')
+        self.fake.parameters[Name] = Value
+        return {'Version': 1}
+
+    def get_secret_value(self, SecretId):
+        self.fake.call('secretsmanager.GetSecretValue')
+        return {'SecretString': json.dumps(self.fake.secrets.get(SecretId, {}))}
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=None):
+        self.fake.call('lambda.Invoke')
+        return {'StatusCode': 202}
+
+
+class FakeTable:
+
+    def __init__(self, fake, name):
+        self.fake = fake
+        self.name = name
+        self.key = TABLE_KEYS[name]
+        self.meta = type('Meta', (), {'client': FakeClient(fake, 'dynamodb')})
+
+    @property
+    def items(self):
+        return self.fake.tables[self.name]
+
+    def _check(self, current, condition, values):
+        if condition is None:
+            return
+        if condition.startswith('attribute_not_exists'):
+            attribute = condition[len('attribute_not_exists('):-1]
+            ok = current is None or attribute not in current
+        elif condition.startswith('attribute_exists'):
+            attribute = condition[len('attribute_exists('):-1]
+            ok = current is not None and attribute in current
+        else:
+            attribute, placeholder = [part.strip() for part in condition.split('=')]
+            ok = current is not None and current.get(attribute) == values[placeholder]
+        if not ok:
+            raise ConditionalCheckFailedException(condition)
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.fake.call('dynamodb.GetItem')
+        item = self.items.get(Key[self.key])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        self.fake.call('dynamodb.PutItem')
+        with self.fake.lock:
+            self._check(self.items.get(Item[self.key]), ConditionExpression,
+                        ExpressionAttributeValues)
+            self.items[Item[self.key]] = dict(Item)
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+        self.fake.call('dynamodb.DeleteItem')
+        with self.fake.lock:
+            self._check(self.items.get(Key[self.key]), ConditionExpression,
+                        ExpressionAttributeValues)
+            self.items.pop(Key[self.key], None)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues,
+                    ExpressionAttributeNames=None, ConditionExpression=None):
+        self.fake.call('dynamodb.UpdateItem')
+        names = ExpressionAttributeNames or {}
+        with self.fake.lock:
+            self._check(self.items.get(Key[self.key]), ConditionExpression,
+                        ExpressionAttributeValues)
+            item = self.items.setdefault(Key[self.key], dict(Key))
+            action, _, assignments = UpdateExpression.partition(' ')
+            for assignment in re.split(r',\s*(?![^(]*\))', assignments):
+                if action == 'ADD':
+                    name, value = assignment.split()
+                    name = names.get(name, name)
+                    item[name] = item.get(name, 0) + ExpressionAttributeValues[value]
+                    continue
+
+                name, value = [part.strip() for part in assignment.split('=')]
+                name = names.get(name, name)
+                if value.startswith('if_not_exists('):
+                    if name in item:
+                        continue
+                    value = value[:-1].split(',')[1].strip()
+                item[name] = ExpressionAttributeValues[value]
+        return {}
+
+    def scan(self, **kwargs):
+        self.fake.call('dynamodb.Scan')
+        return {'Items': [dict(item) for item in self.items.values()]}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, **kwargs):
+        self.fake.call('dynamodb.Query')
+        return {'Items': [dict(item) for item in self.items.values()]}
+
+    def batch_writer(self):
+        return FakeBatchWriter(self)
+
+
+class FakeBatchWriter:
+    """ Buffers writes and sends them 25 at a time, like boto3's. """
+
+    def __init__(self, table):
+        self.table = table
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def put_item(self, Item):
+        self._add(Item[self.table.key], dict(Item))
+
+    def delete_item(self, Key):
+        self._add(Key[self.table.key], None)
+
+    def _add(self, key, item):
+        self.pending.append((key, item))
+        if len(self.pending) == 25:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.table.fake.call('dynamodb.BatchWriteItem')
+        with self.table.fake.lock:
+            for key, item in self.pending:
+                if item is None:
+                    self.table.items.pop(key, None)
+                else:
+                    self.table.items[key] = item
+        self.pending = []
+
+
+class FakeDynamoResource:
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.meta = type('Meta', (), {'client': FakeClient(fake, 'dynamodb')})
+
+    def Table(self, name):
+        return FakeTable(self.fake, name)
+
+    def batch_get_item(self, RequestItems):
+        self.fake.call('dynamodb.BatchGetItem')
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            responses[name] = [dict(table.items[key[table.key]]) for key in request['Keys']
+                               if key[table.key] in table.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class FakeSession:
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def client(self, service, **kwargs):
+        return FakeClient(self.fake, service)
+
+    def resource(self, service, **kwargs):
+        return FakeDynamoResource(self.fake)
+
+
+def install(fake):
+    """ Make aws.py hand out clients backed by a FakeAws.
+
+    Args:
+        fake (FakeAws): The fake fleet to use
+    """
+
+    aws._session = FakeSession(fake)
+    aws._config = None
+    aws._clients.clear()
+    aws._resources.clear()
+    aws._hostname_indexes.clear()
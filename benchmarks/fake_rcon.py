@@ -0,0 +1,110 @@
+"""A stand-in for the RCON port of a CS:GO server.
+
+Speaks enough of https://developer.valvesoftware.com/wiki/Source_RCON_Protocol
+for SourceRcon to authenticate and run commands against it: the auth
+response is preceded by an empty response value as SRCDS does, command
+output is split over two packets, and the empty packet sent after each
+command is mirrored back once the output is complete. Every command run is
+kept so a test can check what was sent to the server.
+"""
+
+import socket
+import struct
+import threading
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+
+def encode_packet(reqid, typ, body):
+    data = struct.pack('<ll', reqid, typ) + body.encode('utf-8') + b'\x00\x00'
+    return struct.pack('<l', len(data)) + data
+
+
+class FakeRconServer:
+    """ Serves RCON on a TCP port from a background thread.
+
+    Args:
+        host (str): The address to listen on
+        port (int): The port to listen on
+        password (str): The RCON password clients have to send
+    """
+
+    def __init__(self, host='127.0.0.1', port=27015, password=''):
+        self.password = password
+        self.commands = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.address = self.listener.getsockname()
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # Shutting the socket down wakes the thread blocked accepting on it
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                packet = self._receive(conn)
+                if packet is None:
+                    return
+                reqid, typ, body = packet
+
+                if typ == SERVERDATA_AUTH:
+                    ok = body == self.password
+                    conn.sendall(encode_packet(reqid, SERVERDATA_RESPONSE_VALUE, '')
+                                 + encode_packet(reqid if ok else -1,
+                                                 SERVERDATA_AUTH_RESPONSE, ''))
+                elif typ == SERVERDATA_EXECCOMMAND:
+                    self.commands.append(body)
+                    output = f"Ran {body}"
+                    conn.sendall(encode_packet(reqid, SERVERDATA_RESPONSE_VALUE, output[:4])
+                                 + encode_packet(reqid, SERVERDATA_RESPONSE_VALUE, output[4:]))
+                else:
+                    conn.sendall(encode_packet(reqid, SERVERDATA_RESPONSE_VALUE, ''))
+
+    def _receive(self, conn):
+        header = self._read(conn, 4)
+        if header is None:
+            return None
+        data = self._read(conn, struct.unpack('<l', header)[0])
+        if data is None:
+            return None
+        reqid, typ = struct.unpack('<ll', data[:8])
+        return reqid, typ, data[8:-2].decode('utf-8')
+
+    def _read(self, conn, size):
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = conn.recv(size - len(data))
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
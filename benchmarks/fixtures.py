@@ -0,0 +1,89 @@
+"""A2S replies shaped like those from our CS:GO practice servers.
+
+The byte layouts follow https://developer.valvesoftware.com/wiki/Server_Queries
+and the contents mirror a 128 tick practice server running SourceMod, so the
+benchmarks decode replies of a realistic size.
+"""
+
+import bz2
+import struct
+import zlib
+
+WHOLE = -1
+SPLIT = -2
+COMPRESSED = 0x80000000
+S2C_CHALLENGE = ord('A')
+A2S_INFO_REPLY = ord('I')
+A2S_PLAYER_REPLY = ord('D')
+A2S_RULES_REPLY = ord('E')
+
+
+def _string(value):
+    return value.encode('utf-8') + b'\x00'
+
+
+def encode_challenge(challenge):
+    return struct.pack('<lBl', WHOLE, S2C_CHALLENGE, challenge)
+
+
+def encode_info(hostname='csgo-prac | practice', map='de_mirage', numplayers=5,
+                maxplayers=10, numbots=0, port=27015, steamid=90151718312345601,
+                tags='secure,practice,128tick'):
+    return (struct.pack('<lBB', WHOLE, A2S_INFO_REPLY, 17)
+            + _string(hostname) + _string(map) + _string('csgo')
+            + _string('Counter-Strike: Global Offensive')
+            + struct.pack('<hBBBBBBB', 730, numplayers, maxplayers, numbots,
+                          ord('d'), ord('l'), 1, 1)
+            + _string('1.38.2.2')
+            + struct.pack('<BhQ', 0x80 | 0x10 | 0x20, port, steamid)
+            + _string(tags))
+
+
+def encode_players(players):
+    data = struct.pack('<lBB', WHOLE, A2S_PLAYER_REPLY, len(players))
+    for index, (name, kills, duration) in enumerate(players):
+        data += struct.pack('<B', index) + _string(name) + struct.pack('<lf', kills, duration)
+    return data
+
+
+def encode_rules(rules):
+    data = struct.pack('<lBh', WHOLE, A2S_RULES_REPLY, len(rules))
+    for key, value in rules.items():
+        data += _string(key) + _string(value)
+    return data
+
+
+def encode_split(data, reqid, size=1248, compress=False):
+    """Split a whole reply into the parts a server would send for it."""
+    if compress:
+        header = struct.pack('<lL', len(data), zlib.crc32(data))
+        body = bz2.compress(data)
+        reqid |= COMPRESSED
+    else:
+        header = b''
+        body = data
+
+    chunks = [body[i:i+size] for i in range(0, len(body), size)]
+    return [struct.pack('<lLBBh', SPLIT, reqid, len(chunks), num, size)
+            + (header if num == 0 else b'') + chunk
+            for num, chunk in enumerate(chunks)]
+
+
+PLAYERS = [(f"player{i} ★", i * 3, 1234.5 + i) for i in range(10)]
+
+RULES = {
+    'tickrate': '128',
+    'game_mode': '1',
+    'game_type': '0',
+    'mp_autoteambalance': '0',
+    'mp_limitteams': '0',
+    'sv_cheats': '1',
+    'sv_infinite_ammo': '1',
+    'sv_grenade_trajectory': '1',
+    'sv_showimpacts': '1',
+    **{f"sm_practicemode_setting_{i}": str(i) for i in range(150)},
+}
+
+INFO_REPLY = encode_info()
+PLAYER_REPLY = encode_players(PLAYERS)
+RULES_REPLY = encode_rules(RULES)
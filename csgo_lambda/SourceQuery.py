@@ -28,17 +28,36 @@
 
 # TODO:  code cleanup
 
-# TODO:  according to spec, packets may be bzip2 compressed.
-# TODO:: not implemented yet because I couldn't find a server that does this.
-
 import socket, struct, sys, time
 import io
+import selectors
+import zlib
 
 PACKETSIZE=1400
 
 WHOLE=-1
 SPLIT=-2
 
+# Precompiled structs used to decode replies in place with unpack_from,
+# rather than slicing a fresh bytes object for every field
+BYTE = struct.Struct('<B')
+SHORT = struct.Struct('<h')
+LONG = struct.Struct('<l')
+LONGLONG = struct.Struct('<Q')
+HEADER = struct.Struct('<lB')
+INFO_FIXED = struct.Struct('<hBBBBBBB')
+PLAYER_FIXED = struct.Struct('<lf')
+
+# split packet header: type, id, total, number, size
+SPLIT_HEADER = struct.Struct('<lLBBh')
+# first part of a compressed response: decompressed size, crc32
+COMPRESSED_HEADER = struct.Struct('<lL')
+COMPRESSED = 0x80000000
+
+# How long the id of a completed split response is remembered, so a part of
+# it which arrives again afterwards is dropped rather than starting it over
+COMPLETED_TTL = 2.0
+
 # REMOVED.  DEPRECATED QUERY!
 
 # A2A_PING
@@ -106,6 +125,266 @@ class SourceQueryPacket(io.BytesIO):
 class SourceQueryError(Exception):
     pass
 
+class SplitPacket(object):
+    """Collects the parts of one split response.
+
+    Parts go into a fixed slot table as they arrive, in any order, with a
+    bitmap of which have been seen so duplicates are dropped and completeness
+    is a single comparison. The payload is joined in one allocation.
+    """
+
+    __slots__ = ('reqid', 'total', 'parts', 'received', 'size', 'crc')
+
+    def __init__(self, reqid, total):
+        self.reqid = reqid
+        self.total = total
+        self.parts = [None] * total
+        self.received = 0
+        self.size = None
+        self.crc = None
+
+    @property
+    def compressed(self):
+        return bool(self.reqid & COMPRESSED)
+
+    @property
+    def complete(self):
+        return self.received == (1 << self.total) - 1
+
+    def add(self, num, data, pos):
+        """Store a part, returning False if it has already been seen."""
+        if self.received & (1 << num):
+            return False
+
+        if num == 0 and self.compressed:
+            self.size, self.crc = COMPRESSED_HEADER.unpack_from(data, pos)
+            pos += COMPRESSED_HEADER.size
+
+        self.parts[num] = memoryview(data)[pos:]
+        self.received |= 1 << num
+        return True
+
+    def assemble(self):
+        """Join the parts into a whole response, decompressing if needed."""
+        data = b''.join(self.parts)
+        if not self.compressed:
+            return data
+
+        # Few servers compress their replies, so bz2 is only loaded if needed
+        import bz2
+        try:
+            data = bz2.decompress(data)
+        except (OSError, ValueError) as ex:
+            raise SourceQueryError(f"Invalid compressed split packet: {ex}")
+
+        if len(data) != self.size or zlib.crc32(data) != self.crc:
+            raise SourceQueryError('Compressed split packet failed CRC check')
+
+        return data
+
+class SplitReassembler(object):
+    """Turns a stream of received packets into whole responses.
+
+    Parts of different responses may be interleaved, so each response being
+    collected is kept separately by its request id. The ids of responses
+    completed in the last COMPLETED_TTL seconds are kept too, so a duplicate
+    part arriving late can't return the same response twice.
+
+    Example usage:
+
+       reassembler = SplitReassembler()
+       while True:
+           data = reassembler.feed(udp.recv(PACKETSIZE))
+           if data is not None:
+               break
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.completed = {}
+
+    def feed(self, data):
+        """Return the whole response once complete, otherwise None."""
+        typ, = LONG.unpack_from(data)
+
+        if typ == WHOLE:
+            return data
+
+        if typ != SPLIT:
+            raise SourceQueryError("Received invalid packet type %d" % (typ,))
+
+        _, reqid, total, num, _ = SPLIT_HEADER.unpack_from(data)
+        if total == 0 or num >= total:
+            raise SourceQueryError('Invalid split packet')
+
+        if reqid in self.completed:
+            if time.monotonic() - self.completed[reqid] < COMPLETED_TTL:
+                return None
+            del self.completed[reqid]
+
+        split = self.pending.get(reqid)
+        if split is None:
+            split = self.pending[reqid] = SplitPacket(reqid, total)
+        elif split.total != total:
+            raise SourceQueryError('Invalid split packet')
+
+        split.add(num, data, SPLIT_HEADER.size)
+        if not split.complete:
+            return None
+
+        del self.pending[reqid]
+        self._complete(reqid)
+        data = split.assemble()
+        if LONG.unpack_from(data)[0] != WHOLE:
+            raise SourceQueryError('Invalid split packet')
+
+        return data
+
+    def _complete(self, reqid):
+        now = time.monotonic()
+        for old in [old for old, at in self.completed.items() if now - at >= COMPLETED_TTL]:
+            del self.completed[old]
+        self.completed[reqid] = now
+
+def _info_packet(challenge=None):
+    packet = SourceQueryPacket()
+    packet.putLong(WHOLE)
+    packet.putByte(A2S_INFO)
+    packet.putString(A2S_INFO_STRING)
+    if challenge:
+        packet.putLong(challenge)
+    return packet
+
+def _request_packet(query, challenge):
+    """Build the request for 'info', 'player' or 'rules' with a challenge."""
+    if query == 'info':
+        return _info_packet(None if challenge == CHALLENGE else challenge)
+
+    packet = SourceQueryPacket()
+    packet.putLong(WHOLE)
+    packet.putByte(QUERIES[query])
+    packet.putLong(challenge)
+    return packet
+
+def _string(data, pos):
+    """Decode a null-terminated string starting at pos.
+
+    Returns the string and the position just past the terminator. Only the
+    string itself is sliced, never a copy of the whole buffer.
+    """
+    end = data.index(b'\0', pos)
+    return data[pos:end].decode('utf-8', 'replace'), end + 1
+
+def decode_info(data, pos=5, ping=None):
+    """Decode an A2S_INFO reply, starting at the byte after the header."""
+    result = {'ping': ping}
+
+    result['network_version'] = data[pos]
+    result['hostname'], pos = _string(data, pos + 1)
+    result['map'], pos = _string(data, pos)
+    result['gamedir'], pos = _string(data, pos)
+    result['gamedesc'], pos = _string(data, pos)
+    (result['appid'], result['numplayers'], result['maxplayers'],
+     result['numbots'], dedicated, os, result['passworded'],
+     result['secure']) = INFO_FIXED.unpack_from(data, pos)
+    result['dedicated'] = chr(dedicated)
+    result['os'] = chr(os)
+    result['version'], pos = _string(data, pos + INFO_FIXED.size)
+
+    # edf may or may not be present
+    # contents undefined (see wiki page)
+    # this protocol is horrible
+    try:
+        edf = data[pos]
+        result['edf'] = edf
+        pos += 1
+
+        if edf & 0x80:
+            result['port'], = SHORT.unpack_from(data, pos)
+            pos += SHORT.size
+        if edf & 0x10:
+            result['steamid'], = LONGLONG.unpack_from(data, pos)
+            pos += LONGLONG.size
+        if edf & 0x40:
+            result['specport'], = SHORT.unpack_from(data, pos)
+            result['specname'], pos = _string(data, pos + SHORT.size)
+        if edf & 0x20:
+            result['tag'], pos = _string(data, pos)
+    except (IndexError, ValueError, struct.error):
+        # let's just ignore all errors...
+        pass
+
+    return result
+
+def decode_player(data, pos=5):
+    """Decode an A2S_PLAYER reply, starting at the byte after the header."""
+    numplayers = data[pos]
+    pos += 1
+
+    result = []
+
+    # TF2 32player servers may send an incomplete reply
+    try:
+        for x in range(numplayers):
+            index = data[pos]
+            name, pos = _string(data, pos + 1)
+            kills, duration = PLAYER_FIXED.unpack_from(data, pos)
+            pos += PLAYER_FIXED.size
+            result.append({'index': index, 'name': name,
+                           'kills': kills, 'time': duration})
+    except (IndexError, ValueError, struct.error):
+        pass
+
+    return result
+
+def decode_rules(data, pos=5):
+    """Decode an A2S_RULES reply, starting at the byte after the header."""
+    numrules, = SHORT.unpack_from(data, pos)
+
+    # Rules are only strings, so decode straight out of the buffer in one go
+    # and split on the terminators. TF2 sends incomplete packets, so we have
+    # to ignore numrules, and anything after the last terminator.
+    strings = str(memoryview(data)[pos + SHORT.size:], 'utf-8', 'replace')
+    strings = strings.split('\0')[:-1]
+    return dict(zip(strings[0::2], strings[1::2]))
+
+QUERIES = {
+    'info': A2S_INFO,
+    'player': A2S_PLAYER,
+    'rules': A2S_RULES,
+}
+
+REPLIES = {
+    A2S_INFO_REPLY: 'info',
+    A2S_PLAYER_REPLY: 'player',
+    A2S_RULES_REPLY: 'rules',
+}
+
+DECODERS = {
+    A2S_INFO_REPLY: decode_info,
+    A2S_PLAYER_REPLY: decode_player,
+    A2S_RULES_REPLY: decode_rules,
+}
+
+def decode_reply(data):
+    """Decode any complete reply in a single pass.
+
+    Returns the header byte and the decoded result, which for a challenge is
+    the challenge number.
+    """
+    typ, header = HEADER.unpack_from(data)
+    if typ != WHOLE:
+        raise SourceQueryError("Received invalid packet type %d" % (typ,))
+
+    if header == S2C_CHALLENGE:
+        return header, LONG.unpack_from(data, HEADER.size)[0]
+
+    decoder = DECODERS.get(header)
+    if decoder is None:
+        raise SourceQueryError("Received invalid reply header %d" % (header,))
+
+    return header, decoder(data, HEADER.size)
+
 class SourceQuery(object):
     """Example usage:
 
@@ -124,13 +403,7 @@ class SourceQuery(object):
         self.udp = False
 
     def _send_info_packet(self, challenge=None):
-        packet = SourceQueryPacket()
-        packet.putLong(WHOLE)
-        packet.putByte(A2S_INFO)
-        packet.putString(A2S_INFO_STRING)
-        if challenge:
-            packet.putLong(challenge)
-        return packet
+        return _info_packet(challenge)
 
     def disconnect(self):
         if self.udp:
@@ -147,45 +420,12 @@ class SourceQuery(object):
             return self.challenge()
 
     def receive(self):
-        packet = SourceQueryPacket(self.udp.recv(PACKETSIZE))
-        typ = packet.getLong()
-
-        if typ == WHOLE:
-            return packet
-
-        elif typ == SPLIT:
-            # handle split packets
-            reqid = packet.getLong()
-            total = packet.getByte()
-            num = packet.getByte()
-            splitsize = packet.getShort()
-            result = [0 for x in range(total)]
-
-            result[num] = packet.read()
-
-            # fetch all remaining splits
-            while 0 in result:
-                packet = SourceQueryPacket(self.udp.recv(PACKETSIZE))
-
-                if packet.getLong() == SPLIT and packet.getLong() == reqid:
-                    total = packet.getByte()
-                    num = packet.getByte()
-                    splitsize = packet.getShort()
-                    result[num] = packet.read()
-
-                else:
-                    raise SourceQueryError('Invalid split packet')
-
-            packet = SourceQueryPacket("".join(result))
-
-            if packet.getLong() == WHOLE:
-                return packet
-
-            else:
-                raise SourceQueryError('Invalid split packet')
-
-        else:
-            raise SourceQueryError("Received invalid packet type %d" % (typ,))
+        """Return the bytes of the next complete reply, joining any splits."""
+        reassembler = SplitReassembler()
+        while True:
+            data = reassembler.feed(self.udp.recv(PACKETSIZE))
+            if data is not None:
+                return data
 
     def challenge(self):
         # use A2S_PLAYER to obtain a challenge
@@ -195,11 +435,10 @@ class SourceQuery(object):
         packet.putLong(CHALLENGE)
 
         self.udp.send(packet.getvalue())
-        packet = self.receive()
+        header, challenge = decode_reply(self.receive())
 
         # this is our challenge packet
-        if packet.getByte() == S2C_CHALLENGE:
-            challenge = packet.getLong()
+        if header == S2C_CHALLENGE:
             return challenge
 
     def ping(self):
@@ -213,62 +452,19 @@ class SourceQuery(object):
         packet = self._send_info_packet()
         before = time.time()
         self.udp.send(packet.getvalue())
-        packet = self.receive()
+        header, result = decode_reply(self.receive())
         after = time.time()
 
-        header = packet.getByte()
-
         # TODO: Merge this into a function
         if header == S2C_CHALLENGE:
-            num = packet.getLong()
-            packet = self._send_info_packet(num)
+            packet = self._send_info_packet(result)
             before = time.time()
             self.udp.send(packet.getvalue())
-            packet = self.receive()
+            header, result = decode_reply(self.receive())
             after = time.time()
-            header = packet.getByte()
 
         if header == A2S_INFO_REPLY:
-            result = {}
-
             result['ping'] = after - before
-
-            result['network_version'] = packet.getByte()
-            result['hostname'] = packet.getString()
-            result['map'] = packet.getString()
-            result['gamedir'] = packet.getString()
-            result['gamedesc'] = packet.getString()
-            result['appid'] = packet.getShort()
-            result['numplayers'] = packet.getByte()
-            result['maxplayers'] = packet.getByte()
-            result['numbots'] = packet.getByte()
-            result['dedicated'] = chr(packet.getByte())
-            result['os'] = chr(packet.getByte())
-            result['passworded'] = packet.getByte()
-            result['secure'] = packet.getByte()
-            result['version'] = packet.getString()
-
-            # edf may or may not be present
-            # contents undefined (see wiki page)
-            # this protocol is horrible
-            try:
-                edf = packet.getByte()
-                result['edf'] = edf
-
-                if edf & 0x80:
-                    result['port'] = packet.getShort()
-                if edf & 0x10:
-                    result['steamid'] = packet.getLongLong()
-                if edf & 0x40:
-                    result['specport'] = packet.getShort()
-                    result['specname'] = packet.getString()
-                if edf & 0x20:
-                    result['tag'] = packet.getString()
-            except Exception as ex:
-                print(ex)
-                # let's just ignore all errors...
-                pass
-
             return result
 
     def player(self):
@@ -281,27 +477,10 @@ class SourceQuery(object):
         packet.putLong(challenge)
 
         self.udp.send(packet.getvalue())
-        packet = self.receive()
+        header, result = decode_reply(self.receive())
 
         # this is our player info
-        if packet.getByte() == A2S_PLAYER_REPLY:
-            numplayers = packet.getByte()
-
-            result = []
-
-            # TF2 32player servers may send an incomplete reply
-            try:
-                for x in range(numplayers):
-                    player = {}
-                    player['index'] = packet.getByte()
-                    player['name'] = packet.getString()
-                    player['kills'] = packet.getLong()
-                    player['time'] = packet.getFloat()
-                    result.append(player)
-
-            except:
-                pass
-
+        if header == A2S_PLAYER_REPLY:
             return result
 
     def rules(self):
@@ -314,20 +493,216 @@ class SourceQuery(object):
         packet.putLong(challenge)
 
         self.udp.send(packet.getvalue())
-        packet = self.receive()
+        header, result = decode_reply(self.receive())
 
         # this is our rules
-        if packet.getByte() == A2S_RULES_REPLY:
-            rules = {}
-            numrules = packet.getShort()
+        if header == A2S_RULES_REPLY:
+            return result
 
-            # TF2 sends incomplete packets, so we have to ignore numrules
-            while 1:
-                try:
-                    key = packet.getString()
-                    rules[key] = packet.getString()
-                except:
+class SourceQuerySession(object):
+    """A long-lived query session with a single server.
+
+    The UDP socket is kept open between queries and the S2C_CHALLENGE token
+    is cached until the server rejects it by sending a new one. Requests are
+    pipelined, so a full snapshot of info, players and rules costs about one
+    round trip rather than one or two for each query.
+
+    Example usage:
+
+       import SourceQuery
+       session = SourceQuery.SourceQuerySession('1.2.3.4', 27015)
+       print session.query()
+       print session.query(['player'])
+       session.close()
+    """
+
+    def __init__(self, host, port=27015, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.udp = False
+        self.challenge = None
+        self.pending = {}
+        self.sent = {}
+        self.results = {}
+        self.reassembler = SplitReassembler()
+
+    def connect(self):
+        if self.udp:
+            return
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setblocking(False)
+        self.udp.connect((self.host, self.port))
+        self.reassembler = SplitReassembler()
+
+    def close(self):
+        if self.udp:
+            self.udp.close()
+            self.udp = False
+
+    def fileno(self):
+        return self.udp.fileno()
+
+    def start(self, queries):
+        """Send every query at once without waiting for the replies."""
+        self.connect()
+
+        # Throw away anything left over from a query that timed out
+        try:
+            while True:
+                self.udp.recv(PACKETSIZE)
+        except BlockingIOError:
+            pass
+        self.reassembler = SplitReassembler()
+
+        self.pending = {}
+        self.results = {}
+        for query in queries:
+            self._send(query)
+
+    def _send(self, query):
+        challenge = CHALLENGE if self.challenge is None else self.challenge
+        self.udp.send(_request_packet(query, challenge).getvalue())
+        self.pending[query] = challenge
+        self.sent[query] = time.time()
+
+    def handle(self):
+        """Read the next packet, returning True once every query has been
+        answered."""
+        data = self.reassembler.feed(self.udp.recv(PACKETSIZE))
+        if data is None:
+            return not self.pending
+
+        after = time.time()
+        header, result = decode_reply(data)
+
+        if header == S2C_CHALLENGE:
+            # Either the first challenge or the cached one was rejected, so
+            # resend anything that went out with a different token
+            self.challenge = result
+            for query, challenge in list(self.pending.items()):
+                if challenge != result:
+                    self._send(query)
+
+        else:
+            query = REPLIES[header]
+            if query in self.pending:
+                if query == 'info':
+                    result['ping'] = after - self.sent[query]
+                self.results[query] = result
+                del self.pending[query]
+
+        return not self.pending
+
+    def query(self, queries=('info', 'player', 'rules')):
+        """Return a dict of each query to its result, or None for any which
+        weren't answered before the timeout."""
+        self.start(queries)
+        deadline = time.time() + self.timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.udp, selectors.EVENT_READ)
+            while self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not selector.select(remaining):
                     break
+                self.handle()
+
+        return {query: self.results.get(query) for query in queries}
+
+    def info(self):
+        return self._single('info')
+
+    def player(self):
+        return self._single('player')
+
+    def rules(self):
+        return self._single('rules')
+
+    def _single(self, query):
+        result = self.query([query])[query]
+        if result is None:
+            raise socket.timeout(f"No {query} reply from {self.host}:{self.port}")
+        return result
 
-            return rules
 
+class SourceQueryMulti(object):
+    """Query many servers at once over non-blocking UDP sockets.
+
+    Every request is sent up front and the replies are collected under a
+    single shared deadline, so the total time taken is bounded by the slowest
+    server rather than the sum of all of them. Passing in the same `sessions`
+    dict on each call keeps the sockets and challenges between calls.
+
+    Example usage:
+
+       import SourceQuery
+       servers = [('1.2.3.4', 27015), ('5.6.7.8', 27015)]
+       print SourceQuery.SourceQueryMulti(servers).info()
+    """
+
+    def __init__(self, servers, timeout=1.0, sessions=None):
+        self.servers = list(servers)
+        self.timeout = timeout
+        self.owns_sessions = sessions is None
+        self.sessions = {} if sessions is None else sessions
+
+    def info(self):
+        """Return a dict of (host, port) to server info, or None for any
+        server that didn't answer before the deadline."""
+        results = self.query(['info'])
+        return {server: result['info'] for server, result in results.items()}
+
+    def query(self, queries=('info', 'player', 'rules')):
+        """Return a dict of (host, port) to a dict of each query's result,
+        with None for anything that wasn't answered before the deadline."""
+        results = {server: dict.fromkeys(queries) for server in self.servers}
+        selector = selectors.DefaultSelector()
+
+        try:
+            for server in results:
+                session = self.sessions.get(server)
+                if session is None:
+                    session = self.sessions[server] = SourceQuerySession(*server)
+                try:
+                    session.start(queries)
+                except OSError as ex:
+                    print(f"Could not query {server}: {ex}")
+                    session.close()
+                    continue
+
+                selector.register(session, selectors.EVENT_READ, server)
+
+            deadline = time.time() + self.timeout
+            while selector.get_map():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                for key, _ in selector.select(remaining):
+                    server = key.data
+                    session = key.fileobj
+                    try:
+                        done = session.handle()
+                    except (OSError, IndexError, ValueError, KeyError,
+                            struct.error, SourceQueryError) as ex:
+                        # ICMP port unreachable surfaces as ConnectionRefusedError
+                        print(f"Server {server} not ready: {ex}")
+                        selector.unregister(session)
+                        session.close()
+                        done = False
+
+                    results[server].update(session.results)
+                    if done:
+                        selector.unregister(session)
+
+        finally:
+            selector.close()
+            if self.owns_sessions:
+                self.close()
+
+        return results
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
@@ -0,0 +1,101 @@
+"""https://developer.valvesoftware.com/wiki/Source_RCON_Protocol"""
+
+import socket
+import struct
+
+SERVERDATA_AUTH = 3
+SERVERDATA_AUTH_RESPONSE = 2
+SERVERDATA_EXECCOMMAND = 2
+SERVERDATA_RESPONSE_VALUE = 0
+
+# id, type and the two null terminators
+MIN_PACKETSIZE = 10
+MAX_PACKETSIZE = 4096
+
+
+class SourceRconError(Exception):
+    pass
+
+
+class SourceRcon(object):
+    """Example usage:
+
+       import SourceRcon
+       server = SourceRcon.SourceRcon('1.2.3.4', 27015, 'password')
+       print server.execute('status')
+       server.disconnect()
+    """
+
+    def __init__(self, host, port=27015, password='', timeout=5.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.tcp = False
+        self.reqid = 0
+
+    def connect(self):
+        self.disconnect()
+        self.tcp = socket.create_connection((self.host, self.port), self.timeout)
+
+        # The server sends an empty response value before the auth response
+        reqid = self._send(SERVERDATA_AUTH, self.password)
+        while True:
+            resid, typ, _ = self._receive()
+            if typ == SERVERDATA_AUTH_RESPONSE:
+                break
+
+        if resid == -1 or resid != reqid:
+            self.disconnect()
+            raise SourceRconError('Authentication failed')
+
+    def disconnect(self):
+        if self.tcp:
+            self.tcp.close()
+            self.tcp = False
+
+    def execute(self, command):
+        """Run a console command and return its output."""
+        if not self.tcp:
+            self.connect()
+
+        reqid = self._send(SERVERDATA_EXECCOMMAND, command)
+
+        # Responses can be split over many packets, so follow the command with
+        # an empty packet which the server mirrors once the output is complete
+        marker = self._send(SERVERDATA_RESPONSE_VALUE, '')
+
+        result = []
+        while True:
+            resid, typ, body = self._receive()
+            if resid == marker:
+                break
+            if resid == reqid and typ == SERVERDATA_RESPONSE_VALUE:
+                result.append(body)
+
+        return ''.join(result)
+
+    def _send(self, typ, body):
+        self.reqid += 1
+        data = struct.pack('<ll', self.reqid, typ) + body.encode('utf-8') + b'\x00\x00'
+        self.tcp.sendall(struct.pack('<l', len(data)) + data)
+        return self.reqid
+
+    def _receive(self):
+        size = struct.unpack('<l', self._read(4))[0]
+        if size < MIN_PACKETSIZE or size > MAX_PACKETSIZE:
+            raise SourceRconError("Received invalid packet size %d" % (size,))
+
+        data = self._read(size)
+        resid, typ = struct.unpack('<ll', data[:8])
+        body = data[8:-2].decode('utf-8', 'replace')
+        return resid, typ, body
+
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.tcp.recv(size - len(data))
+            if not chunk:
+                raise SourceRconError('Connection closed by server')
+            data += chunk
+        return data
@@ -1,10 +1,11 @@
-import boto3
 import json
 import os
-import requests
 
-from aws import start_ecs_task
+from urllib.request import urlopen
+
+from aws import get_client, start_ecs_task
 from common import return_code
+from metrics import instrument
 
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
@@ -16,6 +17,7 @@ SERVER_VERSION_PARAM = os.environ.get('SERVER_VERSION_PARAM')
 URL = "http://api.steampowered.com/ISteamApps/UpToDateCheck/v0001/?appid=730&version={VERSION}&format=json"
 
 
+@instrument
 def handler(event, context):
     print("Checking CSGO server version to see if update is required")
 
@@ -35,15 +37,15 @@ def handler(event, context):
 
 
 def get_current_version():
-    client = boto3.client('ssm')
+    client = get_client('ssm')
     parameter = client.get_parameter(Name=SERVER_VERSION_PARAM)
     return parameter['Parameter']['Value']
 
 
 def check_version(current_version):
     url = URL.format(VERSION=current_version)
-    resp = requests.get(url)
-    return resp.json()['response']
+    with urlopen(url, timeout=10) as resp:
+        return json.load(resp)['response']
 
 
 def update_version(required_version):
@@ -53,7 +55,7 @@ def update_version(required_version):
 
 def update_version_parameter(required_version):
     print(f"Updating parameter store to {required_version}")
-    client = boto3.client('ssm')
+    client = get_client('ssm')
     parameter = client.put_parameter(
             Name=SERVER_VERSION_PARAM,
             Value=required_version,
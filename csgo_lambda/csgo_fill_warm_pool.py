@@ -0,0 +1,75 @@
+import json
+import os
+
+from aws import send_batch_to_queue
+from common import return_code
+from datetime import datetime
+from metrics import instrument
+from warm_pool import get_idle_tasks, start_pool_tasks
+
+ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
+TASK_DEFN = os.environ.get('TASK_DEFN')
+TASK_FAMILY = os.environ.get('TASK_FAMILY')
+SUBNETS = os.environ.get('SUBNETS')
+SECURITY_GROUPS = os.environ.get('SECURITY_GROUPS')
+CONTAINER_NAME = os.environ.get('CONTAINER_NAME')
+GET_HOSTNAME_QUEUE = os.environ.get('GET_HOSTNAME_QUEUE')
+WARM_POOL_SIZE = int(os.environ.get('WARM_POOL_SIZE', '0'))
+WARM_POOL_TICKRATE = os.environ.get('WARM_POOL_TICKRATE', '128')
+QUEUE_RETRIES = 2
+
+
+@instrument
+def handler(event, context):
+    """ Top the warm pool back up to WARM_POOL_SIZE idle servers.
+
+    Runs on a schedule, and is also invoked by the start function each time
+    it takes a server out of the pool. Each new server is sent on to get a
+    hostname so it's ready to be handed out straight away.
+
+    Args:
+        event (dict): Event getting passed to the function
+        context (dict): The context the function runs in
+
+    Returns:
+        dict: ARNs of the tasks started, and those which couldn't be sent
+            on to get a hostname
+    """
+
+    fmt = "%Y-%m-%d %H:%M:%S"
+    idle = len(get_idle_tasks(ECS_CLUSTER, TASK_FAMILY))
+    required = WARM_POOL_SIZE - idle
+    print(f"{idle} idle servers in the warm pool, starting {max(required, 0)}")
+    if required <= 0:
+        return return_code(200, {'taskArns': []})
+
+    subnets = SUBNETS.split(',')
+    security_groups = SECURITY_GROUPS.split(',')
+    task_details = start_pool_tasks(
+            ECS_CLUSTER, TASK_DEFN, subnets, security_groups,
+            get_env_overrides(), required)
+
+    # Send the tasks to get a hostname assigned
+    start_time = datetime.now().strftime(fmt)
+    messages = [json.dumps({'task_arn': task['taskArn'], 'start_time': start_time})
+                for task in task_details]
+    failed = send_batch_to_queue(GET_HOSTNAME_QUEUE, messages, retries=QUEUE_RETRIES)
+    task_arns = [task['taskArn'] for task in task_details]
+
+    response = {'taskArns': task_arns}
+    if failed:
+        # These still get a hostname from their task state change once running
+        response['notQueued'] = [json.loads(message)['task_arn'] for message in failed]
+    return return_code(200, response)
+
+
+def get_env_overrides():
+    return {
+        'containerOverrides': [{
+            'name': CONTAINER_NAME,
+            'environment': [{
+                'name': 'TICKRATE',
+                'value': WARM_POOL_TICKRATE
+            }]
+        }]
+    }
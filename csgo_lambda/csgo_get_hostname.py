@@ -1,18 +1,29 @@
 import json
 import os
+import random
 
-from aws import get_running_task_count, get_task_details, get_public_ip, create_route53_record, send_to_queue
-from common import return_code
+from aws import (get_running_tasks, get_hostname_index, retrieve_hostnames, send_to_queue,
+                 invoke_function_async, Route53ChangeSet)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from fleet_state import FLEET_STATE_TABLE, update_task_state
+from hostname_slots import claim_slot, claim_slots
+from inventory import get_inventory
+from metrics import increment, instrument
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 TASK_FAMILY = os.environ.get('TASK_FAMILY')
 HOSTED_ZONE_ID = os.environ.get('HOSTED_ZONE_ID')
 DNS_HOSTNAME = os.environ.get('DNS_HOSTNAME')
 GET_HOSTNAME_QUEUE = os.environ.get('GET_HOSTNAME_QUEUE')
+READINESS_PROBE_FUNCTION = os.environ.get('READINESS_PROBE_FUNCTION')
 SECONDS_TO_RUN = 10*60
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+MAX_WORKERS = 10
 
 
+@instrument
 def handler(event, context):
     """ Creates a Route53 record pointing to the IP address sent on.
 
@@ -23,73 +34,246 @@ def handler(event, context):
 
     {
         'task_arn': 'arn:aws:ecs:eu-west-1:150673653788:task/csgo-prac-aws-cluster/253a4a666c09494aa5d3ae69011e08d1',
-        'start_time': '2021-10-05 10:00:00'
+        'start_time': '2021-10-05 10:00:00',
+        'attempt': 0
     }
 
     The start_time represents the time the request happened, as the function
     needs to stop running after a period of time to prevent running forever.
+    If the task isn't ready the message is sent back to the queue with the
+    attempt incremented and a delay that grows exponentially with jitter.
+
+    The state of the fleet and the hostname slots are read once for the whole
+    batch, and the calls made for each message run concurrently. A message
+    which fails doesn't fail the others: only the IDs of failed messages are
+    returned as batchItemFailures, so SQS redelivers just those.
 
     Args:
-        event (dict): Event getting passed to the function via an API
+        event (dict): Event getting passed to the function via SQS
         context (dict): The context the function runs in
 
     Returns:
-        dict: Details of the container being started
+        dict: The message IDs of the records which failed
     """
 
-    print(json.dumps(event))
-    fmt = "%Y-%m-%d %H:%M:%S"
-    hostnames = []
+    bodies = {}
+    failed = []
     for record in event['Records']:
-        body = json.loads(record['body'])
+        try:
+            body = json.loads(record['body'])
+        except ValueError:
+            print(f"Message {record['messageId']} is not valid JSON")
+            failed.append(record['messageId'])
+            continue
+        if not isinstance(body, dict) or not isinstance(body.get('task_arn'), str):
+            print(f"Message {record['messageId']} has no task_arn")
+            failed.append(record['messageId'])
+            continue
+        bodies[record['messageId']] = body
+
+    # Fetch the state of the fleet once for every record in the batch
+    tasks = get_inventory(ECS_CLUSTER, TASK_FAMILY)
+    public_ips = {task.task_arn: task.public_ip for task in tasks}
+    index = get_hostname_index(HOSTED_ZONE_ID, max_age=0)
+
+    waiting = {}
+    hostnames = {}
+    needed = {}
+    for message_id, body in bodies.items():
         task_arn = body['task_arn']
-        start_time = datetime.strptime(body['start_time'], fmt)
-        hostname = create_hostname(task_arn)
+        public_ip = public_ips.get(task_arn)
+        if not public_ip:
+            print(f"No public IP for {task_arn} - task is not ready")
+            waiting[message_id] = (body,)
+        elif index.get(public_ip):
+            # The task state change event may have got here first
+            print(f"{public_ip} already has a hostname: {index[public_ip]}")
+            hostnames[message_id] = (task_arn, public_ip, index[public_ip][0])
+        else:
+            needed[message_id] = (task_arn, public_ip)
 
-        # Sometimes the host might not be ready - just resend to the queue
-        if not hostname:
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        failed += map_messages(executor, retry_later, waiting)[1]
 
-            # Only resend if we're still within the threshold
-            if check_time_passed(start_time) <= SECONDS_TO_RUN:
-                print("Resending message to queue")
-                send_to_queue(GET_HOSTNAME_QUEUE, task_arn)
-            else:
-                print("Time expired, create hostname failed")
+        created, errors = create_hostnames(needed, public_ips.keys())
+        hostnames.update(created)
+        failed += errors
 
-            continue
+        failed += map_messages(executor, record_hostname, hostnames)[1]
+
+    increment('HostnameFailures', len(failed))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
+
+
+def map_messages(executor, function, messages):
+    """ Call a function for each message in a thread pool.
+
+    Args:
+        executor (ThreadPoolExecutor): The pool to run the calls in
+        function (function): The function to call
+        messages (dict): Message IDs mapped to the arguments to call it with
+
+    Returns:
+        tuple: Message IDs mapped to what the function returned, and the IDs
+            of the messages where it raised an error
+    """
+
+    futures = {message_id: executor.submit(function, *args)
+               for message_id, args in messages.items()}
+    results = {}
+    failed = []
+    for message_id, future in futures.items():
+        try:
+            results[message_id] = future.result()
+        except Exception as ex:
+            print(f"Message {message_id} failed: {ex}")
+            failed.append(message_id)
+    return results, failed
+
+
+def create_hostnames(needed, running_arns):
+    """ Claim slots for many tasks and create all their records together.
+
+    Every record is sent in one change batch. If Route53 rejects the batch
+    each record is sent on its own, so one bad change only fails the message
+    it came from.
+
+    Args:
+        needed (dict): Message IDs mapped to the task ARN and IP needing a
+                       hostname
+        running_arns (list): ARNs of the running tasks
+
+    Returns:
+        tuple: Message IDs mapped to the task ARN, IP and hostname created,
+            and the IDs of the messages which failed
+    """
 
-        hostnames.append(hostname)
+    if len(needed) == 0:
+        return {}, []
 
-    return return_code(200, {'hostnames': hostnames})
+    try:
+        slots = claim_slots([task_arn for task_arn, _ in needed.values()], running_arns)
+    except Exception as ex:
+        print(f"Could not claim hostname slots: {ex}")
+        return {}, list(needed)
 
+    created = {}
+    changes = {}
+    for message_id, (task_arn, public_ip) in needed.items():
+        hostname = f"csgo{slots[task_arn]}.{DNS_HOSTNAME}"
+        print(f"Creating {hostname} record for {public_ip}")
+        created[message_id] = (task_arn, public_ip, hostname)
+        changes[message_id] = Route53ChangeSet(HOSTED_ZONE_ID)
+        changes[message_id].upsert(hostname, public_ip)
 
-def create_hostname(task_arn):
+    batch = Route53ChangeSet(HOSTED_ZONE_ID)
+    for record_changes in changes.values():
+        batch.update(record_changes)
+    try:
+        batch.commit()
+        return created, []
+    except Exception as ex:
+        print(f"Sending the records together failed, sending them one at a time: {ex}")
+
+    failed = []
+    for message_id, record_changes in changes.items():
+        try:
+            record_changes.commit()
+        except Exception as ex:
+            print(f"Message {message_id} failed: {ex}")
+            failed.append(message_id)
+            del created[message_id]
+    return created, failed
+
+
+def retry_later(body):
+    """ Send a message back to the queue to try again once the task is ready.
+
+    Args:
+        body (dict): The body of the message
+    """
+
+    fmt = "%Y-%m-%d %H:%M:%S"
+    start_time = datetime.strptime(body['start_time'], fmt)
+
+    # Only resend if we're still within the threshold
+    attempt = body.get('attempt', 0) + 1
+    remaining = SECONDS_TO_RUN - check_time_passed(start_time)
+    if remaining > 0:
+        delay = min(get_retry_delay(attempt), int(remaining))
+        print(f"Resending message to queue, attempt {attempt} in {delay}s")
+        send_to_queue(GET_HOSTNAME_QUEUE, json.dumps({**body, 'attempt': attempt}), delay)
+    else:
+        print("Time expired, create hostname failed")
+
+
+def create_hostname(task_arn, public_ip, running_arns=None):
     """ Create a hostname pointing to the public IP of the task.
 
+    The subdomain comes from a hostname slot claimed for the task, so tasks
+    starting together always get different names.
+
     Args:
         task_arn (str): The ARN of the task
+        public_ip (str): The public IP of the task, if it has one yet
+        running_arns (list): ARNs of the running tasks, if already known
 
     Returns:
         str: The hostname assigned to the task
     """
 
-    public_ip = get_public_ip(ECS_CLUSTER, task_arn)
     if not public_ip:
         print("No public IP - task is not ready")
         return None
 
-    task_count = get_running_task_count(ECS_CLUSTER, TASK_FAMILY)
-    if task_count == 0:
+    # The task state change event may have got here first
+    hostnames = retrieve_hostnames(HOSTED_ZONE_ID, public_ip)
+    if hostnames:
+        print(f"{public_ip} already has a hostname: {hostnames}")
+        record_hostname(task_arn, public_ip, hostnames[0])
+        return hostnames[0]
+
+    if running_arns is None:
+        running_arns = get_running_tasks(ECS_CLUSTER, TASK_FAMILY)
+    if task_arn not in running_arns:
         print("Task is not yet running - trying again later")
         return None
 
-    subdomain = f"csgo{task_count}"
+    slot = claim_slot(task_arn, running_arns)
+    subdomain = f"csgo{slot}"
     hostname = f"{subdomain}.{DNS_HOSTNAME}"
     print(f"Creating {hostname} record for {public_ip}")
 
-    create_route53_record(HOSTED_ZONE_ID, hostname, public_ip)
+    changes = Route53ChangeSet(HOSTED_ZONE_ID)
+    changes.upsert(hostname, public_ip)
+    changes.commit()
+    record_hostname(task_arn, public_ip, hostname)
     return hostname
 
 
+def record_hostname(task_arn, public_ip, hostname):
+    if FLEET_STATE_TABLE:
+        update_task_state(task_arn, public_ip=public_ip, hostnames=[hostname])
+
+    # Now the server has an address it can be watched until it's ready
+    if READINESS_PROBE_FUNCTION:
+        invoke_function_async(READINESS_PROBE_FUNCTION,
+                              {'task_arn': task_arn, 'public_ip': public_ip})
+
+
+def get_retry_delay(attempt):
+    """ Get how long to wait before the next attempt, using full jitter.
+
+    Args:
+        attempt (int): The number of the attempt about to be made
+
+    Returns:
+        int: The number of seconds to delay the message by
+    """
+
+    ceiling = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return max(1, round(random.uniform(0, ceiling)))
+
+
 def check_time_passed(time):
     return (datetime.now()-time).total_seconds()
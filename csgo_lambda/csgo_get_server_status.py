@@ -1,20 +1,56 @@
+import hashlib
 import json
 import os
-import socket
+import time
 
-from aws import get_running_tasks, get_task_details, get_public_ip, retrieve_hostnames
-from common import return_code
-from SourceQuery import SourceQuery
+from aws import get_hostname_index
+from common import return_code, not_modified, get_header
+from fleet_state import FLEET_STATE_TABLE, get_fleet_state, get_fleet_version
+from inventory import get_inventory
+from metrics import instrument, record, timed
+from SourceQuery import SourceQueryMulti
+from warm_pool import WARM_POOL_STARTED_BY, WARM_POOL_TABLE, get_claimed_tasks, is_idle_pool_task
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 TASK_FAMILY = os.environ.get('TASK_FAMILY')
 HOSTED_ZONE_ID = os.environ.get('HOSTED_ZONE_ID')
+STATUS_CACHE_TTL = int(os.environ.get('STATUS_CACHE_TTL', '0'))
+FLEET_STATE_MAX_AGE = int(os.environ.get('FLEET_STATE_MAX_AGE', '90'))
+LONG_POLL_RESOURCE = '/status/poll'
+LONG_POLL_INTERVAL = 2
+LONG_POLL_MAX_TIMEOUT = 25
 
+# Without a fleet state table there's nothing cheap to watch for changes, so
+# the status is rebuilt no more often than the dashboard used to poll
+LONG_POLL_REBUILD_INTERVAL = 5
+QUERY_TIMEOUT = float(os.environ.get('QUERY_TIMEOUT', '1.0'))
+DETAILED_QUERY_TIMEOUT = float(os.environ.get('DETAILED_QUERY_TIMEOUT', '2.0'))
+DETAILED_RULES = ('tickrate', 'game_mode', 'game_type')
 
+# The last snapshots built by this container, shared by warm invocations and
+# keyed by whether they are detailed and how stale the stored state may be
+_snapshots = {}
+
+# Query sessions kept open between warm invocations, keyed by (ip, port)
+_sessions = {}
+
+
+@instrument
 def handler(event, context):
     """ Get the status of running CSGO servers.
 
-    There should only be one running server at any time.
+    The status is served from a short-lived snapshot so that many dashboards
+    polling at once don't each cause a full round of AWS calls and server
+    queries. If the client sends the ETag of the snapshot it already has in
+    an If-None-Match header, a 304 is returned with no body.
+
+    Passing `detail=true` in the query string adds live player counts, the
+    player list and selected rules from each server.
+
+    Otherwise the status is read from the fleet state table, as long as the
+    prober has checked every server within FLEET_STATE_MAX_AGE seconds, or
+    within the `max_age` query parameter if one is passed. Older state falls
+    back to asking ECS, Route53 and the servers directly.
 
     Args:
         event (dict): Event getting passed to the function via an API
@@ -24,56 +60,352 @@ def handler(event, context):
         dict: Details of the running containers
     """
 
+    if event.get('resource') == LONG_POLL_RESOURCE:
+        return long_poll(event, context)
+
+    try:
+        max_staleness = get_max_staleness(event)
+    except ValueError as ex:
+        return return_code(400, {'error': str(ex)})
+
+    snapshot = get_status_snapshot(detailed=is_detailed(event), max_staleness=max_staleness)
+    if get_header(event, 'If-None-Match') == snapshot['etag']:
+        return not_modified(snapshot['etag'])
+
+    return return_code(200, snapshot['body'], {'ETag': snapshot['etag']})
+
+
+def long_poll(event, context):
+    """ Wait for the status to differ from the version the client has.
+
+    The client passes the ETag of its last snapshot as the `version` query
+    parameter, and the request is held open until the status changes or
+    `timeout` seconds have passed, in which case a 304 is returned.
+
+    Each held request is its own invocation, so rather than rebuilding the
+    status over and over, the version counter of the fleet state table is
+    read every LONG_POLL_INTERVAL seconds and the status is only rebuilt once
+    something has written to the table. The prober writes to it on every
+    sweep, so live details are still refreshed at least that often.
+
+    Args:
+        event (dict): Event getting passed to the function via an API
+        context (dict): The context the function runs in
+
+    Returns:
+        dict: Details of the running containers, or a 304 if unchanged
+    """
+
+    params = event.get('queryStringParameters') or {}
+    version = params.get('version')
+    detailed = is_detailed(event)
+    try:
+        timeout = min(get_int_param(event, 'timeout', LONG_POLL_MAX_TIMEOUT),
+                      LONG_POLL_MAX_TIMEOUT)
+        max_staleness = get_max_staleness(event)
+    except ValueError as ex:
+        return return_code(400, {'error': str(ex)})
+
+    # Leave enough time to build and return a final snapshot
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000
+        timeout = min(timeout, remaining - 10)
+
+    deadline = time.time() + timeout
+    interval = LONG_POLL_INTERVAL if FLEET_STATE_TABLE else LONG_POLL_REBUILD_INTERVAL
+
+    # Read the version first, so a write made while building isn't missed
+    fleet_version = get_fleet_version() if FLEET_STATE_TABLE else None
+    snapshot = get_status_snapshot(detailed=detailed, max_staleness=max_staleness)
+    while snapshot['etag'] == version:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return not_modified(snapshot['etag'])
+        time.sleep(min(interval, remaining))
+
+        if FLEET_STATE_TABLE:
+            latest = get_fleet_version()
+            if latest == fleet_version:
+                continue
+            fleet_version = latest
+        snapshot = get_status_snapshot(0, detailed, max_staleness)
+
+    return return_code(200, snapshot['body'], {'ETag': snapshot['etag']})
+
+
+def is_detailed(event):
+    params = event.get('queryStringParameters') or {}
+    return params.get('detail', '').lower() in ('1', 'true')
+
+
+def get_max_staleness(event):
+    return get_int_param(event, 'max_age', FLEET_STATE_MAX_AGE)
+
+
+def get_int_param(event, name, default):
+    """ Read a number of seconds from the query string.
+
+    Args:
+        event (dict): Event getting passed to the function via an API
+        name (str): Name of the query string parameter
+        default (int): The value to use if it wasn't passed
+
+    Returns:
+        int: The value of the parameter
+
+    Raises:
+        ValueError: If the value isn't a whole number
+    """
+
+    params = event.get('queryStringParameters') or {}
+    value = params.get(name)
+    if value is None:
+        return default
+    if not value.isdecimal():
+        raise ValueError(f"{name} must be a whole number of seconds")
+    return int(value)
+
+
+def get_status_snapshot(max_age=None, detailed=False, max_staleness=None):
+    """ Get the status of the servers along with a hash of its content.
+
+    Args:
+        max_age (int): How old in seconds a cached snapshot can be, defaults
+                       to the STATUS_CACHE_TTL environment variable
+        detailed (bool): Whether to include live details from the servers
+        max_staleness (int): How old in seconds the fleet state table can be
+
+    Returns:
+        dict: The status body, its ETag and the time it was built
+    """
+
+    if max_age is None:
+        max_age = STATUS_CACHE_TTL
+    if max_staleness is None:
+        max_staleness = FLEET_STATE_MAX_AGE
+
+    key = (detailed, max_staleness)
+    snapshot = _snapshots.get(key)
+    if snapshot is not None and time.time() - snapshot['built_at'] < max_age:
+        return snapshot
+
+    body = get_status(detailed, max_staleness)
+    now = time.time()
+
+    # Clients can pick any max_age, so only keep snapshots which can still be served
+    for old in [old for old, cached in _snapshots.items()
+                if now - cached['built_at'] >= STATUS_CACHE_TTL]:
+        del _snapshots[old]
+    snapshot = _snapshots[key] = {
+        'body': body,
+        'etag': get_etag(body),
+        'built_at': now
+    }
+    return snapshot
+
+
+def get_etag(body):
+    """ Hash the parts of the status which only change when the fleet does.
+
+    The ping of each server and how long each player has been connected are
+    different every time the servers are queried, so they're left out of the
+    hash. Otherwise a detailed status would never be unchanged.
+
+    Args:
+        body (dict): The status body
+
+    Returns:
+        str: The quoted ETag of the body
+    """
+
+    tasks = []
+    for task in body.get('task_details') or []:
+        task = {key: value for key, value in task.items() if key != 'ping'}
+        if task.get('players') is not None:
+            task['players'] = [{key: value for key, value in player.items() if key != 'time'}
+                               for player in task['players']]
+        tasks.append(task)
+
+    stable = {**body, 'task_details': tasks if body.get('task_details') is not None else None}
+    digest = hashlib.sha1(json.dumps(stable, sort_keys=True).encode('utf-8'))
+    return f'"{digest.hexdigest()}"'
+
+
+def get_status(detailed=False, max_staleness=None):
+    """ Get the details of every running server.
+
+    Args:
+        detailed (bool): Whether to include live details from the servers
+        max_staleness (int): How old in seconds the fleet state table can be,
+                             defaults to FLEET_STATE_MAX_AGE
+
+    Returns:
+        dict: Details of the running containers
+    """
+
+    # The table doesn't hold the player lists and rules of detailed requests
+    if FLEET_STATE_TABLE and not detailed:
+        body = get_stored_status(FLEET_STATE_MAX_AGE if max_staleness is None
+                                 else max_staleness)
+        if body is not None:
+            return body
+
     fmt = '%Y-%m-%d %H:%M:%S'
-    task_arns = get_running_tasks(ECS_CLUSTER, TASK_FAMILY)
-    if len(task_arns) == 0:
-        return return_code(200, {'task_details': None})
+    tasks = get_inventory(ECS_CLUSTER, TASK_FAMILY)
+
+    # Servers waiting in the warm pool haven't been started by anyone yet
+    pool_arns = [task.task_arn for task in tasks
+                 if task.started_by == WARM_POOL_STARTED_BY]
+    if WARM_POOL_TABLE and pool_arns:
+        claimed = get_claimed_tasks(pool_arns)
+        tasks = [task for task in tasks if not is_idle_pool_task(task, claimed)]
 
-    task_details = get_task_details(ECS_CLUSTER, task_arns)
+    if len(tasks) == 0:
+        return {'task_details': None}
+
+    public_ips = [task.public_ip for task in tasks]
+    hostname_index = get_hostname_index(HOSTED_ZONE_ID)
+    if detailed:
+        server_info = query_servers(public_ips, 27015,
+                                    ('info', 'player', 'rules'),
+                                    DETAILED_QUERY_TIMEOUT)
+    else:
+        server_info = query_servers(public_ips, 27015, ('info',),
+                                    QUERY_TIMEOUT)
 
     output = []
-    for task in task_details:
+    for task in tasks:
 
-        public_ip = get_public_ip(ECS_CLUSTER, task['taskArn'])
-        hostnames = retrieve_hostnames(HOSTED_ZONE_ID, public_ip)
-        server_query = query_server_info(public_ip, 27015)
+        public_ip = task.public_ip
+        hostnames = hostname_index.get(public_ip, [])
+        server_query = server_info.get(public_ip, {}).get('info')
 
         single_task = {
-            'taskArn': task['taskArn'],
+            'taskArn': task.task_arn,
             'publicIp': public_ip,
             'hostnames': hostnames,
-            'startedAt': task['startedAt'].strftime(fmt) if 'startedAt' in task else None,
-            'lastStatus': task['lastStatus'],
-            'desiredStatus': task['desiredStatus'],
-            'cpu': task['cpu'],
-            'memory': task['memory'],
-            'overrides': task['overrides'] if 'overrides' in task else None,
-            'stopCode': task['stopCode'] if 'stopCode' in task else None,
-            'stoppedReason': task['stoppedReason'] if 'stoppedReason' in task else None,
-            'stoppingAt': task['stoppingAt'].strftime(fmt) if 'stoppingAt' in task else None,
-            'stoppedAt': task['stoppedAt'].strftime(fmt) if 'stoppedAt' in task else None,
+            'startedAt': task.started_at.strftime(fmt) if task.started_at else None,
+            'lastStatus': task.last_status,
+            'desiredStatus': task.desired_status,
+            'cpu': task.cpu,
+            'memory': task.memory,
+            'overrides': task.overrides,
+            'stopCode': task.stop_code,
+            'stoppedReason': task.stopped_reason,
+            'stoppingAt': task.stopping_at.strftime(fmt) if task.stopping_at else None,
+            'stoppedAt': task.stopped_at.strftime(fmt) if task.stopped_at else None,
             'serverReady': server_query is not None,
             'map': server_query['map'] if server_query is not None else ''
         }
+        if detailed:
+            single_task.update(get_server_details(server_info.get(public_ip, {})))
         output.append(single_task)
 
-    return return_code(200, {'task_details': output})
+    return {'task_details': output}
 
 
-def query_server_info(ip, port):
-    if ip is None:
-        return None
+def get_stored_status(max_staleness):
+    """ Get the details of every running server from the fleet state table.
 
-    q = SourceQuery(ip, port)
-    try:
-        info = q.info()
-    except socket.timeout as ex:
-        print("Server not ready")
-        return None
-    except ConnectionRefusedError as ex:
-        print("Server not ready")
+    Args:
+        max_staleness (int): How old in seconds the table can be
+
+    Returns:
+        dict: Details of the running containers, or None if the table is
+            too old to use
+    """
+
+    state = get_fleet_state()
+    swept_at = state['swept_at']
+    if swept_at is None or time.time() - swept_at > max_staleness:
+        print(f"Fleet state was last swept at {swept_at}, using the live status")
         return None
 
-    print(info)
-    return info
+    tasks = [item for item in state['tasks'] if not item.get('idle_pool')]
+    if len(tasks) == 0:
+        return {'task_details': None}
+
+    return {'task_details': [{
+        'taskArn': item['task_arn'],
+        'publicIp': item.get('public_ip'),
+        'hostnames': item.get('hostnames', []),
+        'startedAt': item.get('started_at'),
+        'lastStatus': item.get('last_status'),
+        'desiredStatus': item.get('desired_status'),
+        'cpu': item.get('cpu'),
+        'memory': item.get('memory'),
+        'overrides': item.get('overrides'),
+        'stopCode': item.get('stop_code'),
+        'stoppedReason': item.get('stopped_reason'),
+        'stoppingAt': item.get('stopping_at'),
+        'stoppedAt': item.get('stopped_at'),
+        'serverReady': item.get('server_ready', False),
+        'map': item.get('map', '')
+    } for item in tasks]}
+
+
+def get_server_details(results):
+    """ Summarise the live details of a server for the status output.
+
+    Anything the server didn't answer in time is returned as None, so a slow
+    server only loses its own details rather than holding up the request.
+
+    Args:
+        results (dict): The info, player and rules results of the server
+
+    Returns:
+        dict: Player counts, ping, player list and selected rules
+    """
+
+    info = results.get('info') or {}
+    players = results.get('player')
+    rules = results.get('rules')
+    ping = info.get('ping')
+
+    return {
+        'ping': round(ping * 1000) if ping is not None else None,
+        'numPlayers': info.get('numplayers'),
+        'maxPlayers': info.get('maxplayers'),
+        'numBots': info.get('numbots'),
+        'players': [{'name': p['name'], 'kills': p['kills'], 'time': round(p['time'])}
+                    for p in players] if players is not None else None,
+        'rules': {key: rules[key] for key in DETAILED_RULES if key in rules}
+                 if rules is not None else None
+    }
+
+
+def query_servers(ips, port, queries, timeout):
+    """ Query every server concurrently.
+
+    All servers share a single timeout, so the time taken depends on the
+    slowest server rather than the number of servers, and anything not
+    answered by then is left out.
+
+    Args:
+        ips (list): IP addresses of the servers, any None values are skipped
+        port (int): The query port of the servers
+        queries (list): Which of 'info', 'player' and 'rules' to query
+        timeout (float): The total time in seconds to wait for replies
+
+    Returns:
+        dict: IP address mapped to each query's result, or None if not ready
+    """
+
+    servers = [(ip, port) for ip in ips if ip is not None]
+
+    # Close the sessions of any servers which have gone away
+    for server in set(_sessions) - set(servers):
+        _sessions.pop(server).close()
+
+    if len(servers) == 0:
+        return {}
+
+    with timed('A2SQueryTime'):
+        results = SourceQueryMulti(servers, timeout, _sessions).query(queries)
+    for (ip, _), result in results.items():
+        if result['info'] is None:
+            print(f"Server {ip} not ready")
+        elif result['info']['ping'] is not None:
+            record('A2SPing', result['info']['ping'] * 1000)
 
+    return {ip: result for (ip, _), result in results.items()}
@@ -0,0 +1,111 @@
+import os
+import time
+
+from aws import get_hostname_index
+from common import return_code
+from csgo_get_server_status import QUERY_TIMEOUT, query_servers
+from fleet_state import delete_task_states, get_fleet_state, record_sweep, sweep_task_states
+from inventory import get_inventory
+from metrics import instrument
+from warm_pool import WARM_POOL_STARTED_BY, WARM_POOL_TABLE, get_claimed_tasks, is_idle_pool_task
+
+ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
+TASK_FAMILY = os.environ.get('TASK_FAMILY')
+HOSTED_ZONE_ID = os.environ.get('HOSTED_ZONE_ID')
+
+
+@instrument
+def handler(event, context):
+    """ Refresh the stored state of every server in the fleet.
+
+    Runs on a schedule. The start, hostname and stop functions keep the
+    fleet state table up to date as they change the fleet, and this fills in
+    everything they can't see: the ECS status of each task, whether the
+    server is answering queries yet, its map and player counts. Servers which
+    are no longer running are removed, and the sweep is recorded so the
+    status function knows how fresh the table is.
+
+    Only the fields the sweep sees are written, so the readiness prober can
+    record a server as ready while the sweep is running. Each server's
+    ready_at is set by the sweep only when it's the first to see it answer.
+
+    Args:
+        event (dict): Event getting passed to the function
+        context (dict): The context the function runs in
+
+    Returns:
+        dict: The number of servers stored and removed
+    """
+
+    # Read the table first, so a server started while this runs is never
+    # taken for one which has stopped
+    swept_at = int(time.time())
+    previous = {item['task_arn']: item for item in get_fleet_state()['tasks']}
+    tasks = get_inventory(ECS_CLUSTER, TASK_FAMILY)
+
+    pool_arns = [task.task_arn for task in tasks
+                 if task.started_by == WARM_POOL_STARTED_BY]
+    claimed = get_claimed_tasks(pool_arns) if WARM_POOL_TABLE and pool_arns else set()
+
+    hostname_index = get_hostname_index(HOSTED_ZONE_ID)
+    server_info = query_servers([task.public_ip for task in tasks], 27015,
+                                ('info',), QUERY_TIMEOUT)
+
+    states = [get_task_state(task, hostname_index, server_info.get(task.public_ip, {}),
+                             swept_at, is_idle_pool_task(task, claimed))
+              for task in tasks]
+
+    running = {task.task_arn for task in tasks}
+    removed = [task_arn for task_arn in previous if task_arn not in running]
+
+    gone = sweep_task_states(states, set(previous), if_missing=('ready_at',))
+    delete_task_states(removed, bump=False)
+    record_sweep(swept_at)
+
+    return return_code(200, {'stored': len(states) - len(gone),
+                             'removed': len(removed) + len(gone)})
+
+
+def get_task_state(task, hostname_index, results, probed_at, idle_pool):
+    """ Build the stored state of a server from its task and query results.
+
+    Args:
+        task (TaskRecord): The task as returned by `get_inventory`
+        hostname_index (dict): IP addresses mapped to their hostnames
+        results (dict): The query results of the server
+        probed_at (int): When the server was queried
+        idle_pool (bool): Whether the task is sitting unclaimed in the warm pool
+
+    Returns:
+        dict: The fields to store for the server, with ready_at only if the
+            server answered
+    """
+
+    fmt = '%Y-%m-%d %H:%M:%S'
+    info = results.get('info')
+
+    state = {
+        'task_arn': task.task_arn,
+        'public_ip': task.public_ip,
+        'hostnames': hostname_index.get(task.public_ip, []) if task.public_ip else [],
+        'started_at': task.started_at.strftime(fmt) if task.started_at else None,
+        'last_status': task.last_status,
+        'desired_status': task.desired_status,
+        'cpu': task.cpu,
+        'memory': task.memory,
+        'overrides': task.overrides,
+        'stop_code': task.stop_code,
+        'stopped_reason': task.stopped_reason,
+        'stopping_at': task.stopping_at.strftime(fmt) if task.stopping_at else None,
+        'stopped_at': task.stopped_at.strftime(fmt) if task.stopped_at else None,
+        'server_ready': info is not None,
+        'map': info['map'] if info is not None else '',
+        'num_players': info.get('numplayers') if info is not None else None,
+        'max_players': info.get('maxplayers') if info is not None else None,
+        'num_bots': info.get('numbots') if info is not None else None,
+        'probed_at': probed_at,
+        'idle_pool': idle_pool
+    }
+    if info is not None:
+        state['ready_at'] = probed_at
+    return state
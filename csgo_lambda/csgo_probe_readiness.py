@@ -0,0 +1,166 @@
+import os
+import time
+
+from aws import get_task_details, invoke_function_async
+from common import return_code
+from fleet_state import claim_readiness_probe, update_task_state
+from metrics import instrument, record
+from SourceQuery import SourceQuerySession
+
+ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
+PROBE_MIN_INTERVAL = float(os.environ.get('PROBE_MIN_INTERVAL', '0.25'))
+PROBE_MAX_INTERVAL = float(os.environ.get('PROBE_MAX_INTERVAL', '2.0'))
+PROBE_BACKOFF = 1.5
+PROBE_TIMEOUT = 0.5
+MAX_PROBE_TIME = 20*60
+
+# Leave enough time at the end of an invocation to hand over to the next
+HANDOVER_TIME = 10
+
+
+@instrument
+def handler(event, context):
+    """ Wait for a newly started server to answer queries and record when.
+
+    Started as soon as a task is given its hostname. The server is queried
+    on a schedule which starts tight and backs off, so a server which loads
+    quickly is seen within a fraction of a second without a slow one being
+    queried thousands of times. Once it answers, the time it became ready is
+    stored in the fleet state, and how long each stage of the start took is
+    recorded as a metric:
+
+        Boot: from the task being created to its image being pulled
+        EfsMount: from the image being pulled to the container starting,
+                  which is mostly mounting the EFS volume
+        SrcdsLoad: from the container starting to the server answering
+        TimeToReady: the whole start
+
+    If the function is about to time out before the server is ready, it
+    invokes itself to carry on. The event structure looks like this:
+
+    {
+        'task_arn': 'arn:aws:ecs:eu-west-1:150673653788:task/csgo-prac-aws-cluster/253a4a666c09494aa5d3ae69011e08d1',
+        'public_ip': '1.2.3.4',
+        'probe_started_at': 1633428000
+    }
+
+    Args:
+        event (dict): Event getting passed to the function
+        context (dict): The context the function runs in
+
+    Returns:
+        dict: When the server became ready and how long each stage took
+    """
+
+    task_arn = event['task_arn']
+    public_ip = event['public_ip']
+
+    # Only the first invocation has to check another prober isn't running
+    probe_started_at = event.get('probe_started_at')
+    if probe_started_at is None:
+        if not claim_readiness_probe(task_arn):
+            return return_code(200, {'taskArn': task_arn, 'readyAt': None})
+        probe_started_at = int(time.time())
+
+    deadline = probe_started_at + MAX_PROBE_TIME
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000 - HANDOVER_TIME
+        deadline = min(deadline, time.time() + remaining)
+
+    info, probes = wait_until_ready(public_ip, deadline)
+    record('ReadinessProbes', probes, 'Count')
+
+    if info is None:
+        if time.time() - probe_started_at < MAX_PROBE_TIME and context is not None:
+            print(f"{public_ip} is not ready yet, carrying on in a new invocation")
+            invoke_function_async(context.function_name,
+                                  {**event, 'probe_started_at': probe_started_at})
+        else:
+            print(f"{public_ip} was not ready after {MAX_PROBE_TIME} seconds")
+        return return_code(200, {'taskArn': task_arn, 'readyAt': None})
+
+    ready_at = time.time()
+    phases = get_ready_phases(task_arn, ready_at)
+    print(f"{public_ip} is ready after {probes} probes: {phases}")
+    for name, seconds in phases.items():
+        record(name, seconds, 'Seconds')
+
+    update_task_state(task_arn, server_ready=True, ready_at=int(ready_at),
+                      map=info['map'], ready_phases=phases)
+
+    return return_code(200, {'taskArn': task_arn, 'readyAt': int(ready_at),
+                             'probes': probes, 'phases': phases})
+
+
+def wait_until_ready(public_ip, deadline, port=27015):
+    """ Query a server until it answers, backing off between each query.
+
+    Args:
+        public_ip (str): The IP address of the server
+        deadline (float): The time to give up at
+        port (int): The query port of the server
+
+    Returns:
+        tuple: The server's info, or None if it never answered, and the
+            number of queries sent
+    """
+
+    session = SourceQuerySession(public_ip, port, PROBE_TIMEOUT)
+    interval = PROBE_MIN_INTERVAL
+    probes = 0
+    try:
+        while True:
+            started = time.time()
+            probes += 1
+            try:
+                info = session.query(('info',))['info']
+            except OSError:
+                # A port nothing is listening on yet answers with an ICMP
+                # unreachable, which leaves the socket unusable
+                session.close()
+                info = None
+
+            if info is not None:
+                return info, probes
+
+            wait = interval - (time.time() - started)
+            if time.time() + max(wait, 0) >= deadline:
+                return None, probes
+            if wait > 0:
+                time.sleep(wait)
+            interval = min(interval * PROBE_BACKOFF, PROBE_MAX_INTERVAL)
+    finally:
+        session.close()
+
+
+def get_ready_phases(task_arn, ready_at):
+    """ Split the time a server took to start into its stages.
+
+    Args:
+        task_arn (str): The ARN of the task
+        ready_at (float): When the server first answered a query
+
+    Returns:
+        dict: Seconds taken by each stage, leaving out any ECS hasn't
+            recorded the timestamps of
+    """
+
+    tasks = get_task_details(ECS_CLUSTER, [task_arn])
+    if len(tasks) == 0:
+        return {}
+
+    task = tasks[0]
+    created_at = task.get('createdAt')
+    pulled_at = task.get('pullStoppedAt')
+    started_at = task.get('startedAt')
+
+    phases = {}
+    if created_at and pulled_at:
+        phases['Boot'] = pulled_at.timestamp() - created_at.timestamp()
+    if pulled_at and started_at:
+        phases['EfsMount'] = started_at.timestamp() - pulled_at.timestamp()
+    if started_at:
+        phases['SrcdsLoad'] = ready_at - started_at.timestamp()
+    if created_at:
+        phases['TimeToReady'] = ready_at - created_at.timestamp()
+    return {name: round(seconds, 3) for name, seconds in phases.items()}
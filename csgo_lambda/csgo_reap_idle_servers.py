@@ -0,0 +1,121 @@
+import os
+import time
+
+from aws import get_dynamo_resource
+from common import return_code
+from csgo_stop_server import stop_servers
+from inventory import get_inventory
+from metrics import instrument, timed
+from SourceQuery import SourceQueryMulti
+from warm_pool import WARM_POOL_STARTED_BY, WARM_POOL_TABLE, get_claimed_tasks, is_idle_pool_task
+
+ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
+TASK_FAMILY = os.environ.get('TASK_FAMILY')
+IDLE_HISTORY_TABLE = os.environ.get('IDLE_HISTORY_TABLE')
+IDLE_TIMEOUT = int(os.environ.get('IDLE_TIMEOUT_MINUTES', '30')) * 60
+QUERY_TIMEOUT = 2.0
+HISTORY_LENGTH = 12
+HISTORY_TTL = 24*60*60
+
+
+@instrument
+def handler(event, context):
+    """ Stop any server which has had no human players for IDLE_TIMEOUT.
+
+    Runs on a schedule. Every running server is queried for its player count
+    at once, and the count is added to a short history of each task kept in
+    DynamoDB, along with the time the server was first seen empty. Servers
+    which haven't answered yet are still starting up, so they're left alone,
+    as are the idle servers kept in the warm pool.
+
+    Args:
+        event (dict): Event getting passed to the function
+        context (dict): The context the function runs in
+
+    Returns:
+        dict: ARNs of the tasks which were stopped
+    """
+
+    tasks = get_inventory(ECS_CLUSTER, TASK_FAMILY)
+    if len(tasks) == 0:
+        return return_code(200, {'stopped': []})
+
+    pool_arns = [task.task_arn for task in tasks
+                 if task.started_by == WARM_POOL_STARTED_BY]
+    if WARM_POOL_TABLE and pool_arns:
+        claimed = get_claimed_tasks(pool_arns)
+        tasks = [task for task in tasks if not is_idle_pool_task(task, claimed)]
+
+    public_ips = {task.task_arn: task.public_ip for task in tasks}
+    player_counts = get_player_counts(public_ips)
+
+    stopped = []
+    now = int(time.time())
+    table = get_dynamo_resource().Table(IDLE_HISTORY_TABLE)
+    for task_arn, humans in player_counts.items():
+        history = table.get_item(Key={'task_arn': task_arn}).get('Item', {})
+        idle_since = get_idle_since(history, humans, now)
+
+        if idle_since is not None and now - idle_since >= IDLE_TIMEOUT:
+            print(f"{task_arn} has been empty since {idle_since}, stopping it")
+            stopped.append(task_arn)
+            continue
+
+        samples = history.get('samples', []) + [{'at': now, 'humans': humans}]
+        item = {
+            'task_arn': task_arn,
+            'samples': samples[-HISTORY_LENGTH:],
+            'expires_at': now + HISTORY_TTL
+        }
+        if idle_since is not None:
+            item['idle_since'] = idle_since
+        table.put_item(Item=item)
+
+    stopped = stop_servers(stopped, [public_ips[task_arn] for task_arn in stopped])
+    for task_arn in stopped:
+        table.delete_item(Key={'task_arn': task_arn})
+
+    return return_code(200, {'stopped': stopped})
+
+
+def get_player_counts(public_ips):
+    """ Get the number of human players on each server.
+
+    Args:
+        public_ips (dict): Task ARN mapped to the public IP of the task
+
+    Returns:
+        dict: Task ARN mapped to the number of humans, for servers that answered
+    """
+
+    servers = [(ip, 27015) for ip in public_ips.values() if ip]
+    if len(servers) == 0:
+        return {}
+
+    with timed('A2SQueryTime'):
+        results = SourceQueryMulti(servers, QUERY_TIMEOUT).info()
+    counts = {}
+    for task_arn, ip in public_ips.items():
+        info = results.get((ip, 27015))
+        if info is None:
+            print(f"{task_arn} didn't answer, it may still be starting")
+            continue
+        counts[task_arn] = info['numplayers'] - info['numbots']
+    return counts
+
+
+def get_idle_since(history, humans, now):
+    """ Get the time a server was first seen empty in its current idle spell.
+
+    Args:
+        history (dict): The stored history of the task
+        humans (int): The number of humans on the server now
+        now (int): The current time
+
+    Returns:
+        int: The time the server became empty, or None if it has players
+    """
+
+    if humans > 0:
+        return None
+    return int(history.get('idle_since', now))
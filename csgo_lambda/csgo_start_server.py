@@ -1,20 +1,44 @@
 import json
 import os
+import re
 
-from aws import start_ecs_task, send_to_queue
+from aws import (start_ecs_task, send_batch_to_queue, get_client,
+                 get_task_details, get_public_ips, invoke_function_async)
 from common import return_code
+from csgo_stop_server import stop_servers
 from datetime import datetime
+from fleet_state import FLEET_STATE_TABLE, put_task_states, update_task_state
+from metrics import instrument
+from SourceQuery import SourceQueryMulti
+from SourceRcon import SourceRcon, SourceRconError
+from warm_pool import get_idle_tasks, claim_task, release_task
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 TASK_DEFN = os.environ.get('TASK_DEFN')
+TASK_FAMILY = os.environ.get('TASK_FAMILY')
 SUBNETS = os.environ.get('SUBNETS')
 SECURITY_GROUPS = os.environ.get('SECURITY_GROUPS')
 CONTAINER_NAME = os.environ.get('CONTAINER_NAME')
 GET_HOSTNAME_QUEUE = os.environ.get('GET_HOSTNAME_QUEUE')
+WARM_POOL_SIZE = int(os.environ.get('WARM_POOL_SIZE', '0'))
+WARM_POOL_TICKRATE = os.environ.get('WARM_POOL_TICKRATE', '128')
+FILL_WARM_POOL_FUNCTION = os.environ.get('FILL_WARM_POOL_FUNCTION')
+SECRET_NAME = os.environ.get('SECRET_NAME')
+RCON_PASSWORD_KEY = os.environ.get('RCON_PASSWORD_KEY')
+MAX_SERVERS = 100
+QUEUE_RETRIES = 2
+POOL_QUERY_TIMEOUT = 1.0
 
+# Values which are safe to pass to a console command as-is
+SAFE_VALUE = re.compile(r'^[\w.-]+$')
 
+# Read from Secrets Manager on first use and kept for warm invocations
+_rcon_password = None
+
+
+@instrument
 def handler(event, context):
-    """ Start a CSGO server with the specified options.
+    """ Start one or more CSGO servers with the specified options.
 
     The server options that can be modified are as follows:
 
@@ -31,37 +55,127 @@ def handler(event, context):
         {"name": "MAPGROUP", "value", "mg_active"}
     ]
 
+    Many servers can be started at once by sending a list of those options:
+    {
+        "servers": [
+            [{"name": "MAP", "value", "de_dust2"}],
+            [{"name": "MAP", "value", "de_mirage"}]
+        ]
+    }
+
     Args:
         event (dict): Event getting passed to the function via an API
         context (dict): The context the function runs in
 
     Returns:
-        dict: Details of the container being started
+        dict: ARNs of the tasks started, the options of any servers which
+            couldn't be started, and the tasks which couldn't be sent on to
+            get a hostname
     """
 
-    print(json.dumps(event))
     body = json.loads(event['body'])
+    specs = body.get('servers') if isinstance(body, dict) else [body]
+    if not isinstance(specs, list):
+        return return_code(400, {'error': "Expected a list of server options, or 'servers'"})
+    if len(specs) > MAX_SERVERS:
+        return return_code(400, {'error': f"At most {MAX_SERVERS} servers can be started at once"})
+
+    # Hand out already running servers if there are any waiting
+    task_arns = []
+    if WARM_POOL_SIZE > 0:
+        claimed, stopped = start_from_pool(specs)
+        task_arns = [arn for arn in claimed if arn]
+        if task_arns or stopped:
+            invoke_function_async(FILL_WARM_POOL_FUNCTION)
+        specs = [spec for spec, arn in zip(specs, claimed) if arn is None]
+
+    task_details, not_started = start_servers(specs)
+    if FLEET_STATE_TABLE:
+        record_started(task_details, task_arns)
+
+    # Send the tasks to get a hostname assigned
     fmt = "%Y-%m-%d %H:%M:%S"
+    start_time = datetime.now().strftime(fmt)
+    messages = [json.dumps({'task_arn': task['taskArn'], 'start_time': start_time})
+                for task in task_details]
+    failed = send_batch_to_queue(GET_HOSTNAME_QUEUE, messages, retries=QUEUE_RETRIES)
+    task_arns += [task['taskArn'] for task in task_details]
+
+    response = {'taskArns': task_arns}
+    if not_started:
+        response['notStarted'] = not_started
+    if failed:
+        # These still get a hostname from their task state change once running
+        response['notQueued'] = [json.loads(message)['task_arn'] for message in failed]
+    return return_code(200, response)
+
+
+def start_servers(specs):
+    """ Start a new task for each of the server options given.
+
+    Servers asking for the same options share their container overrides, so
+    they're started together with as few `run_task` calls as possible. A
+    call which fails, or tasks ECS can't place, don't stop the other servers
+    from being started.
+
+    Args:
+        specs (list): The server options of each server to start
+
+    Returns:
+        tuple: Details of the tasks started, and the options of each server
+            which couldn't be started
+    """
+
+    groups = {}
+    for spec in specs:
+        key = json.dumps(spec, sort_keys=True)
+        groups.setdefault(key, []).append(spec)
 
     subnets = SUBNETS.split(',')
     security_groups = SECURITY_GROUPS.split(',')
-    task_details = start_ecs_task(
-            ECS_CLUSTER, TASK_DEFN, subnets, security_groups,
-            get_env_overrides(body))
+    tasks = []
+    failed = []
+    for group in groups.values():
+        count = len(group)
+        while count > 0:
+            batch = min(count, 10)
+            try:
+                started, _ = start_ecs_task(
+                        ECS_CLUSTER, TASK_DEFN, subnets, security_groups,
+                        get_env_overrides(group[0]), count=batch)
+            except Exception as ex:
+                print(f"Could not start {batch} servers: {ex}")
+                started = []
+            tasks += started
+            failed += group[:batch - len(started)]
+            count -= batch
+    return tasks, failed
 
-    task_arns = []
-    for task in task_details:
 
-        msg = {
-            'task_arn': task['taskArn'],
-            'start_time': datetime.now().strftime(fmt)
-        }
+def record_started(task_details, claimed_arns):
+    """ Add the servers just handed out to the fleet state table.
+
+    Args:
+        task_details (list): Details of the tasks started
+        claimed_arns (list): ARNs of the tasks claimed from the warm pool
+    """
 
-        # Send task to get a hostname assigned
-        send_to_queue(GET_HOSTNAME_QUEUE, json.dumps(msg))
-        task_arns.append(task['taskArn'])
+    for task_arn in claimed_arns:
+        update_task_state(task_arn, idle_pool=False)
 
-    return return_code(200, {'taskArns': task_arns})
+    put_task_states([{
+        'task_arn': task['taskArn'],
+        'public_ip': None,
+        'hostnames': [],
+        'last_status': task['lastStatus'],
+        'desired_status': task['desiredStatus'],
+        'cpu': task.get('cpu'),
+        'memory': task.get('memory'),
+        'overrides': task.get('overrides'),
+        'server_ready': False,
+        'map': '',
+        'idle_pool': False
+    } for task in task_details])
 
 
 def get_env_overrides(environment_list):
@@ -72,3 +186,147 @@ def get_env_overrides(environment_list):
         }]
     }
 
+
+
+def start_from_pool(specs):
+    """ Claim idle servers from the warm pool and apply the settings to them.
+
+    The settings are applied over RCON, as the container environment can't be
+    changed once the task is running. The tickrate is a launch option of the
+    server, so requests for a different tickrate to the pool aren't served.
+
+    ECS reports a task as running before SRCDS has loaded, so only servers
+    which answer a query are handed out. A server which still refuses the
+    RCON connection is put back in the pool, and only one which rejects the
+    password or a command is stopped.
+
+    Args:
+        specs (list): The server options sent to the function for each server
+
+    Returns:
+        tuple: The ARN of the task claimed for each server, or None where no
+            pool task could be used, and the ARNs of the pool tasks stopped
+    """
+
+    claimed = [None] * len(specs)
+    stopped = []
+    wanted = []
+    for index, environment_list in enumerate(specs):
+        settings = {env['name']: env['value'] for env in environment_list}
+        if settings.get('TICKRATE', WARM_POOL_TICKRATE) != WARM_POOL_TICKRATE:
+            print(f"Warm pool only has {WARM_POOL_TICKRATE} tick servers")
+            continue
+
+        try:
+            wanted.append((index, get_rcon_commands(settings)))
+        except ValueError as ex:
+            print(ex)
+
+    if len(wanted) == 0:
+        return claimed, stopped
+
+    task_arns = get_idle_tasks(ECS_CLUSTER, TASK_FAMILY)
+    if len(task_arns) == 0:
+        print("No idle servers in the warm pool")
+        return claimed, stopped
+
+    tasks = [task for task in get_task_details(ECS_CLUSTER, task_arns)
+             if task['lastStatus'] == 'RUNNING']
+    public_ips = get_public_ips(tasks)
+    answering = get_answering(public_ips.values())
+    candidates = iter([task for task in tasks if public_ips[task['taskArn']] in answering])
+
+    for index, commands in wanted:
+        for task in candidates:
+            task_arn = task['taskArn']
+            public_ip = public_ips[task_arn]
+            if not claim_task(task_arn):
+                continue
+
+            try:
+                apply_settings(public_ip, commands)
+            except OSError as ex:
+                # Most likely still loading, so it's left for a later start
+                print(f"Could not connect to {task_arn}, putting it back in the pool: {ex}")
+                release_task(task_arn)
+                continue
+            except SourceRconError as ex:
+                # The pool task already has a hostname, which goes with it
+                print(f"Could not configure {task_arn}, stopping it: {ex}")
+                stopped += stop_servers([task_arn], [public_ip])
+                continue
+
+            claimed[index] = task_arn
+            break
+
+    return claimed, stopped
+
+
+def get_answering(public_ips):
+    """ Get which servers have loaded far enough to answer a query.
+
+    Args:
+        public_ips (list): The IP addresses of the servers, None values are skipped
+
+    Returns:
+        set: The IP addresses of the servers which answered
+    """
+
+    servers = [(ip, 27015) for ip in public_ips if ip]
+    if len(servers) == 0:
+        return set()
+
+    results = SourceQueryMulti(servers, POOL_QUERY_TIMEOUT).info()
+    return {ip for (ip, _), info in results.items() if info is not None}
+
+
+def get_rcon_commands(settings):
+    """ Convert the server options into console commands.
+
+    Args:
+        settings (dict): The server option names mapped to their values
+
+    Returns:
+        list: The commands to run, with the map change last
+    """
+
+    for name, value in settings.items():
+        if value and not SAFE_VALUE.match(value):
+            raise ValueError(f"Invalid value for {name}: {value}")
+
+    commands = []
+    if settings.get('MAPGROUP'):
+        commands.append(f"mapgroup {settings['MAPGROUP']}")
+    if settings.get('HOST_WORKSHOP_COLLECTION'):
+        commands.append(f"host_workshop_collection {settings['HOST_WORKSHOP_COLLECTION']}")
+    if settings.get('WORKSHOP_START_MAP'):
+        commands.append(f"host_workshop_map {settings['WORKSHOP_START_MAP']}")
+    elif settings.get('MAP'):
+        commands.append(f"changelevel {settings['MAP']}")
+    return commands
+
+
+def apply_settings(public_ip, commands):
+    """ Run the commands on a server over RCON.
+
+    Args:
+        public_ip (str): The IP address of the server
+        commands (list): The console commands to run
+    """
+
+    rcon = SourceRcon(public_ip, 27015, get_rcon_password())
+    try:
+        for command in commands:
+            print(f"Running '{command}' on {public_ip}")
+            rcon.execute(command)
+    finally:
+        rcon.disconnect()
+
+
+def get_rcon_password():
+    global _rcon_password
+    if _rcon_password is None:
+        client = get_client('secretsmanager')
+        secret = client.get_secret_value(SecretId=SECRET_NAME)
+        _rcon_password = json.loads(secret['SecretString'])[RCON_PASSWORD_KEY]
+    return _rcon_password
@@ -1,22 +1,35 @@
-import boto3
 import json
 import os
 
-from aws import stop_ecs_task, get_public_ip, delete_route53_record, retrieve_hostnames
+from aws import (stop_ecs_task, get_task_details, get_public_ips,
+                 get_hostname_index, Route53ChangeSet)
 from common import return_code
+from concurrent.futures import ThreadPoolExecutor
+from fleet_state import FLEET_STATE_TABLE, delete_task_states
+from hostname_slots import release_slots
+from metrics import instrument
+from warm_pool import WARM_POOL_TABLE, release_task
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 HOSTED_ZONE_ID = os.environ.get('HOSTED_ZONE_ID')
+MAX_SERVERS = 100
+MAX_WORKERS = 10
 
 
+@instrument
 def handler(event, context):
-    """ Stop a running CSGO server.
+    """ Stop one or more running CSGO servers.
 
     An example of the message sent is as follows:
     {
         'task_arn': 'arn:aws:ecs:eu-west-1:150673653788:task/csgo-prac-aws-cluster/253a4a666c09494aa5d3ae69011e08d1'
     }
 
+    Many servers can be stopped at once by sending a list of ARNs instead:
+    {
+        'task_arns': ['arn:aws:ecs:...', 'arn:aws:ecs:...']
+    }
+
     Args:
         event (dict): Event getting passed to the function via an API
         context (dict): The context the function runs in
@@ -25,27 +38,87 @@ def handler(event, context):
         dict: Details of the container being started
     """
 
-    print(json.dumps(event))
     body = json.loads(event['body'])
-    task_arn = body['task_arn']
 
-    print("Deleting the A record of the task")
-    delete_hostname(task_arn)
+    if 'task_arns' not in body:
+        task_arn = body['task_arn']
+        if not stop_servers([task_arn]):
+            return return_code(500, {'error': f"Could not stop task {task_arn}"})
+        return return_code(200, {'task_status': f"Stopping task {task_arn}"})
+
+    task_arns = list(dict.fromkeys(body['task_arns']))
+    if len(task_arns) > MAX_SERVERS:
+        return return_code(400, {'error': f"At most {MAX_SERVERS} servers can be stopped at once"})
+
+    stopped = stop_servers(task_arns)
+    failed = [task_arn for task_arn in task_arns if task_arn not in stopped]
+    return return_code(200, {'taskArns': stopped, 'failed': failed})
+
+
+def stop_servers(task_arns, public_ips=None):
+    """ Remove the hostnames of many servers and stop their tasks.
+
+    The tasks are described and their IPs resolved together, every A record
+    is deleted in a single Route53 change batch, and the tasks themselves are
+    stopped in parallel. A task which fails to stop doesn't stop the others,
+    and only the hostname slots of the tasks which did stop are released.
+
+    Args:
+        task_arns (list): The ARNs of the tasks to stop
+        public_ips (list): The IPs of the tasks, if they're already known
+
+    Returns:
+        list: The ARNs of the tasks stopped
+    """
+
+    if len(task_arns) == 0:
+        return []
+
+    print("Deleting the A records of the tasks")
+    delete_hostnames(task_arns, public_ips)
 
-    msg = f"Stopping task {task_arn}"
-    print(msg)
+    print(f"Stopping tasks {task_arns}")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {task_arn: executor.submit(stop_task, task_arn) for task_arn in task_arns}
+
+    stopped = []
+    for task_arn, future in futures.items():
+        try:
+            future.result()
+            stopped.append(task_arn)
+        except Exception as ex:
+            print(f"Could not stop {task_arn}: {ex}")
+
+    if stopped:
+        release_slots(stopped)
+        if FLEET_STATE_TABLE:
+            delete_task_states(stopped)
+    return stopped
+
+
+def stop_task(task_arn):
     stop_ecs_task(ECS_CLUSTER, task_arn)
+    if WARM_POOL_TABLE:
+        try:
+            release_task(task_arn)
+        except Exception as ex:
+            # The task has stopped, so it's still counted as stopped
+            print(f"Could not release the warm pool claim of {task_arn}: {ex}")
 
-    return return_code(200, {'task_status': msg})
 
+def delete_hostnames(task_arns, public_ips=None):
+    if public_ips is None:
+        tasks = get_task_details(ECS_CLUSTER, task_arns)
+        public_ips = get_public_ips(tasks).values()
 
-def delete_hostname(task_arn):
-    public_ip = get_public_ip(ECS_CLUSTER, task_arn)
-    if not public_ip:
+    public_ips = [ip for ip in public_ips if ip]
+    if len(public_ips) == 0:
         return None
 
-    hostnames = retrieve_hostnames(HOSTED_ZONE_ID, public_ip)
-    for hostname in hostnames:
-        print(f"Deleting {hostname} from {HOSTED_ZONE_ID}")
-        delete_route53_record(HOSTED_ZONE_ID, hostname, public_ip)
-
+    index = get_hostname_index(HOSTED_ZONE_ID, max_age=0)
+    changes = Route53ChangeSet(HOSTED_ZONE_ID)
+    for ip in public_ips:
+        for hostname in index.get(ip, []):
+            print(f"Deleting {hostname} from {HOSTED_ZONE_ID}")
+            changes.delete(hostname, ip)
+    return changes.commit()
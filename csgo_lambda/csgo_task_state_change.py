@@ -0,0 +1,52 @@
+from aws import get_public_ips
+from common import return_code
+from csgo_get_hostname import create_hostname
+from metrics import instrument
+
+
+@instrument
+def handler(event, context):
+    """ Creates a Route53 record as soon as a task is running with an IP.
+
+    ECS sends a "Task State Change" event through EventBridge every time a
+    task changes state, and the detail contains the same attachments as a
+    call to describe_tasks. Once the task is RUNNING with its network
+    interface attached a hostname is created straight away, rather than
+    waiting for the get-hostname queue to come round again, which is kept
+    only as a fallback. A task which is being stopped is still RUNNING until
+    it has shut down, so those are skipped by their desiredStatus. The event
+    structure looks like this:
+
+    {
+        'detail-type': 'ECS Task State Change',
+        'source': 'aws.ecs',
+        'detail': {
+            'taskArn': 'arn:aws:ecs:eu-west-1:150673653788:task/csgo-prac-aws-cluster/253a4a666c09494aa5d3ae69011e08d1',
+            'lastStatus': 'RUNNING',
+            'desiredStatus': 'RUNNING',
+            'attachments': [...]
+        }
+    }
+
+    Args:
+        event (dict): Event getting passed to the function via EventBridge
+        context (dict): The context the function runs in
+
+    Returns:
+        dict: The hostname assigned to the task
+    """
+
+    task = event['detail']
+    task_arn = task['taskArn']
+
+    if task['lastStatus'] != 'RUNNING' or task.get('desiredStatus') == 'STOPPED':
+        print(f"Task {task_arn} is {task['lastStatus']} and should be "
+              f"{task.get('desiredStatus')}, nothing to do")
+        return return_code(200, {'hostnames': []})
+
+    public_ip = get_public_ips([task]).get(task_arn)
+    hostname = create_hostname(task_arn, public_ip)
+    if not hostname:
+        return return_code(200, {'hostnames': []})
+
+    return return_code(200, {'hostnames': [hostname]})
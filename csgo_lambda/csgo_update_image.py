@@ -1,8 +1,8 @@
-import json
 import os
 
 from aws import start_ecs_task
 from common import return_code
+from metrics import instrument
 
 ECS_CLUSTER = os.environ.get('ECS_CLUSTER')
 TASK_DEFN = os.environ.get('TASK_DEFN')
@@ -11,8 +11,8 @@ SECURITY_GROUPS = os.environ.get('SECURITY_GROUPS')
 CONTAINER_NAME = os.environ.get('CONTAINER_NAME')
 
 
+@instrument
 def handler(event, context):
-    print(json.dumps(event))
     subnets = SUBNETS.split(',')
     security_groups = SECURITY_GROUPS.split(',')
     start_ecs_task(ECS_CLUSTER, TASK_DEFN, subnets, security_groups, get_env_overrides())
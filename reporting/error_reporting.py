@@ -1,19 +1,18 @@
-import boto3
 import http.client
 import json
 import os
 import urllib
 
-from urllib.request import urlopen, Request
+from metrics import debug, instrument
 
 PUSHOVER_TOKEN = os.environ.get("PUSHOVER_TOKEN")
 PUSHOVER_USER = os.environ.get("PUSHOVER_USER")
 
 
+@instrument
 def handler(event, context):
-    print(json.dumps(event))
     for record in event['Records']:
-        print(json.dumps(record))
+        debug(record)
         parse_and_send(record)
 
 
@@ -1,14 +1,105 @@
-import boto3
 import json
 import os
+import threading
+import time
+
+from metrics import debug, install_aws_hooks
+
+# Endpoints used in place of AWS when running under `sam local`. ECS, EC2 and
+# Route53 aren't available in the free version of localstack.
+LOCAL_ENDPOINTS = {
+    'sqs': 'http://localhost:4566',
+    'dynamodb': 'http://dynamodb:8000',
+}
+
+# Clients and resources are kept at module level so warm invocations reuse
+# the credential chain, endpoint resolver and keep-alive connection pools.
+# boto3 is only imported when the first client is made, as importing it is
+# most of the cold start of a handler that may not need AWS at all.
+CLIENT_CONFIG = {'tcp_keepalive': True, 'max_pool_connections': 25}
+_session = None
+_config = None
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+# IP to hostname index of each hosted zone, optionally kept across warm
+# invocations for HOSTNAME_CACHE_TTL seconds
+HOSTNAME_CACHE_TTL = int(os.getenv("HOSTNAME_CACHE_TTL", "0"))
+_hostname_indexes = {}
+
+
+def _get_session():
+    global _session, _config
+    if _session is None:
+        import boto3
+        from botocore.config import Config
+        session = boto3.session.Session()
+        install_aws_hooks(session)
+        _config = Config(**CLIENT_CONFIG)
+        _session = session
+    return _session
+
+
+def _client_key(service, region):
+    endpoint = LOCAL_ENDPOINTS.get(service) if os.getenv("AWS_SAM_LOCAL") else None
+    region = region or os.getenv("AWS_REGION")
+    return (service, region, endpoint)
+
+
+def get_client(service, region=None):
+    """ Get a shared boto3 client for a service, creating it on first use.
+
+    Args:
+        service (str): The AWS service name, eg. 'ecs'
+        region (str): Region of the service, defaults to the function region
+
+    Returns:
+        botocore.client.BaseClient: The client for the service
+    """
+
+    key = _client_key(service, region)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                service, region, endpoint = key
+                client = _get_session().client(
+                        service, region_name=region, endpoint_url=endpoint,
+                        config=_config)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service, region=None):
+    """ Get a shared boto3 resource for a service, creating it on first use.
+
+    Args:
+        service (str): The AWS service name, eg. 'dynamodb'
+        region (str): Region of the service, defaults to the function region
+
+    Returns:
+        boto3.resources.base.ServiceResource: The resource for the service
+    """
+
+    key = _client_key(service, region)
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                service, region, endpoint = key
+                resource = _get_session().resource(
+                        service, region_name=region, endpoint_url=endpoint,
+                        config=_config)
+                _resources[key] = resource
+    return resource
 
 
 def send_to_queue_name(queue_name, message):
     # Create SQS client
-    if os.getenv("AWS_SAM_LOCAL"):
-        sqs = boto3.resource('sqs', endpoint_url='http://localhost:4566')
-    else:
-        sqs = boto3.resource('sqs')
+    sqs = get_resource('sqs')
     # Get queue
     queue = sqs.get_queue_by_name(QueueName=queue_name)
     # Send message
@@ -18,22 +109,58 @@ def send_to_queue_name(queue_name, message):
     print(f"Message sent: {response['MessageId']}")
 
 
-def send_to_queue(queue_url, message):
+def send_to_queue(queue_url, message, delay_seconds=None):
+    print(f"Sending a message to SQS {queue_url}")
+    debug(message)
     # Create SQS client
-    print(f"Sending the following message to SQS {queue_url}:")
-    print(message)
-    if os.getenv("AWS_SAM_LOCAL"):
-        sqs = boto3.client('sqs', endpoint_url='http://localhost:4566')
-    else:
-        sqs = boto3.client('sqs')
+    sqs = get_client('sqs')
+    # Without a delay the queue's own DelaySeconds is used
+    kwargs = {'DelaySeconds': delay_seconds} if delay_seconds is not None else {}
     response = sqs.send_message(
         QueueUrl=queue_url,
-        MessageBody=(message)
+        MessageBody=(message),
+        **kwargs
     )
     print(f"Message sent: {response['MessageId']}")
 
 
-def start_ecs_task(cluster, task_definition, subnets, security_groups, overrides={}):
+def send_batch_to_queue(queue_url, messages, delay_seconds=None, retries=0):
+    """ Send many messages to a queue, up to 10 per call.
+
+    Args:
+        queue_url (str): URL of the queue to send the messages to
+        messages (list): The message bodies to send
+        delay_seconds (int): Optional delay applied to every message
+        retries (int): How many more times to send the messages SQS fails
+                       to accept
+
+    Returns:
+        list: The message bodies which SQS failed to accept
+    """
+
+    print(f"Sending {len(messages)} messages to SQS {queue_url}")
+    sqs = get_client('sqs')
+    kwargs = {'DelaySeconds': delay_seconds} if delay_seconds is not None else {}
+    for attempt in range(retries + 1):
+        failed = []
+        for i in range(0, len(messages), 10):
+            batch = messages[i:i+10]
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{'Id': str(n), 'MessageBody': message, **kwargs}
+                         for n, message in enumerate(batch)]
+            )
+            for failure in response.get('Failed', []):
+                print(f"Message failed to send: {failure}")
+                failed.append(batch[int(failure['Id'])])
+        if len(failed) == 0:
+            break
+        messages = failed
+    return failed
+
+
+def start_ecs_task(cluster, task_definition, subnets, security_groups, overrides={},
+                   count=1, started_by=None):
     """Starts a new ECS task within a Fargate cluster to build the packages
 
     The ECS task pulls each package built one by one from the queue and adds
@@ -45,17 +172,23 @@ def start_ecs_task(cluster, task_definition, subnets, security_groups, overrides
         subnets (list): List of subnet id's to connect the task to
         security_groups (list): List of security groups to apply to the task
         overrides (dict): Any ECS variable overrides to push to the container
+        count (int): The number of tasks to start, up to 10
+        started_by (str): Optional tag used to find the tasks again later
+
+    Returns:
+        tuple: Details of the tasks started, and the failures ECS returned
+            for any it couldn't start, such as for a lack of capacity
     """
 
-    print(f"Starting new ECS task")
+    print(f"Starting {count} new ECS task(s)")
 
-    # Note: There's no ECS in the free version of localstack
-    client = boto3.client('ecs')
+    kwargs = {'startedBy': started_by} if started_by else {}
+    client = get_client('ecs')
     response = client.run_task(
         cluster=cluster,
         launchType='FARGATE',
         taskDefinition=task_definition,
-        count=1,
+        count=count,
         platformVersion='LATEST',
         networkConfiguration={
             'awsvpcConfiguration': {
@@ -64,10 +197,14 @@ def start_ecs_task(cluster, task_definition, subnets, security_groups, overrides
                 'assignPublicIp': 'ENABLED'
             }
         },
-        overrides=overrides
+        overrides=overrides,
+        **kwargs
     )
-    print(f"Run task complete: {str(response)}")
-    return response['tasks']
+    failures = response.get('failures', [])
+    for failure in failures:
+        print(f"Run task failure: {failure}")
+    debug(response)
+    return response['tasks'], failures
 
 
 def stop_ecs_task(cluster, task_arn):
@@ -81,7 +218,7 @@ def stop_ecs_task(cluster, task_arn):
         dict: Details of the task being stopped
     """
 
-    client = boto3.client('ecs')
+    client = get_client('ecs')
     resp = client.stop_task(
         cluster=cluster,
         task=task_arn
@@ -99,16 +236,15 @@ def get_running_tasks(cluster, task_definition):
         task_definition (str): The family of task to search for
 
     Returns:
-        dict: A JSON of task ARNs in a running/soon to be running state
+        list: ARNs of the tasks in a running/soon to be running state
     """
 
-    client = boto3.client('ecs')
-    response = client.list_tasks(
-        cluster=cluster,
-        family=task_definition,
-        desiredStatus="RUNNING"
-    )
-    return response['taskArns']
+    paginator = get_client('ecs').get_paginator('list_tasks')
+    task_arns = []
+    for page in paginator.paginate(cluster=cluster, family=task_definition,
+                                   desiredStatus="RUNNING"):
+        task_arns += page['taskArns']
+    return task_arns
 
 
 def get_running_task_count(cluster, task_family):
@@ -124,33 +260,35 @@ def get_running_task_count(cluster, task_family):
         (int): The number of tasks in a running/soon to be running state
     """
 
-    client = boto3.client('ecs')
-    response = client.list_tasks(
-        cluster=cluster,
-        family=task_family,
-        desiredStatus="RUNNING"
-    )
-    return len(response['taskArns'])
+    return len(get_running_tasks(cluster, task_family))
 
 
 def get_task_details(cluster, task_arns):
     """ Get details of the tasks specified
 
+    ECS describes at most 100 tasks per call, so larger lists are split into
+    chunks of 100 which are described in parallel.
+
     Args:
         cluster (str): Name of the cluster to check
         task_arns (list): List of task arns to check
 
     Returns:
-        dict: Details of the tasks specified
+        list: Details of the tasks specified
     """
 
-    client = boto3.client('ecs')
-    response = client.describe_tasks(
-        cluster=cluster,
-        tasks=task_arns
-    )
+    client = get_client('ecs')
+    chunks = [task_arns[i:i+100] for i in range(0, len(task_arns), 100)]
+
+    def describe(chunk):
+        return client.describe_tasks(cluster=cluster, tasks=chunk)['tasks']
+
+    if len(chunks) <= 1:
+        return describe(chunks[0]) if chunks else []
 
-    return response['tasks']
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 10)) as executor:
+        return [task for tasks in executor.map(describe, chunks) for task in tasks]
 
 
 def get_public_ip(cluster, task_arn):
@@ -174,30 +312,103 @@ def get_public_ip(cluster, task_arn):
         print("No tasks found")
         return None
 
-    task = tasks[0]
-    print(task)
+    return get_public_ips(tasks).get(task_arn)
+
+
+def get_network_interface_id(task):
+    """ Get the ID of the network interface attached to a task.
+
+    Args:
+        task (dict): Details of the task as returned by `get_task_details`,
+                     or the detail of an ECS task state change event
+
+    Returns:
+        str: The ENI ID, or None if the interface isn't attached yet
+    """
 
-    # Get a list of the attached ENI's, there should only be one per task
-    enis = [a for a in task['attachments']
-            if 'type' in a and a['type'] == 'ElasticNetworkInterface']
-    assert len(enis) == 1
+    # Get a list of the attached ENI's, there should only be one per task.
+    # Task state change events call the attachment 'eni' rather than
+    # 'ElasticNetworkInterface' as describe_tasks does.
+    enis = [a for a in task.get('attachments', [])
+            if a.get('type') in ('ElasticNetworkInterface', 'eni')]
+    assert len(enis) <= 1
+    if len(enis) == 0:
+        return None
 
     # Get the network ID for the ENI, again there should only be one
     network_ids = [n['value'] for n in enis[0]['details']
                    if n['name'] == 'networkInterfaceId']
-    print(network_ids)
     assert len(network_ids) <= 1
 
     # Return nothing if the server isn't ready
     if len(network_ids) == 0:
         return None
 
-    # Get the details of the ENI and return the IP address
-    resource = boto3.resource('ec2').NetworkInterface(network_ids[0])
-    if not resource.association_attribute:
-        return None
+    return network_ids[0]
+
+
+def get_public_ips(tasks):
+    """ Get the public IP addresses of many tasks with a single EC2 lookup.
+
+    The ENI ID's are pulled out of the task details and all of them are
+    resolved together, rather than loading each interface one at a time.
+
+    Args:
+        tasks (list): Details of the tasks as returned by `get_task_details`
+
+    Returns:
+        dict: Task ARN mapped to its public IP, or None if it has none yet
+    """
+
+    eni_ids = {task['taskArn']: get_network_interface_id(task) for task in tasks}
+    public_ips = get_interface_public_ips(eni_ids.values())
+    return {arn: public_ips.get(eni) for arn, eni in eni_ids.items()}
 
-    return resource.association_attribute['PublicIp']
+
+def get_interface_public_ips(eni_ids):
+    """ Get the public IP addresses of many network interfaces.
+
+    Args:
+        eni_ids (list): The ENI ID's to look up, any None values are skipped
+
+    Returns:
+        dict: ENI ID mapped to its public IP, for interfaces which have one
+    """
+
+    wanted = sorted(set(eni for eni in eni_ids if eni))
+
+    # Filtering rather than passing NetworkInterfaceIds means an interface
+    # that has since been deleted doesn't fail the whole lookup
+    public_ips = {}
+    paginator = get_client('ec2').get_paginator('describe_network_interfaces')
+    for i in range(0, len(wanted), 200):
+        pages = paginator.paginate(Filters=[{
+            'Name': 'network-interface-id',
+            'Values': wanted[i:i+200]
+        }])
+        for page in pages:
+            for eni in page['NetworkInterfaces']:
+                association = eni.get('Association')
+                if association and 'PublicIp' in association:
+                    public_ips[eni['NetworkInterfaceId']] = association['PublicIp']
+
+    return public_ips
+
+
+def invoke_function_async(function_name, payload=None):
+    """ Invoke a Lambda function without waiting for it to finish.
+
+    Args:
+        function_name (str): Name or ARN of the function to invoke
+        payload (dict): The event to pass to the function
+    """
+
+    print(f"Invoking {function_name}")
+    get_client('lambda').invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps(payload or {})
+    )
 
 
 def get_dynamo_resource():
@@ -206,16 +417,133 @@ def get_dynamo_resource():
     running in
     """
 
-    if os.getenv("AWS_SAM_LOCAL"):
-        dynamo = boto3.resource('dynamodb', endpoint_url="http://dynamodb:8000")
-    else:
-        dynamo = boto3.resource('dynamodb')
-    return dynamo
+    return get_resource('dynamodb')
+
+
+class Route53ChangeSet:
+    """ Collects record changes to a hosted zone and sends them together.
+
+    Changes are kept per record name and type, so each record is changed at
+    most once however many times it's added. A CREATE followed by a DELETE of
+    the same record cancels out, a DELETE followed by a CREATE becomes an
+    UPSERT, and otherwise the last change wins. Everything is then sent in as
+    few `change_resource_record_sets` calls as Route53 allows.
+
+    Args:
+        hosted_zone_id (str): Route53 hosted zone ID the records are in
+        ttl (int): TTL of the records created
+    """
+
+    # Route53 allows 1000 changes per batch, with an UPSERT counting as two
+    MAX_CHANGES = 1000
+
+    def __init__(self, hosted_zone_id, ttl=60):
+        self.hosted_zone_id = hosted_zone_id
+        self.ttl = ttl
+        self.changes = {}
+
+    def __len__(self):
+        return len(self.changes)
+
+    def create(self, hostname, ip_address, record_type='A'):
+        self._add('CREATE', hostname, ip_address, record_type)
+
+    def delete(self, hostname, ip_address, record_type='A'):
+        self._add('DELETE', hostname, ip_address, record_type)
+
+    def upsert(self, hostname, ip_address, record_type='A'):
+        self._add('UPSERT', hostname, ip_address, record_type)
+
+    def update(self, other):
+        """ Add every change collected by another change set to this one.
+
+        Args:
+            other (Route53ChangeSet): The change set to take the changes from
+        """
+
+        for (name, record_type), (action, ip_address) in other.changes.items():
+            self._add(action, name, ip_address, record_type)
+
+    def _add(self, action, hostname, ip_address, record_type):
+        name = hostname.lower().rstrip('.') + '.'
+        key = (name, record_type)
+        previous = self.changes.get(key)
+        if previous is not None:
+            if previous[0] == 'CREATE' and action == 'DELETE':
+                del self.changes[key]
+                return
+            if previous[0] == 'DELETE' and action == 'CREATE':
+                action = 'UPSERT'
+        self.changes[key] = (action, ip_address)
+
+    def batches(self):
+        """ Split the changes into batches Route53 will accept.
+
+        Returns:
+            list: Each batch as a list of changes for the API call
+        """
+
+        batches = [[]]
+        size = 0
+        for (name, record_type), (action, ip_address) in self.changes.items():
+            weight = 2 if action == 'UPSERT' else 1
+            if size + weight > self.MAX_CHANGES:
+                batches.append([])
+                size = 0
+            batches[-1].append({
+                'Action': action,
+                'ResourceRecordSet': {
+                    'Name': name,
+                    'ResourceRecords': [{'Value': ip_address}],
+                    'TTL': self.ttl,
+                    'Type': record_type,
+                },
+            })
+            size += weight
+        return [batch for batch in batches if batch]
+
+    def commit(self, wait=False, comment='Update CSGO server records'):
+        """ Send every change collected so far, then clear them.
+
+        Args:
+            wait (bool): Whether to wait until the changes are INSYNC
+            comment (str): Comment attached to each change batch
+
+        Returns:
+            list: The change ID of each batch sent
+        """
+
+        batches = self.batches()
+        if len(batches) == 0:
+            return []
+
+        client = get_client('route53')
+        change_ids = []
+        try:
+            for batch in batches:
+                print(f"Sending {len(batch)} record changes to {self.hosted_zone_id}")
+                response = client.change_resource_record_sets(
+                    HostedZoneId=self.hosted_zone_id,
+                    ChangeBatch={'Changes': batch, 'Comment': comment}
+                )
+                change_ids.append(response['ChangeInfo']['Id'])
+        finally:
+            invalidate_hostname_index(self.hosted_zone_id)
+
+        self.changes = {}
+        if wait:
+            waiter = client.get_waiter('resource_record_sets_changed')
+            for change_id in change_ids:
+                waiter.wait(Id=change_id, WaiterConfig={'Delay': 2, 'MaxAttempts': 60})
+        return change_ids
 
 
 def create_route53_record(hosted_zone_id, hostname, ip_address):
-    """ Creates an A record within Route53 within the specified hosted zone,
-    pointing `hostname` to `ip_address`.
+    """ Points `hostname` to `ip_address` with an A record in the specified
+    hosted zone.
+
+    The record is upserted, so a stale record left behind with the same name
+    doesn't fail the change.
 
     Args:
         hosted_zone_id (str): Route53 hosted zone ID to create the record in
@@ -223,31 +551,12 @@ def create_route53_record(hosted_zone_id, hostname, ip_address):
         ip_address (str): IP Address to point the record to
 
     Returns:
-        dict: Response of the API call
+        list: The change ID of the update
     """
 
-    client = boto3.client('route53')
-    response = client.change_resource_record_sets(
-    ChangeBatch={
-        'Changes': [
-            {
-                'Action': 'CREATE',
-                'ResourceRecordSet': {
-                    'Name': hostname,
-                    'ResourceRecords': [
-                        {
-                            'Value': ip_address,
-                        },
-                    ],
-                    'TTL': 60,
-                    'Type': 'A',
-                },
-            },
-        ],
-        'Comment': 'Create CSGO server record',
-    },
-    HostedZoneId=hosted_zone_id,
-)
+    changes = Route53ChangeSet(hosted_zone_id)
+    changes.upsert(hostname, ip_address)
+    return changes.commit()
 
 
 def delete_route53_record(hosted_zone_id, hostname, ip_address):
@@ -259,31 +568,13 @@ def delete_route53_record(hosted_zone_id, hostname, ip_address):
         ip_address (str): IP Address to point the record to
 
     Returns:
-        dict: Response of the API call
+        list: The change ID of the update
     """
 
-    client = boto3.client('route53')
-    response = client.change_resource_record_sets(
-    ChangeBatch={
-        'Changes': [
-            {
-                'Action': 'DELETE',
-                'ResourceRecordSet': {
-                    'Name': hostname,
-                    'ResourceRecords': [
-                        {
-                            'Value': ip_address,
-                        },
-                    ],
-                    'TTL': 60,
-                    'Type': 'A',
-                },
-            },
-        ],
-        'Comment': 'Create CSGO server record',
-    },
-    HostedZoneId=hosted_zone_id,
-)
+    changes = Route53ChangeSet(hosted_zone_id)
+    changes.delete(hostname, ip_address)
+    return changes.commit()
+
 
 def retrieve_hostnames(hosted_zone_id, ip_address):
     """ Retrieve a list of hostnames that are mapped to a specific IP address
@@ -299,9 +590,48 @@ def retrieve_hostnames(hosted_zone_id, ip_address):
         List: A list of name values within Route53
     """
 
-    client = boto3.client('route53')
-    response = client.list_resource_record_sets(HostedZoneId=hosted_zone_id)
-    hostnames = [ rec['Name'] for rec in response['ResourceRecordSets']
-                  if 'ResourceRecords' in rec
-                  and {'Value': ip_address} in rec['ResourceRecords']]
-    return hostnames
+    return list(get_hostname_index(hosted_zone_id).get(ip_address, []))
+
+
+def get_hostname_index(hosted_zone_id, max_age=None):
+    """ Get every hostname in a hosted zone, indexed by the IP it points to.
+
+    All pages of the zone are read, so the lookup doesn't miss anything once
+    the zone grows past a single page of records. The index is cached for
+    `max_age` seconds, which defaults to the HOSTNAME_CACHE_TTL environment
+    variable, and is dropped whenever a record is created or deleted.
+
+    Args:
+        hosted_zone_id (str): Route53 hosted zone ID to read the records from
+        max_age (int): How old in seconds a cached index can be
+
+    Returns:
+        dict: IP address mapped to a list of hostnames
+    """
+
+    if max_age is None:
+        max_age = HOSTNAME_CACHE_TTL
+
+    cached = _hostname_indexes.get(hosted_zone_id)
+    if cached is not None and time.time() - cached[0] < max_age:
+        return cached[1]
+
+    index = {}
+    paginator = get_client('route53').get_paginator('list_resource_record_sets')
+    for page in paginator.paginate(HostedZoneId=hosted_zone_id):
+        for rec in page['ResourceRecordSets']:
+            for value in rec.get('ResourceRecords', []):
+                index.setdefault(value['Value'], []).append(rec['Name'])
+
+    _hostname_indexes[hosted_zone_id] = (time.time(), index)
+    return index
+
+
+def invalidate_hostname_index(hosted_zone_id):
+    """ Drop the cached hostname index of a hosted zone.
+
+    Args:
+        hosted_zone_id (str): Route53 hosted zone ID of the index
+    """
+
+    _hostname_indexes.pop(hosted_zone_id, None)
@@ -1,12 +1,13 @@
 import json
 
 
-def return_code(code, body):
+def return_code(code, body, headers=None):
     """Returns a JSON response
 
     Args:
         code (int): HTTP response code
         body (dict): Data to return
+        headers (dict): Any extra headers to add to the response
 
     Returns:
         (dict): JSON object containing the code and body
@@ -14,10 +15,60 @@ def return_code(code, body):
 
     return {
         "statusCode": code,
-        "headers": {
-            "Access-Control-Allow-Headers" : "Content-Type",
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "OPTIONS,POST,GET"
-        },
+        "headers": get_headers(headers),
         "body": json.dumps(body)
     }
+
+
+def not_modified(etag):
+    """Returns an empty 304 response for a conditional GET
+
+    Args:
+        etag (str): The ETag of the content the client already has
+
+    Returns:
+        (dict): JSON object containing the code and headers
+    """
+
+    return {
+        "statusCode": 304,
+        "headers": get_headers({"ETag": etag}),
+        "body": ""
+    }
+
+
+def get_headers(headers=None):
+    """Returns the CORS headers sent with every response
+
+    Args:
+        headers (dict): Any extra headers to add
+
+    Returns:
+        (dict): The response headers
+    """
+
+    return {
+        "Access-Control-Allow-Headers" : "Content-Type,If-None-Match",
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "OPTIONS,POST,GET",
+        "Access-Control-Expose-Headers": "ETag",
+        **(headers or {})
+    }
+
+
+def get_header(event, name):
+    """Get a request header from an API Gateway event, ignoring case
+
+    Args:
+        event (dict): Event getting passed to the function via an API
+        name (str): Name of the header
+
+    Returns:
+        (str): Value of the header, or None if it wasn't sent
+    """
+
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
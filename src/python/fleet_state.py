@@ -0,0 +1,273 @@
+import os
+import time
+
+from decimal import Decimal
+
+from aws import get_dynamo_resource
+
+# Every server of a stack is kept under the same partition key, so the whole
+# fleet can be read back with a single query. The prober writes a marker item
+# each time it has checked every server, which is how fresh the table is, and
+# every write bumps a version counter so watchers can tell when it changed.
+FLEET_STATE_TABLE = os.environ.get('FLEET_STATE_TABLE')
+FLEET = os.environ.get('TASK_FAMILY', 'fleet')
+SWEEP_MARKER = '#sweep'
+VERSION_MARKER = '#version'
+STATE_TTL = 2*24*60*60
+
+
+def get_fleet_state():
+    """ Get the stored state of every server in the fleet.
+
+    Returns:
+        dict: The time the prober last checked every server, or None if it
+            never has, the version of the state and the state of each server
+    """
+
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    kwargs = {
+        'KeyConditionExpression': 'fleet = :fleet',
+        'ExpressionAttributeValues': {':fleet': FLEET}
+    }
+    swept_at = None
+    version = 0
+    tasks = []
+    while True:
+        response = table.query(**kwargs)
+        for item in response['Items']:
+            item = from_dynamo(item)
+            if item['task_arn'] == SWEEP_MARKER:
+                swept_at = item['swept_at']
+            elif item['task_arn'] == VERSION_MARKER:
+                version = item['version']
+            else:
+                tasks.append(item)
+        if 'LastEvaluatedKey' not in response:
+            return {'swept_at': swept_at, 'version': version, 'tasks': tasks}
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_fleet_version():
+    """ Get a number which changes every time the stored state is written.
+
+    This is a single small read, so it can be checked far more often than
+    the whole fleet can be rebuilt.
+
+    Returns:
+        int: The version of the fleet state, 0 if it has never been written
+    """
+
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    response = table.get_item(Key={'fleet': FLEET, 'task_arn': VERSION_MARKER},
+                              ConsistentRead=True)
+    return int(response.get('Item', {}).get('version', 0))
+
+
+def bump_version(table=None):
+    """ Mark the stored state as changed.
+
+    Args:
+        table (dynamodb.Table): The fleet state table, if it's already open
+    """
+
+    table = table or get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    table.update_item(
+        Key={'fleet': FLEET, 'task_arn': VERSION_MARKER},
+        UpdateExpression='ADD version :one',
+        ExpressionAttributeValues={':one': 1}
+    )
+
+
+def update_task_state(task_arn, **fields):
+    """ Set some of the fields of a server, leaving the others as they are.
+
+    Args:
+        task_arn (str): ARN of the task
+        fields: The fields to set, such as public_ip or hostnames
+    """
+
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    set_fields(table, task_arn, fields)
+    bump_version(table)
+
+
+def set_fields(table, task_arn, fields, if_missing=(), must_exist=False):
+    """ Write some of the fields of a server in a single update.
+
+    Args:
+        table (dynamodb.Table): The fleet state table
+        task_arn (str): ARN of the task
+        fields (dict): The fields to set
+        if_missing (tuple): Fields which are only set if the server doesn't
+                            have them yet
+        must_exist (bool): Whether to skip the write if the server isn't stored
+
+    Returns:
+        bool: False if the write was skipped as the server wasn't stored
+    """
+
+    now = int(time.time())
+    fields = {**fields, 'updated_at': now, 'expires_at': now + STATE_TTL}
+    names = {f"#f{i}": name for i, name in enumerate(fields)}
+    values = {f":f{i}": to_dynamo(value) for i, value in enumerate(fields.values())}
+    assignments = [f"{name} = if_not_exists({name}, {value})"
+                   if names[name] in if_missing else f"{name} = {value}"
+                   for name, value in zip(names, values)]
+
+    kwargs = {'ConditionExpression': 'attribute_exists(task_arn)'} if must_exist else {}
+    try:
+        table.update_item(
+            Key={'fleet': FLEET, 'task_arn': task_arn},
+            UpdateExpression='SET ' + ', '.join(assignments),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            **kwargs
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def claim_readiness_probe(task_arn):
+    """ Atomically mark a server as having its readiness probed.
+
+    A server can be given its hostname by both the queue and the task state
+    change, and messages can be delivered twice, so this makes sure only the
+    first prober started for a server keeps going.
+
+    Args:
+        task_arn (str): ARN of the task
+
+    Returns:
+        bool: True if the probe was claimed, False if one was already running
+    """
+
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    try:
+        table.update_item(
+            Key={'fleet': FLEET, 'task_arn': task_arn},
+            UpdateExpression='SET probe_started_at = :now',
+            ConditionExpression='attribute_not_exists(probe_started_at)',
+            ExpressionAttributeValues={':now': int(time.time())}
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Readiness of {task_arn} is already being probed")
+        return False
+    return True
+
+
+def put_task_states(states):
+    """ Replace the whole state of many servers at once.
+
+    Args:
+        states (list): The fields of each server, each including its task_arn
+    """
+
+    if len(states) == 0:
+        return
+
+    now = int(time.time())
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    with table.batch_writer() as batch:
+        for state in states:
+            batch.put_item(Item=to_dynamo({
+                **state,
+                'fleet': FLEET,
+                'updated_at': now,
+                'expires_at': now + STATE_TTL
+            }))
+    bump_version(table)
+
+
+def sweep_task_states(states, known_arns, if_missing=()):
+    """ Write what a sweep saw of many servers, without replacing them.
+
+    Only the fields given are set, so anything the other functions wrote
+    while the sweep ran, such as the readiness of a server, is kept. The
+    servers which were stored when the sweep started must still be there,
+    so one which was stopped and removed in the meantime isn't written back.
+    The version isn't bumped, as `record_sweep` does that once at the end.
+
+    Args:
+        states (list): The fields of each server, each including its task_arn
+        known_arns (set): ARNs of the servers stored when the sweep started
+        if_missing (tuple): Fields which are only set if the server doesn't
+                            have them yet
+
+    Returns:
+        list: ARNs of the servers which had been removed during the sweep
+    """
+
+    if len(states) == 0:
+        return []
+
+    def write(state):
+        fields = {name: value for name, value in state.items() if name != 'task_arn'}
+        table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+        return set_fields(table, state['task_arn'], fields, if_missing,
+                          must_exist=state['task_arn'] in known_arns)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(states), 10)) as executor:
+        written = list(executor.map(write, states))
+    return [state['task_arn'] for state, ok in zip(states, written) if not ok]
+
+
+def delete_task_states(task_arns, bump=True):
+    """ Remove servers from the fleet once they've been stopped.
+
+    Args:
+        task_arns (list): ARNs of the tasks to remove
+        bump (bool): Whether to bump the version, which a sweep leaves to
+                     `record_sweep`
+    """
+
+    if len(task_arns) == 0:
+        return
+
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    with table.batch_writer() as batch:
+        for task_arn in task_arns:
+            batch.delete_item(Key={'fleet': FLEET, 'task_arn': task_arn})
+    if bump:
+        bump_version(table)
+
+
+def record_sweep(swept_at=None):
+    """ Mark the stored state as up to date with every server in the fleet.
+
+    Args:
+        swept_at (int): When the servers were checked, defaults to now
+    """
+
+    table = get_dynamo_resource().Table(FLEET_STATE_TABLE)
+    table.put_item(Item={
+        'fleet': FLEET,
+        'task_arn': SWEEP_MARKER,
+        'swept_at': swept_at or int(time.time())
+    })
+    bump_version(table)
+
+
+def to_dynamo(value):
+    """ Convert floats to Decimals, as DynamoDB won't take floats. """
+
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: to_dynamo(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_dynamo(item) for item in value]
+    return value
+
+
+def from_dynamo(value):
+    """ Convert the Decimals DynamoDB returns back to ints and floats. """
+
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: from_dynamo(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_dynamo(item) for item in value]
+    return value
@@ -0,0 +1,234 @@
+import os
+import time
+
+from aws import get_dynamo_resource
+
+# Each server gets the hostname csgo{slot}, and a slot is owned by a task by
+# writing the task ARN against the slot number. The slot is also written
+# against the task ARN in the same transaction, so a task can never own two.
+HOSTNAME_SLOT_TABLE = os.environ.get('HOSTNAME_SLOT_TABLE')
+HOSTNAME_OWNER_TABLE = os.environ.get('HOSTNAME_OWNER_TABLE')
+MAX_SLOTS = 1000
+
+
+def get_slots():
+    """ Get every hostname slot that is currently owned.
+
+    Returns:
+        dict: Slot number mapped to the ARN of the task that owns it
+    """
+
+    table = get_dynamo_resource().Table(HOSTNAME_SLOT_TABLE)
+    slots = {}
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response['Items']:
+            slots[int(item['slot'])] = item['task_arn']
+        if 'LastEvaluatedKey' not in response:
+            return slots
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_owned_slot(task_arn):
+    """ Get the hostname slot a task owns.
+
+    Args:
+        task_arn (str): ARN of the task
+
+    Returns:
+        int: The slot number, or None if the task doesn't own one
+    """
+
+    table = get_dynamo_resource().Table(HOSTNAME_OWNER_TABLE)
+    item = table.get_item(Key={'task_arn': task_arn}, ConsistentRead=True).get('Item')
+    return int(item['slot']) if item is not None else None
+
+
+def claim_slot(task_arn, running_arns):
+    """ Atomically claim the lowest free hostname slot for a task.
+
+    A slot is free if nobody owns it, or if it's owned by a task which is no
+    longer running. Every claim is a conditional write of both the slot and
+    the task, so two tasks starting at the same time can never end up with
+    the same slot, and two claims for the same task, such as from the queue
+    and the task state change, can never take two slots. Claiming again for
+    a task that already has a slot returns the same slot.
+
+    Args:
+        task_arn (str): ARN of the task claiming the slot
+        running_arns (list): ARNs of every task which is currently running
+
+    Returns:
+        int: The slot number claimed
+    """
+
+    running_arns = set(running_arns)
+
+    slot = get_owned_slot(task_arn)
+    if slot is not None:
+        return slot
+
+    slots = get_slots()
+    for slot, owner in slots.items():
+        if owner == task_arn:
+            return slot
+
+    for slot in range(1, MAX_SLOTS+1):
+        owner = slots.get(slot)
+        if owner is not None and owner in running_arns:
+            continue
+
+        # Someone else may have got there first, so move on to the next one
+        taken = take_slot(slot, task_arn, owner)
+        if taken is not None:
+            return taken
+
+    raise RuntimeError("No free hostname slots")
+
+
+def claim_slots(task_arns, running_arns):
+    """ Claim a hostname slot for each of many tasks with a single scan.
+
+    Each task is given a different one of the lowest free slots and the
+    claims are written in parallel, rather than every task racing for the
+    same slot. A task which loses its slot to someone else falls back to
+    `claim_slot`. Tasks which already own a slot keep it.
+
+    Args:
+        task_arns (list): ARNs of the tasks claiming slots
+        running_arns (list): ARNs of every task which is currently running
+
+    Returns:
+        dict: ARN of each task mapped to the slot it claimed
+    """
+
+    running_arns = set(running_arns)
+    slots = get_slots()
+    owned = {owner: slot for slot, owner in slots.items()}
+    claimed = {arn: owned[arn] for arn in task_arns if arn in owned}
+
+    wanting = [arn for arn in dict.fromkeys(task_arns) if arn not in claimed]
+    if len(wanting) == 0:
+        return claimed
+
+    free = [slot for slot in range(1, MAX_SLOTS+1)
+            if slots.get(slot) is None or slots[slot] not in running_arns]
+    if len(free) < len(wanting):
+        raise RuntimeError("No free hostname slots")
+
+    def claim(task_arn, slot):
+        taken = take_slot(slot, task_arn, slots.get(slot))
+        if taken is not None:
+            return taken
+        return claim_slot(task_arn, running_arns)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(len(wanting), 10)) as executor:
+        claimed.update(zip(wanting, executor.map(claim, wanting, free)))
+    return claimed
+
+
+def take_slot(slot, task_arn, owner):
+    """ Write a task as the owner of a slot, if the slot is still as expected.
+
+    The slot and the task are written in one transaction, which fails if the
+    slot has changed or the task already owns a slot.
+
+    Args:
+        slot (int): The slot number
+        task_arn (str): ARN of the task taking the slot
+        owner (str): ARN of the stopped task owning the slot, or None if free
+
+    Returns:
+        int: The slot the task owns, which is another slot if a claim for the
+            same task got there first, or None if the slot was taken by
+            another task in the meantime
+    """
+
+    if owner is None:
+        condition = {'ConditionExpression': 'attribute_not_exists(slot)'}
+    else:
+        print(f"Taking slot {slot} from stopped task {owner}")
+        condition = {
+            'ConditionExpression': 'task_arn = :owner',
+            'ExpressionAttributeValues': {':owner': owner}
+        }
+
+    now = int(time.time())
+    items = [
+        {'Put': {
+            'TableName': HOSTNAME_SLOT_TABLE,
+            'Item': {'slot': slot, 'task_arn': task_arn, 'claimed_at': now},
+            **condition
+        }},
+        {'Put': {
+            'TableName': HOSTNAME_OWNER_TABLE,
+            'Item': {'task_arn': task_arn, 'slot': slot, 'claimed_at': now},
+            'ConditionExpression': 'attribute_not_exists(task_arn)'
+        }}
+    ]
+    if owner is not None:
+        items.append({'Delete': {'TableName': HOSTNAME_OWNER_TABLE,
+                                 'Key': {'task_arn': owner}}})
+
+    client = get_dynamo_resource().meta.client
+    try:
+        client.transact_write_items(TransactItems=items)
+    except client.exceptions.TransactionCanceledException as ex:
+        reasons = [reason.get('Code') for reason in ex.response.get('CancellationReasons', [])]
+        if len(reasons) > 1 and reasons[1] == 'ConditionalCheckFailed':
+            print(f"Task {task_arn} already owns a slot")
+            return get_owned_slot(task_arn)
+        return None
+    return slot
+
+
+def release_slot(task_arn):
+    """ Free any hostname slot owned by a task.
+
+    Args:
+        task_arn (str): ARN of the task which owns the slot
+
+    Returns:
+        list: The slot numbers released
+    """
+
+    return release_slots([task_arn])
+
+
+def release_slots(task_arns):
+    """ Free the hostname slots owned by any of the tasks, with a single scan.
+
+    Args:
+        task_arns (list): ARNs of the tasks which own the slots
+
+    Returns:
+        list: The slot numbers released
+    """
+
+    client = get_dynamo_resource().meta.client
+    task_arns = set(task_arns)
+
+    released = []
+    for slot, owner in get_slots().items():
+        if owner not in task_arns:
+            continue
+        try:
+            client.transact_write_items(TransactItems=[
+                {'Delete': {
+                    'TableName': HOSTNAME_SLOT_TABLE,
+                    'Key': {'slot': slot},
+                    'ConditionExpression': 'task_arn = :owner',
+                    'ExpressionAttributeValues': {':owner': owner}
+                }},
+                {'Delete': {
+                    'TableName': HOSTNAME_OWNER_TABLE,
+                    'Key': {'task_arn': owner}
+                }}
+            ])
+        except client.exceptions.TransactionCanceledException:
+            continue
+        released.append(slot)
+
+    return released
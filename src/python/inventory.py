@@ -0,0 +1,61 @@
+from aws import get_running_tasks, get_task_details, get_network_interface_id, get_interface_public_ips
+
+
+class TaskRecord:
+    """ The parts of a task's `describe_tasks` details the handlers use.
+
+    Only the fields read by the handlers are kept, so an inventory of a large
+    fleet doesn't hold on to every attachment, container and tag of each task.
+    """
+
+    __slots__ = ('task_arn', 'last_status', 'desired_status', 'started_by',
+                 'started_at', 'stopping_at', 'stopped_at', 'stop_code',
+                 'stopped_reason', 'cpu', 'memory', 'overrides', 'eni_id',
+                 'public_ip')
+
+    def __init__(self, task):
+        self.task_arn = task['taskArn']
+        self.last_status = task.get('lastStatus')
+        self.desired_status = task.get('desiredStatus')
+        self.started_by = task.get('startedBy')
+        self.started_at = task.get('startedAt')
+        self.stopping_at = task.get('stoppingAt')
+        self.stopped_at = task.get('stoppedAt')
+        self.stop_code = task.get('stopCode')
+        self.stopped_reason = task.get('stoppedReason')
+        self.cpu = task.get('cpu')
+        self.memory = task.get('memory')
+        self.overrides = task.get('overrides')
+        self.eni_id = get_network_interface_id(task)
+        self.public_ip = None
+
+    def __repr__(self):
+        return f"TaskRecord({self.task_arn}, {self.last_status}, {self.public_ip})"
+
+
+def get_inventory(cluster, task_family, resolve_ips=True):
+    """ Get every running task of a family along with its public IP.
+
+    All pages of `list_tasks` are read, the tasks are described in parallel
+    chunks of 100 and every interface is resolved in one EC2 lookup, so a
+    handler needs only this one fetch to know the state of the whole fleet.
+
+    Args:
+        cluster (str): The name of the cluster containing the tasks
+        task_family (str): The family of task to search for
+        resolve_ips (bool): Whether to look up the public IP of each task
+
+    Returns:
+        list: A TaskRecord for each task in a running/soon to be running state
+    """
+
+    task_arns = get_running_tasks(cluster, task_family)
+    if len(task_arns) == 0:
+        return []
+
+    records = [TaskRecord(task) for task in get_task_details(cluster, task_arns)]
+    if resolve_ips:
+        public_ips = get_interface_public_ips(record.eni_id for record in records)
+        for record in records:
+            record.public_ip = public_ips.get(record.eni_id)
+    return records
@@ -0,0 +1,196 @@
+import functools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Metrics are written to stdout as CloudWatch Embedded Metric Format, so
+# CloudWatch Logs turns them into metrics without any extra API calls
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CsgoPrac')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# EMF allows at most 100 values per metric in a single record
+MAX_VALUES = 100
+
+# Only the first invocation of a container is a cold start
+_cold_start = True
+_metrics = {}
+_counts = {}
+_units = {}
+_lock = threading.Lock()
+
+
+def is_debug():
+    return LOG_LEVEL == 'DEBUG'
+
+
+def debug(message):
+    """ Print a message only when LOG_LEVEL is DEBUG.
+
+    Args:
+        message: The message to print, anything that isn't a string is
+                 dumped as JSON
+    """
+
+    if not is_debug():
+        return
+    if not isinstance(message, str):
+        message = json.dumps(message, default=str)
+    print(message)
+
+
+def record(name, value, unit='Milliseconds'):
+    """ Add a value to a metric of the current invocation.
+
+    Args:
+        name (str): Name of the metric
+        value (float): The value to add
+        unit (str): CloudWatch unit of the metric
+    """
+
+    with _lock:
+        _metrics.setdefault(name, []).append(value)
+        _units[name] = unit
+
+
+def increment(name, value=1):
+    """ Add to a counter of the current invocation.
+
+    Args:
+        name (str): Name of the counter
+        value (int): The amount to add
+    """
+
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + value
+
+
+@contextmanager
+def timed(name):
+    """ Record how long the body of a `with` block takes.
+
+    Args:
+        name (str): Name of the metric to record the time against
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+
+def instrument(handler):
+    """ Decorate a Lambda handler to write its metrics when it returns.
+
+    Each invocation writes a single EMF record with whether it was a cold
+    start, the handler duration, and anything recorded while it ran, such as
+    the time taken by each AWS API call.
+
+    Args:
+        handler (function): The Lambda handler to instrument
+
+    Returns:
+        function: The instrumented handler
+    """
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _cold_start
+        cold_start, _cold_start = _cold_start, False
+        debug(event)
+
+        start = time.perf_counter()
+        try:
+            response = handler(event, context)
+        finally:
+            record('Duration', (time.perf_counter() - start) * 1000)
+            increment('ColdStart', int(cold_start))
+            flush(context)
+
+        debug(response)
+        return response
+
+    return wrapper
+
+
+def flush(context=None):
+    """ Write every metric recorded so far as an EMF record and clear them.
+
+    Args:
+        context (dict): The context of the Lambda function, used to name
+                        the function the metrics belong to
+    """
+
+    with _lock:
+        metrics = {name: values[-MAX_VALUES:] for name, values in _metrics.items()}
+        metrics.update({name: [value] for name, value in _counts.items()})
+        units = {**_units, **{name: 'Count' for name in _counts}}
+        _metrics.clear()
+        _counts.clear()
+        _units.clear()
+
+    if len(metrics) == 0:
+        return
+
+    function = getattr(context, 'function_name', None) \
+        or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+    emf = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function']],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in sorted(metrics)]
+            }]
+        },
+        'Function': function,
+        **{name: values[0] if len(values) == 1 else values
+           for name, values in metrics.items()}
+    }
+    print(json.dumps(emf))
+
+
+def install_aws_hooks(session):
+    """ Time every AWS API call made by clients of a boto3 session.
+
+    The time of each call is recorded against `<service>.<operation>`, and
+    the number of calls against AwsCalls. Calls which never got a response,
+    such as when the endpoint can't be reached, are also counted against
+    AwsCallErrors. Clients copy the session's event
+    hooks when they're created, so this must run before any client is made.
+
+    Args:
+        session (boto3.session.Session): The session to add the hooks to
+    """
+
+    session.events.register('before-call', _before_call)
+    session.events.register('after-call', _after_call)
+    session.events.register('after-call-error', _after_call_error)
+
+
+def _before_call(model, context, **kwargs):
+    context['metrics_name'] = f"{model.service_model.service_name}.{model.name}"
+    context['metrics_start'] = time.perf_counter()
+
+
+def _after_call(model, context, **kwargs):
+    _record_call(context)
+
+
+def _after_call_error(exception=None, context=None, **kwargs):
+    # Only the exception and context are passed when the request itself fails
+    if _record_call(context or {}):
+        increment('AwsCallErrors')
+
+
+def _record_call(context):
+    start = context.pop('metrics_start', None)
+    name = context.pop('metrics_name', None)
+    if start is None or name is None:
+        return False
+    record(name, (time.perf_counter() - start) * 1000)
+    increment('AwsCalls')
+    return True
@@ -0,0 +1,153 @@
+import os
+import time
+
+from aws import get_client, get_dynamo_resource, start_ecs_task
+
+# Tasks started to sit idle in the pool are given this startedBy value, and
+# a task is handed out by writing its ARN to the claim table
+WARM_POOL_STARTED_BY = 'csgo-warm-pool'
+WARM_POOL_TABLE = os.environ.get('WARM_POOL_TABLE')
+CLAIM_TTL = 2*24*60*60
+
+
+def get_pool_tasks(cluster, task_family):
+    """ Get every task that was started for the warm pool, claimed or not.
+
+    Args:
+        cluster (str): The name of the cluster containing the tasks
+        task_family (str): The family of task to search for
+
+    Returns:
+        list: ARNs of the warm pool tasks
+    """
+
+    client = get_client('ecs')
+    paginator = client.get_paginator('list_tasks')
+    task_arns = []
+    for page in paginator.paginate(cluster=cluster, family=task_family,
+                                   startedBy=WARM_POOL_STARTED_BY,
+                                   desiredStatus="RUNNING"):
+        task_arns += page['taskArns']
+    return task_arns
+
+
+def get_claimed_tasks(task_arns):
+    """ Get which of the tasks have already been handed out from the pool.
+
+    Args:
+        task_arns (list): ARNs of the warm pool tasks to check
+
+    Returns:
+        set: ARNs of the tasks which have been claimed
+    """
+
+    dynamo = get_dynamo_resource()
+    claimed = set()
+    for i in range(0, len(task_arns), 100):
+        keys = [{'task_arn': arn} for arn in task_arns[i:i+100]]
+        request = {WARM_POOL_TABLE: {'Keys': keys, 'ProjectionExpression': 'task_arn'}}
+        while request:
+            response = dynamo.batch_get_item(RequestItems=request)
+            claimed.update(item['task_arn']
+                           for item in response['Responses'].get(WARM_POOL_TABLE, []))
+            request = response.get('UnprocessedKeys')
+    return claimed
+
+
+def get_idle_tasks(cluster, task_family):
+    """ Get the warm pool tasks which are still waiting to be claimed.
+
+    Args:
+        cluster (str): The name of the cluster containing the tasks
+        task_family (str): The family of task to search for
+
+    Returns:
+        list: ARNs of the idle tasks
+    """
+
+    task_arns = get_pool_tasks(cluster, task_family)
+    if len(task_arns) == 0:
+        return []
+
+    claimed = get_claimed_tasks(task_arns)
+    return [arn for arn in task_arns if arn not in claimed]
+
+
+def is_idle_pool_task(task, claimed):
+    """ Check whether a task is sitting unclaimed in the warm pool.
+
+    Args:
+        task (TaskRecord): The task as returned by `get_inventory`
+        claimed (set): ARNs of the claimed tasks
+
+    Returns:
+        bool: True if the task is an unclaimed pool task
+    """
+
+    return task.started_by == WARM_POOL_STARTED_BY and task.task_arn not in claimed
+
+
+def claim_task(task_arn):
+    """ Atomically take a task out of the warm pool.
+
+    Args:
+        task_arn (str): ARN of the task to claim
+
+    Returns:
+        bool: True if the task was claimed, False if someone else got it first
+    """
+
+    table = get_dynamo_resource().Table(WARM_POOL_TABLE)
+    try:
+        table.put_item(
+            Item={
+                'task_arn': task_arn,
+                'claimed_at': int(time.time()),
+                'expires_at': int(time.time()) + CLAIM_TTL
+            },
+            ConditionExpression='attribute_not_exists(task_arn)'
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Task {task_arn} has already been claimed")
+        return False
+
+    print(f"Claimed {task_arn} from the warm pool")
+    return True
+
+
+def release_task(task_arn):
+    """ Remove the claim on a task once it has been stopped.
+
+    Args:
+        task_arn (str): ARN of the task to release
+    """
+
+    table = get_dynamo_resource().Table(WARM_POOL_TABLE)
+    table.delete_item(Key={'task_arn': task_arn})
+
+
+def start_pool_tasks(cluster, task_definition, subnets, security_groups,
+                     overrides, count):
+    """ Start new idle tasks for the warm pool.
+
+    Args:
+        cluster (str): The name of the cluster to start the tasks in
+        task_definition (str); The name of the task definition to run
+        subnets (list): List of subnet id's to connect the tasks to
+        security_groups (list): List of security groups to apply to the tasks
+        overrides (dict): Any ECS variable overrides to push to the container
+        count (int): The number of tasks to start
+
+    Returns:
+        list: Details of the tasks started
+    """
+
+    tasks = []
+    while count > 0:
+        batch = min(count, 10)
+        started, _ = start_ecs_task(cluster, task_definition, subnets,
+                                    security_groups, overrides, count=batch,
+                                    started_by=WARM_POOL_STARTED_BY)
+        tasks += started
+        count -= batch
+    return tasks
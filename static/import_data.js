@@ -3,15 +3,37 @@ $(function () {
     $('#table').bootstrapTable({data: []});
     setButtonVisibility();
     $('#mapSelect').on('change', setButtonVisibility);
-    var intervalID = window.setInterval(getServerStatus, 5000);
+    watchServerStatus();
 });
 
+var statusEtag = null;
+
 function getServerStatus() {
     var url = `https://csgo-api.${SERVER_HOSTNAME}/status`;
-    httpGetAsync(url, formatTable);
+    httpGetAsync(url, formatTable, statusEtag);
+}
+
+function watchServerStatus() {
+    var url = `https://csgo-api.${SERVER_HOSTNAME}/status/poll?timeout=25`;
+    if (statusEtag)
+        url += `&version=${encodeURIComponent(statusEtag)}`;
+
+    var xmlHttp = new XMLHttpRequest();
+    xmlHttp.responseType = 'json';
+    xmlHttp.onloadend = function() {
+        if (xmlHttp.status == 200)
+            formatTable(xmlHttp.response, xmlHttp.getResponseHeader("ETag"));
+
+        // Wait for the next change straight away, backing off on errors
+        var ok = (xmlHttp.status == 200 || xmlHttp.status == 304);
+        window.setTimeout(watchServerStatus, ok ? 0 : 5000);
+    }
+    xmlHttp.open("GET", url, true); // true for asynchronous 
+    xmlHttp.send(null);
 }
 
-function formatTable(data) {
+function formatTable(data, etag) {
+    statusEtag = etag;
     var $table = $('#table');
     statusData = [];
     if(data['task_details'] != null) {
@@ -105,15 +127,18 @@ function httpPostAsync(theUrl, data, callback) {
     xmlHttp.send(JSON.stringify(data));
 }
 
-function httpGetAsync(theUrl, callback) {
+function httpGetAsync(theUrl, callback, etag) {
     var xmlHttp = new XMLHttpRequest();
     xmlHttp.responseType = 'json';
     console.log(theUrl);
     xmlHttp.onreadystatechange = function() {
+        // A 304 means nothing has changed since the last response
         if (xmlHttp.readyState == 4 && xmlHttp.status == 200)
-            callback(xmlHttp.response);
+            callback(xmlHttp.response, xmlHttp.getResponseHeader("ETag"));
     }
     xmlHttp.open("GET", theUrl, true); // true for asynchronous 
+    if (etag)
+        xmlHttp.setRequestHeader("If-None-Match", etag);
     xmlHttp.send(null);
 }
 
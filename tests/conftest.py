@@ -0,0 +1,24 @@
+"""Run the handlers against the in-process AWS fakes used by the benchmarks."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+# Sets up the environment and import path the handlers need
+import bench_handlers
+import fake_aws
+from fake_aws import FakeAws
+
+ENV = bench_handlers.ENV
+
+
+@pytest.fixture
+def fake():
+    """ An empty fleet whose API calls take no time, in place of AWS. """
+
+    fake = FakeAws(latency=0.0)
+    fake_aws.install(fake)
+    return fake
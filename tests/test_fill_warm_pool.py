@@ -0,0 +1,29 @@
+import json
+
+import csgo_fill_warm_pool
+
+
+def fill():
+    response = csgo_fill_warm_pool.handler({}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_rejected_hostname_messages_are_returned(fake, monkeypatch):
+    monkeypatch.setattr(csgo_fill_warm_pool, 'WARM_POOL_SIZE', 3)
+    fake.rejected_messages = 100
+
+    code, body = fill()
+
+    assert code == 200
+    assert len(body['taskArns']) == 3
+    assert body['notQueued'] == body['taskArns']
+
+
+def test_rejected_hostname_messages_are_retried(fake, monkeypatch):
+    monkeypatch.setattr(csgo_fill_warm_pool, 'WARM_POOL_SIZE', 3)
+    fake.rejected_messages = 2
+
+    code, body = fill()
+
+    assert 'notQueued' not in body
+    assert len(fake.messages) == 3
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from a2s_simulator import fleet_ips
+from bench_handlers import get_hostname
+
+import csgo_get_hostname
+
+
+def invoke(event):
+    response = csgo_get_hostname.handler(event, None)
+    return [failure['itemIdentifier'] for failure in response['batchItemFailures']]
+
+
+def test_hostnames_are_created(fake):
+    event = get_hostname(fake, fleet_ips(3))
+
+    assert invoke(event) == []
+    assert sorted(fake.records) == [(f"csgo{slot}.bench.example.com.", 'A')
+                                    for slot in (1, 2, 3)]
+
+
+@pytest.mark.parametrize('body', [
+    'not json',
+    json.dumps(['a', 'list']),
+    json.dumps('arn:aws:ecs:task'),
+    json.dumps(None),
+    json.dumps({'start_time': '2021-10-05 10:00:00'}),
+    json.dumps({'task_arn': 12}),
+])
+def test_bad_message_fails_only_itself(fake, body):
+    event = get_hostname(fake, fleet_ips(2))
+    event['Records'].append({'messageId': 'bad', 'body': body})
+
+    assert invoke(event) == ['bad']
+    assert len(fake.records) == 2
@@ -0,0 +1,82 @@
+import json
+import time
+
+import pytest
+
+from a2s_simulator import fleet_ips
+from bench_handlers import api_event, status_stored
+
+import csgo_get_server_status
+
+
+def detailed_body(ping, times, kills=3):
+    info = {'map': 'de_mirage', 'numplayers': len(times), 'maxplayers': 10, 'numbots': 0,
+            'ping': ping}
+    players = [{'name': f"player{i}", 'kills': kills, 'time': time}
+               for i, time in enumerate(times)]
+    details = csgo_get_server_status.get_server_details(
+        {'info': info, 'player': players, 'rules': {'tickrate': '128'}})
+    return {'task_details': [{'taskArn': 'arn:task/1', 'map': 'de_mirage', **details}]}
+
+
+def test_etag_ignores_ping_and_connection_times():
+    first = detailed_body(0.012, [61.2, 300.7])
+    second = detailed_body(0.048, [63.9, 303.1])
+
+    assert first != second
+    assert csgo_get_server_status.get_etag(first) == csgo_get_server_status.get_etag(second)
+
+
+def test_etag_changes_with_the_players():
+    before = detailed_body(0.012, [61.2, 300.7])
+
+    assert csgo_get_server_status.get_etag(before) \
+        != csgo_get_server_status.get_etag(detailed_body(0.012, [61.2, 300.7], kills=4))
+    assert csgo_get_server_status.get_etag(before) \
+        != csgo_get_server_status.get_etag(detailed_body(0.012, [61.2]))
+
+
+def test_etag_of_empty_fleet():
+    assert csgo_get_server_status.get_etag({'task_details': None}).startswith('"')
+
+
+@pytest.fixture
+def stored(fake, monkeypatch):
+    """ A fleet state table swept 30 seconds ago, with snapshots cached. """
+
+    monkeypatch.setattr(csgo_get_server_status, 'STATUS_CACHE_TTL', 60)
+    monkeypatch.setattr(csgo_get_server_status, '_snapshots', {})
+    status_stored(fake, fleet_ips(2))
+    fake.tables['fleet-state']['#sweep']['swept_at'] = int(time.time()) - 30
+    return fake
+
+
+def get_status(params=None, resource='/status'):
+    response = csgo_get_server_status.handler(api_event(resource, params=params), None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def ecs_calls(fake):
+    return sum(count for name, count in fake.reset_calls().items() if name.startswith('ecs.'))
+
+
+def test_snapshot_is_not_shared_across_max_age(stored):
+    assert get_status()[0] == 200
+    assert ecs_calls(stored) == 0
+
+    # The cached snapshot came from state older than this request allows
+    assert get_status({'max_age': '10'})[0] == 200
+    assert ecs_calls(stored) > 0
+
+    assert get_status()[0] == 200
+    assert get_status({'max_age': '10'})[0] == 200
+    assert ecs_calls(stored) == 0
+
+
+@pytest.mark.parametrize('resource', ['/status', '/status/poll'])
+@pytest.mark.parametrize('max_age', ['soon', '-5', '1.5', ''])
+def test_bad_max_age_is_rejected(stored, resource, max_age):
+    code, body = get_status({'max_age': max_age}, resource)
+
+    assert code == 400
+    assert 'max_age' in body['error']
@@ -0,0 +1,128 @@
+import json
+import threading
+from datetime import datetime
+
+import pytest
+
+from a2s_simulator import fleet_ips
+from bench_handlers import seed_fleet
+
+import csgo_get_hostname
+import hostname_slots
+
+TASKS = 20
+
+
+@pytest.fixture
+def slow_fake(fake):
+    """ Give every call a little latency so concurrent claims interleave. """
+
+    fake.latency = 0.002
+    fake.jitter = 0.005
+    return fake
+
+
+def run_together(calls):
+    """ Start every call at the same moment and collect what each returned. """
+
+    barrier = threading.Barrier(len(calls))
+    results = [None] * len(calls)
+    errors = []
+
+    def run(index, function, *args):
+        barrier.wait()
+        try:
+            results[index] = function(*args)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run, args=(index, *call))
+               for index, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    return results
+
+
+def owners(fake):
+    return {item['slot']: item['task_arn'] for item in fake.tables['hostname-slots'].values()}
+
+
+def get_hostname(task_arn):
+    """ Deliver one task's hostname message on its own, as SQS would. """
+
+    start_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    body = json.dumps({'task_arn': task_arn, 'start_time': start_time})
+    return csgo_get_hostname.handler({'Records': [{'messageId': task_arn, 'body': body}]},
+                                     None)
+
+
+def test_concurrent_tasks_get_different_hostnames(slow_fake):
+    ips = fleet_ips(TASKS)
+    task_arns = seed_fleet(slow_fake, ips, hostnames=False)
+    slow_fake.reset_calls()
+
+    responses = run_together([(get_hostname, arn) for arn in task_arns])
+
+    assert [response['batchItemFailures'] for response in responses] == [[]] * TASKS
+    assert slow_fake.records == {(f"csgo{slot}.bench.example.com.", 'A'): ip
+                                 for slot, ip in zip(sorted_slots(slow_fake, task_arns), ips)}
+    assert sorted(slot for slot in owners(slow_fake)) == list(range(1, TASKS + 1))
+
+    # One change per task, with none failed, retried or sent back to the queue
+    calls = slow_fake.reset_calls()
+    assert calls['route53.ChangeResourceRecordSets'] == TASKS
+    assert calls['sqs.SendMessage'] == 0
+
+
+def sorted_slots(fake, task_arns):
+    """ The slot owned by each task, in the order of the tasks. """
+
+    return [fake.tables['hostname-owners'][arn]['slot'] for arn in task_arns]
+
+
+def test_concurrent_claims_for_the_same_task_share_one_slot(slow_fake):
+    # The queue and the task state change both claim for every task at once
+    task_arns = [slow_fake.add_task() for _ in range(TASKS)]
+    calls = [(hostname_slots.claim_slot, arn, task_arns) for arn in task_arns] * 2
+
+    slots = run_together(calls)
+
+    assert slots[:TASKS] == slots[TASKS:]
+    assert sorted(slots[:TASKS]) == list(range(1, TASKS + 1))
+    assert owners(slow_fake) == dict(zip(slots, task_arns))
+    assert {arn: item['slot'] for arn, item in slow_fake.tables['hostname-owners'].items()} \
+        == dict(zip(task_arns, slots))
+
+
+def test_batch_and_single_claims_race_for_the_same_tasks(slow_fake):
+    task_arns = [slow_fake.add_task() for _ in range(TASKS)]
+    calls = [(hostname_slots.claim_slots, task_arns, task_arns)]
+    calls += [(hostname_slots.claim_slot, arn, task_arns) for arn in task_arns]
+
+    batch, *singles = run_together(calls)
+
+    assert [batch[arn] for arn in task_arns] == singles
+    assert sorted(singles) == list(range(1, TASKS + 1))
+    assert len(slow_fake.tables['hostname-owners']) == TASKS
+
+
+def test_slot_of_stopped_task_is_reused(fake):
+    stopped, running = fake.add_task(), fake.add_task()
+    assert hostname_slots.claim_slot(stopped, [stopped]) == 1
+
+    assert hostname_slots.claim_slot(running, [running]) == 1
+    assert owners(fake) == {1: running}
+    assert list(fake.tables['hostname-owners']) == [running]
+
+
+def test_release_frees_slot_and_owner(fake):
+    task_arns = [fake.add_task() for _ in range(3)]
+    for arn in task_arns:
+        hostname_slots.claim_slot(arn, task_arns)
+
+    assert hostname_slots.release_slots(task_arns[:2]) == [1, 2]
+    assert owners(fake) == {3: task_arns[2]}
+    assert list(fake.tables['hostname-owners']) == [task_arns[2]]
@@ -0,0 +1,46 @@
+import socket
+
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import EndpointConnectionError
+
+import metrics
+
+
+@pytest.fixture
+def closed_port():
+    """ A local port with nothing listening on it. """
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def session():
+    session = boto3.session.Session(aws_access_key_id='testing',
+                                    aws_secret_access_key='testing',
+                                    region_name='eu-west-1')
+    metrics.install_aws_hooks(session)
+    metrics.flush()
+    yield session
+    metrics.flush()
+
+
+def test_unreachable_endpoint_raises_its_own_error(session, closed_port):
+    client = session.client('sqs', endpoint_url=f"http://127.0.0.1:{closed_port}",
+                            config=Config(retries={'total_max_attempts': 1},
+                                          connect_timeout=1))
+
+    with pytest.raises(EndpointConnectionError):
+        client.list_queues()
+
+    assert len(metrics._metrics['sqs.ListQueues']) == 1
+    assert metrics._counts == {'AwsCalls': 1, 'AwsCallErrors': 1}
+
+
+def test_error_hook_without_a_timed_call():
+    metrics._after_call_error(exception=ValueError('no request'), context={})
+
+    assert 'AwsCallErrors' not in metrics._counts
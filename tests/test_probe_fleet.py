@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from a2s_simulator import fleet_ips
+from bench_handlers import seed_fleet
+
+import csgo_probe_fleet
+import fleet_state
+
+INFO = {'map': 'de_mirage', 'numplayers': 3, 'maxplayers': 10, 'numbots': 0}
+
+
+@pytest.fixture
+def stored(fake, monkeypatch):
+    """ Two tasks, stored by a first sweep which no server answered. """
+
+    ips = fleet_ips(2)
+    task_arns = seed_fleet(fake, ips)
+    answers = {}
+
+    def query_servers(ips, port, queries, timeout):
+        during_sweep = answers.pop('during_sweep', None)
+        if during_sweep:
+            during_sweep()
+        return {ip: {'info': dict(INFO)} for ip in answers.get('answering', [])}
+
+    monkeypatch.setattr(csgo_probe_fleet, 'query_servers', query_servers)
+    sweep()
+    return task_arns, ips, answers
+
+
+def sweep():
+    response = csgo_probe_fleet.handler({}, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])
+
+
+def stored_state(fake, task_arn):
+    return fake.tables['fleet-state'].get(task_arn)
+
+
+def test_readiness_written_during_sweep_is_kept(fake, stored):
+    task_arns, ips, answers = stored
+
+    def prober():
+        fleet_state.claim_readiness_probe(task_arns[0])
+        fleet_state.update_task_state(task_arns[0], server_ready=True, ready_at=100,
+                                      map='de_mirage', ready_phases={'SrcdsLoad': 12.5})
+
+    answers.update(during_sweep=prober, answering=[ips[0]])
+    sweep()
+
+    state = stored_state(fake, task_arns[0])
+    assert state['ready_at'] == 100
+    assert state['ready_phases'] == {'SrcdsLoad': 12.5}
+    assert 'probe_started_at' in state
+    assert state['num_players'] == 3
+
+
+def test_sweep_sets_ready_at_when_first_to_see_server_answer(fake, stored):
+    task_arns, ips, answers = stored
+    assert 'ready_at' not in stored_state(fake, task_arns[0])
+
+    answers.update(answering=[ips[0]])
+    sweep()
+
+    first = stored_state(fake, task_arns[0])
+    assert first['ready_at'] == first['probed_at']
+    assert 'ready_at' not in stored_state(fake, task_arns[1])
+
+    sweep()
+    assert stored_state(fake, task_arns[0])['ready_at'] == first['ready_at']
+
+
+def test_server_removed_during_sweep_is_not_written_back(fake, stored):
+    task_arns, _, answers = stored
+    answers.update(during_sweep=lambda: fleet_state.delete_task_states(task_arns[:1]))
+
+    assert sweep() == {'stored': 1, 'removed': 1}
+
+    assert stored_state(fake, task_arns[0]) is None
+    assert stored_state(fake, task_arns[1]) is not None
+
+
+def test_new_server_is_stored(fake, stored):
+    task_arn = fake.add_task(fleet_ips(1, offset=4)[0])
+
+    assert sweep() == {'stored': 3, 'removed': 0}
+
+    assert stored_state(fake, task_arn)['last_status'] == 'RUNNING'
+
+
+def test_sweep_bumps_the_version_once(fake, stored):
+    task_arns, _, _ = stored
+    fake.tasks[task_arns[1]]['lastStatus'] = 'STOPPED'
+    fake.tasks[task_arns[1]]['desiredStatus'] = 'STOPPED'
+    version = fleet_state.get_fleet_version()
+
+    sweep()
+
+    assert fleet_state.get_fleet_version() == version + 1
@@ -0,0 +1,64 @@
+import json
+import threading
+
+import pytest
+
+from a2s_simulator import FleetThread, SimulatedFleet, SimulationOptions, fleet_ips
+from bench_handlers import seed_fleet
+
+import csgo_probe_fleet
+import csgo_probe_readiness
+from fleet_state import from_dynamo
+
+SERVERS = 4
+
+
+@pytest.fixture
+def starting(fake, monkeypatch):
+    """ Servers which start answering at random within a second, with
+    tasks already stored by a sweep which none of them answered. """
+
+    monkeypatch.setattr(csgo_probe_readiness, 'PROBE_MIN_INTERVAL', 0.05)
+    monkeypatch.setattr(csgo_probe_readiness, 'PROBE_MAX_INTERVAL', 0.1)
+    monkeypatch.setattr(csgo_probe_fleet, 'QUERY_TIMEOUT', 0.1)
+
+    ips = fleet_ips(SERVERS)
+    servers = FleetThread(SimulatedFleet(SERVERS, SimulationOptions(boot=1.0)))
+    task_arns = seed_fleet(fake, ips)
+    csgo_probe_fleet.handler({}, None)
+
+    # Every call takes a little while so the prober and sweeps interleave
+    fake.latency = 0.002
+    fake.jitter = 0.005
+    yield list(zip(task_arns, ips))
+    servers.close()
+
+
+def test_sweeps_running_alongside_the_prober_keep_its_results(fake, starting):
+    results = [None] * len(starting)
+
+    def probe(index, task_arn, public_ip):
+        response = csgo_probe_readiness.handler(
+            {'task_arn': task_arn, 'public_ip': public_ip}, None)
+        results[index] = json.loads(response['body'])
+
+    probers = [threading.Thread(target=probe, args=(index, *task))
+               for index, task in enumerate(starting)]
+    for prober in probers:
+        prober.start()
+    sweeps = 0
+    while any(prober.is_alive() for prober in probers):
+        csgo_probe_fleet.handler({}, None)
+        sweeps += 1
+    for prober in probers:
+        prober.join()
+    csgo_probe_fleet.handler({}, None)
+
+    for (task_arn, _), result in zip(starting, results):
+        assert result['readyAt'] is not None
+        state = from_dynamo(fake.tables['fleet-state'][task_arn])
+        assert state['ready_at'] == result['readyAt']
+        assert state['ready_phases'] == result['phases']
+        assert 'probe_started_at' in state
+        assert state['server_ready'] is True
+    assert sweeps > 1
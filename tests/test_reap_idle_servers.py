@@ -0,0 +1,128 @@
+import json
+import time
+
+import pytest
+
+from a2s_simulator import A2S_INFO, FleetThread, SimulatedFleet, fleet_ips
+from bench_handlers import seed_fleet
+from fixtures import encode_info
+
+import csgo_reap_idle_servers
+from warm_pool import WARM_POOL_STARTED_BY
+
+SERVERS = 3
+
+
+@pytest.fixture(scope='module')
+def servers():
+    """ Simulated servers answering A2S on 127.0.0.2 onwards. """
+
+    servers = FleetThread(SimulatedFleet(SERVERS))
+    yield servers
+    servers.close()
+
+
+@pytest.fixture
+def fleet(fake, servers, monkeypatch):
+    """ A task for each simulated server, and a way to set its players. """
+
+    monkeypatch.setattr(csgo_reap_idle_servers, 'QUERY_TIMEOUT', 0.3)
+    task_arns = seed_fleet(fake, fleet_ips(SERVERS))
+
+    def set_players(index, humans, bots=0):
+        servers.fleet.servers[index].replies[A2S_INFO] = encode_info(
+            numplayers=humans + bots, numbots=bots)
+
+    for index in range(SERVERS):
+        set_players(index, 0)
+    return task_arns, set_players
+
+
+def reap():
+    response = csgo_reap_idle_servers.handler({}, None)
+    assert response['statusCode'] == 200
+    return json.loads(response['body'])['stopped']
+
+
+def history(fake):
+    return fake.tables['idle-history']
+
+
+def idle_for(fake, task_arn, seconds):
+    history(fake)[task_arn] = {'task_arn': task_arn, 'samples': [],
+                               'idle_since': int(time.time()) - seconds}
+
+
+def test_empty_servers_are_remembered_but_not_stopped_at_once(fake, fleet):
+    task_arns, set_players = fleet
+    set_players(1, 4)
+
+    assert reap() == []
+
+    assert 'idle_since' in history(fake)[task_arns[0]]
+    assert 'idle_since' not in history(fake)[task_arns[1]]
+    assert history(fake)[task_arns[1]]['samples'][-1]['humans'] == 4
+    assert fake.calls['ecs.StopTask'] == 0
+
+
+def test_server_empty_past_timeout_is_stopped(fake, fleet):
+    task_arns, _ = fleet
+    idle_for(fake, task_arns[0], csgo_reap_idle_servers.IDLE_TIMEOUT + 60)
+
+    assert reap() == [task_arns[0]]
+
+    assert fake.tasks[task_arns[0]]['desiredStatus'] == 'STOPPED'
+    assert task_arns[0] not in history(fake)
+    assert 1 not in fake.tables['hostname-slots']
+    assert task_arns[0] not in fake.tables['hostname-owners']
+    assert ('csgo1.bench.example.com.', 'A') not in fake.records
+    assert fake.tasks[task_arns[1]]['desiredStatus'] == 'RUNNING'
+
+
+def test_players_joining_reset_the_idle_time(fake, fleet):
+    task_arns, set_players = fleet
+    set_players(0, 2)
+    idle_for(fake, task_arns[0], csgo_reap_idle_servers.IDLE_TIMEOUT + 60)
+
+    assert reap() == []
+
+    assert 'idle_since' not in history(fake)[task_arns[0]]
+    assert fake.tasks[task_arns[0]]['desiredStatus'] == 'RUNNING'
+
+
+def test_bots_are_not_players(fake, fleet):
+    task_arns, set_players = fleet
+    set_players(0, 0, bots=2)
+    idle_for(fake, task_arns[0], csgo_reap_idle_servers.IDLE_TIMEOUT + 60)
+
+    assert reap() == [task_arns[0]]
+
+
+def test_server_that_does_not_answer_is_left_alone(fake, fleet):
+    # Nothing is listening on this address, as if the server were still starting
+    task_arn = fake.add_task(fleet_ips(1, offset=2 + SERVERS)[0])
+    idle_for(fake, task_arn, csgo_reap_idle_servers.IDLE_TIMEOUT + 60)
+
+    assert task_arn not in reap()
+
+    assert fake.tasks[task_arn]['desiredStatus'] == 'RUNNING'
+    assert history(fake)[task_arn]['samples'] == []
+
+
+def test_idle_pool_tasks_are_skipped(fake, fleet):
+    task_arns, _ = fleet
+    fake.tasks[task_arns[0]]['startedBy'] = WARM_POOL_STARTED_BY
+    idle_for(fake, task_arns[0], csgo_reap_idle_servers.IDLE_TIMEOUT + 60)
+
+    assert task_arns[0] not in reap()
+
+    assert fake.tasks[task_arns[0]]['desiredStatus'] == 'RUNNING'
+
+
+def test_claimed_pool_tasks_are_reaped(fake, fleet):
+    task_arns, _ = fleet
+    fake.tasks[task_arns[0]]['startedBy'] = WARM_POOL_STARTED_BY
+    fake.tables['warm-pool'][task_arns[0]] = {'task_arn': task_arns[0]}
+    idle_for(fake, task_arns[0], csgo_reap_idle_servers.IDLE_TIMEOUT + 60)
+
+    assert reap() == [task_arns[0]]
@@ -0,0 +1,176 @@
+import random
+import socket
+import time
+
+import pytest
+
+import SourceQuery
+from a2s_simulator import A2S_INFO, FleetThread, SimulatedFleet, SimulationOptions
+from fixtures import INFO_REPLY, RULES_REPLY, encode_info, encode_split
+from SourceQuery import SourceQueryError, SourceQuerySession, SplitReassembler
+
+
+def feed_all(reassembler, packets):
+    """ Feed packets in order and return every whole response which came out. """
+
+    responses = []
+    for packet in packets:
+        data = reassembler.feed(packet)
+        if data is not None:
+            responses.append(bytes(data))
+    return responses
+
+
+def test_whole_packet_is_returned_as_is():
+    assert feed_all(SplitReassembler(), [INFO_REPLY]) == [INFO_REPLY]
+
+
+def test_parts_in_order():
+    packets = encode_split(RULES_REPLY, 1)
+    assert len(packets) > 2
+
+    assert feed_all(SplitReassembler(), packets) == [RULES_REPLY]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_shuffled_parts(seed):
+    packets = encode_split(RULES_REPLY, 1, size=500)
+    random.Random(seed).shuffle(packets)
+
+    reassembler = SplitReassembler()
+    assert feed_all(reassembler, packets) == [RULES_REPLY]
+    assert reassembler.pending == {}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_duplicated_parts_give_one_response(seed):
+    packets = encode_split(RULES_REPLY, 1, size=500) * 2
+    random.Random(seed).shuffle(packets)
+
+    reassembler = SplitReassembler()
+    assert feed_all(reassembler, packets) == [RULES_REPLY]
+    assert reassembler.pending == {}
+
+
+def test_duplicate_after_completion_is_dropped():
+    packets = encode_split(RULES_REPLY, 1, size=500)
+    reassembler = SplitReassembler()
+    assert feed_all(reassembler, packets) == [RULES_REPLY]
+
+    # Every part arriving again can't reopen or complete the response
+    assert feed_all(reassembler, packets) == []
+    assert reassembler.pending == {}
+
+
+def test_completed_ids_are_forgotten(monkeypatch):
+    packets = encode_split(RULES_REPLY, 1, size=500)
+    reassembler = SplitReassembler()
+    assert feed_all(reassembler, packets) == [RULES_REPLY]
+
+    monkeypatch.setattr(SourceQuery, 'COMPLETED_TTL', 0)
+    assert feed_all(reassembler, packets) == [RULES_REPLY]
+    assert feed_all(reassembler, encode_split(INFO_REPLY, 2, size=50)) == [INFO_REPLY]
+    assert list(reassembler.completed) == [2]
+
+
+def test_interleaved_responses():
+    rules = encode_split(RULES_REPLY, 1, size=500)
+    info = encode_split(INFO_REPLY, 2, size=40)
+    packets = rules + info
+    random.Random(0).shuffle(packets)
+
+    responses = feed_all(SplitReassembler(), packets)
+
+    assert sorted(responses) == sorted([RULES_REPLY, INFO_REPLY])
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_bzip2_parts(seed):
+    packets = encode_split(RULES_REPLY, 3, size=200, compress=True)
+    assert len(packets) > 2
+    packets += packets[:2]
+    random.Random(seed).shuffle(packets)
+
+    assert feed_all(SplitReassembler(), packets) == [RULES_REPLY]
+
+
+def test_bzip2_crc_mismatch():
+    packets = encode_split(RULES_REPLY, 3, size=200, compress=True)
+    first = bytearray(packets[0])
+    first[SourceQuery.SPLIT_HEADER.size + 4] ^= 0xff
+    packets[0] = bytes(first)
+
+    with pytest.raises(SourceQueryError):
+        feed_all(SplitReassembler(), packets)
+
+
+def test_bzip2_corrupt_payload():
+    packets = encode_split(RULES_REPLY, 3, size=200, compress=True)
+    packets[1] = packets[1][:-20] + b'\x00' * 20
+
+    with pytest.raises(SourceQueryError):
+        feed_all(SplitReassembler(), packets)
+
+
+def test_part_number_out_of_range():
+    packet = bytearray(encode_split(RULES_REPLY, 1, size=500)[0])
+    packet[9] = packet[8]
+
+    with pytest.raises(SourceQueryError):
+        SplitReassembler().feed(bytes(packet))
+
+
+@pytest.fixture
+def server():
+    """ One simulated server on a free local port, and a session with it. """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    runner = FleetThread(SimulatedFleet(1, SimulationOptions(), base_port=port))
+    session = SourceQuerySession('127.0.0.1', port, timeout=0.5)
+    yield runner.fleet, session
+    session.close()
+    runner.close()
+
+
+def test_session_reuses_its_challenge(server):
+    fleet, session = server
+    assert None not in session.query().values()
+    challenges, requests = fleet.stats['challenges'], fleet.stats['requests']
+
+    result = session.query()
+
+    assert None not in result.values()
+    assert fleet.stats['challenges'] == challenges
+    assert fleet.stats['requests'] == requests + 3
+
+
+def test_session_resends_after_challenge_changes(server):
+    fleet, session = server
+    assert None not in session.query().values()
+    challenges = fleet.stats['challenges']
+
+    fleet.options.rotate = 0.01
+    time.sleep(0.05)
+    result = session.query()
+
+    assert None not in result.values()
+    assert fleet.stats['challenges'] > challenges
+
+
+def test_reply_to_timed_out_query_is_not_returned_later(server):
+    fleet, session = server
+    fleet.servers[0].replies[A2S_INFO] = encode_info(map='de_dust2')
+    assert session.info()['map'] == 'de_dust2'
+
+    # The reply arrives after the query has given up on it
+    fleet.options.latency = 0.2
+    session.timeout = 0.05
+    assert session.query(['info']) == {'info': None}
+    time.sleep(0.3)
+
+    fleet.options.latency = 0.0
+    fleet.servers[0].replies[A2S_INFO] = encode_info(map='de_nuke')
+    assert session.info()['map'] == 'de_nuke'
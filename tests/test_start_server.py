@@ -0,0 +1,188 @@
+import json
+
+import pytest
+
+from a2s_simulator import FleetThread, SimulatedFleet, fleet_ips
+from conftest import ENV
+from fake_rcon import FakeRconServer
+
+import csgo_start_server
+from warm_pool import WARM_POOL_STARTED_BY
+
+RCON_PASSWORD = 'rcon-secret'
+
+# Pool tasks on these addresses have loaded far enough to answer queries
+LOADED = fleet_ips(2)
+LOADING = fleet_ips(1, offset=2 + len(LOADED))[0]
+
+
+@pytest.fixture(scope='module')
+def servers():
+    servers = FleetThread(SimulatedFleet(len(LOADED)))
+    yield servers
+    servers.close()
+
+
+@pytest.fixture
+def pool(fake, servers, monkeypatch):
+    """ Turn the warm pool on, with the RCON password in the fake secrets. """
+
+    monkeypatch.setattr(csgo_start_server, 'WARM_POOL_SIZE', 2)
+    monkeypatch.setattr(csgo_start_server, 'POOL_QUERY_TIMEOUT', 0.3)
+    monkeypatch.setattr(csgo_start_server, 'SECRET_NAME', 'csgo-bench-secret')
+    monkeypatch.setattr(csgo_start_server, 'RCON_PASSWORD_KEY', 'rcon')
+    monkeypatch.setattr(csgo_start_server, '_rcon_password', None)
+    fake.secrets['csgo-bench-secret'] = {'rcon': RCON_PASSWORD}
+    return fake
+
+
+def add_pool_task(fake, public_ip, slot):
+    hostname = f"csgo{slot}.{ENV['DNS_HOSTNAME']}"
+    task_arn = fake.add_task(public_ip, started_by=WARM_POOL_STARTED_BY, hostname=hostname)
+    fake.tables['hostname-slots'][slot] = {'slot': slot, 'task_arn': task_arn}
+    fake.tables['hostname-owners'][task_arn] = {'task_arn': task_arn, 'slot': slot}
+    return task_arn
+
+
+def start(body):
+    response = csgo_start_server.handler({'body': json.dumps(body)}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_start_from_pool_applies_settings_over_rcon(pool):
+    task_arn = add_pool_task(pool, LOADED[0], 1)
+
+    with FakeRconServer(LOADED[0], 27015, RCON_PASSWORD) as rcon:
+        code, body = start([{'name': 'MAP', 'value': 'de_nuke'}])
+
+    assert code == 200
+    assert body['taskArns'] == [task_arn]
+    assert rcon.commands == ['changelevel de_nuke']
+    assert task_arn in pool.tables['warm-pool']
+    assert pool.calls['ecs.RunTask'] == 0
+    assert pool.calls['lambda.Invoke'] == 1
+
+
+def test_start_without_idle_servers_does_not_refill_pool(pool):
+    code, body = start([{'name': 'MAP', 'value': 'de_nuke'}])
+
+    assert code == 200
+    assert len(body['taskArns']) == 1
+    assert pool.calls['ecs.RunTask'] == 1
+    assert pool.calls['lambda.Invoke'] == 0
+
+
+def test_start_with_other_tickrate_skips_pool(pool):
+    task_arn = add_pool_task(pool, LOADED[0], 1)
+
+    code, body = start([{'name': 'TICKRATE', 'value': '64'}])
+
+    assert code == 200
+    assert body['taskArns'] != [task_arn]
+    assert task_arn not in pool.tables['warm-pool']
+    assert pool.calls['lambda.Invoke'] == 0
+
+
+def test_pool_task_still_loading_is_not_claimed(pool):
+    # Nothing answers queries on this address yet
+    task_arn = add_pool_task(pool, LOADING, 1)
+
+    code, body = start([{'name': 'MAP', 'value': 'de_nuke'}])
+
+    assert code == 200
+    assert body['taskArns'] != [task_arn]
+    assert pool.tasks[task_arn]['desiredStatus'] == 'RUNNING'
+    assert task_arn not in pool.tables['warm-pool']
+    assert pool.calls['dynamodb.PutItem'] == 0
+    assert pool.calls['ecs.RunTask'] == 1
+
+
+def test_refused_rcon_connection_puts_pool_tasks_back(pool):
+    # Both answer queries, but nothing is listening on their RCON ports
+    task_arns = [add_pool_task(pool, ip, slot) for slot, ip in enumerate(LOADED, 1)]
+
+    code, body = start([{'name': 'MAP', 'value': 'de_nuke'}])
+
+    assert code == 200
+    assert len(body['taskArns']) == 1
+    assert body['taskArns'][0] not in task_arns
+    for slot, task_arn in enumerate(task_arns, 1):
+        assert pool.tasks[task_arn]['desiredStatus'] == 'RUNNING'
+        assert task_arn not in pool.tables['warm-pool']
+        assert pool.tables['hostname-slots'][slot]['task_arn'] == task_arn
+    assert pool.calls['ecs.StopTask'] == 0
+    assert pool.calls['ecs.RunTask'] == 1
+    assert pool.calls['lambda.Invoke'] == 0
+
+
+def test_wrong_rcon_password_stops_pool_task_and_refills_pool(pool):
+    task_arn = add_pool_task(pool, LOADED[0], 1)
+
+    with FakeRconServer(LOADED[0], 27015, 'another-password') as rcon:
+        code, body = start([{'name': 'MAP', 'value': 'de_nuke'}])
+
+    assert code == 200
+    assert body['taskArns'] != [task_arn]
+    assert rcon.commands == []
+    assert pool.tasks[task_arn]['desiredStatus'] == 'STOPPED'
+    assert task_arn not in pool.tables['warm-pool']
+    assert 1 not in pool.tables['hostname-slots']
+    assert task_arn not in pool.tables['hostname-owners']
+    assert ('csgo1.bench.example.com.', 'A') not in pool.records
+    assert pool.calls['ecs.RunTask'] == 1
+    assert pool.calls['lambda.Invoke'] == 1
+
+
+@pytest.mark.parametrize('body', [{}, {'servers': None}, {'servers': 'de_nuke'}])
+def test_body_without_server_list_is_rejected(fake, body):
+    code, response = start(body)
+
+    assert code == 400
+    assert 'error' in response
+    assert fake.calls['ecs.RunTask'] == 0
+
+
+def test_rejected_hostname_messages_are_retried(fake):
+    fake.rejected_messages = 3
+
+    code, body = start({'servers': [[{'name': 'MAP', 'value': 'de_nuke'}]] * 5})
+
+    assert code == 200
+    assert 'notQueued' not in body
+    assert sorted(json.loads(message)['task_arn'] for message in fake.messages) \
+        == sorted(body['taskArns'])
+
+
+def test_hostname_messages_still_rejected_are_returned(fake):
+    fake.rejected_messages = 100
+
+    code, body = start({'servers': [[{'name': 'MAP', 'value': 'de_nuke'}]] * 2})
+
+    assert code == 200
+    assert body['notQueued'] == body['taskArns']
+    assert fake.calls['sqs.SendMessageBatch'] == csgo_start_server.QUEUE_RETRIES + 1
+
+
+def test_servers_ecs_could_not_place_are_returned(fake):
+    nuke, mirage = [{'name': 'MAP', 'value': 'de_nuke'}], [{'name': 'MAP', 'value': 'de_mirage'}]
+    fake.unplaced_tasks = 3
+
+    code, body = start({'servers': [nuke] * 12 + [mirage] * 4})
+
+    assert code == 200
+    assert len(body['taskArns']) == 13
+    assert body['notStarted'] == [nuke] * 3
+    assert len(fake.messages) == 13
+
+
+def test_failed_run_task_does_not_lose_servers_already_started(fake):
+    nuke, mirage = [{'name': 'MAP', 'value': 'de_nuke'}], [{'name': 'MAP', 'value': 'de_mirage'}]
+    fake.run_task_errors = 1
+
+    code, body = start({'servers': [nuke] * 2 + [mirage] * 3})
+
+    assert code == 200
+    assert body['notStarted'] == [nuke] * 2
+    assert len(body['taskArns']) == 3
+    assert sorted(json.loads(message)['task_arn'] for message in fake.messages) \
+        == sorted(body['taskArns'])
@@ -0,0 +1,48 @@
+import json
+
+from bench_handlers import seed_fleet
+from a2s_simulator import fleet_ips
+
+import csgo_stop_server
+
+
+def stop(body):
+    response = csgo_stop_server.handler({'body': json.dumps(body)}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_stop_many(fake):
+    task_arns = seed_fleet(fake, fleet_ips(3))
+
+    code, body = stop({'task_arns': task_arns})
+
+    assert code == 200
+    assert body == {'taskArns': task_arns, 'failed': []}
+    assert all(fake.tasks[arn]['desiredStatus'] == 'STOPPED' for arn in task_arns)
+    assert fake.tables['hostname-slots'] == {}
+    assert fake.tables['hostname-owners'] == {}
+    assert fake.records == {}
+
+
+def test_task_failing_to_stop_keeps_its_slot(fake):
+    task_arns = seed_fleet(fake, fleet_ips(3))
+    fake.unstoppable.add(task_arns[0])
+
+    code, body = stop({'task_arns': task_arns})
+
+    assert code == 200
+    assert body == {'taskArns': task_arns[1:], 'failed': task_arns[:1]}
+    assert fake.tasks[task_arns[0]]['desiredStatus'] == 'RUNNING'
+    assert all(fake.tasks[arn]['desiredStatus'] == 'STOPPED' for arn in task_arns[1:])
+    assert fake.tables['hostname-slots'] == {1: {'slot': 1, 'task_arn': task_arns[0]}}
+    assert list(fake.tables['hostname-owners']) == task_arns[:1]
+
+
+def test_stop_one_that_fails(fake):
+    task_arn, = seed_fleet(fake, fleet_ips(1))
+    fake.unstoppable.add(task_arn)
+
+    code, body = stop({'task_arn': task_arn})
+
+    assert code == 500
+    assert 1 in fake.tables['hostname-slots']
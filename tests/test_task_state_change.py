@@ -0,0 +1,59 @@
+import copy
+import json
+import os
+
+import pytest
+
+import csgo_task_state_change
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures',
+                       'ecs_task_state_change.json')
+PUBLIC_IP = '203.0.113.57'
+
+
+@pytest.fixture
+def events(fake):
+    """ The events EventBridge sent for a task being started and then
+    stopped, with the task and its interface added to the fake fleet. """
+
+    with open(FIXTURE) as f:
+        events = json.load(f)
+
+    task = copy.deepcopy(events[0]['detail'])
+    eni_id = task['attachments'][0]['details'][1]['value']
+    fake.tasks[task['taskArn']] = task
+    fake.enis[eni_id] = PUBLIC_IP
+    return events
+
+
+def invoke(event):
+    response = csgo_task_state_change.handler(event, None)
+    return json.loads(response['body'])['hostnames']
+
+
+def test_running_event_creates_hostname(fake, events):
+    assert invoke(events[0]) == ['csgo1.bench.example.com']
+    assert fake.records == {('csgo1.bench.example.com.', 'A'): PUBLIC_IP}
+    assert fake.tables['hostname-slots'][1]['task_arn'] == events[0]['detail']['taskArn']
+
+
+def test_running_to_stopped_creates_nothing_more(fake, events):
+    running, stopping, stopped = events
+    task_arn = running['detail']['taskArn']
+    assert invoke(running) == ['csgo1.bench.example.com']
+
+    # The task is still RUNNING while it shuts down, but is wanted STOPPED
+    fake.tasks[task_arn]['desiredStatus'] = 'STOPPED'
+    fake.reset_calls()
+    assert invoke(stopping) == []
+    assert invoke(stopped) == []
+    assert fake.reset_calls() == {}
+    assert list(fake.records) == [('csgo1.bench.example.com.', 'A')]
+
+
+def test_stopping_task_is_not_given_a_hostname(fake, events):
+    fake.tasks[events[1]['detail']['taskArn']]['desiredStatus'] = 'STOPPED'
+
+    assert invoke(events[1]) == []
+    assert fake.records == {}
+    assert fake.tables['hostname-slots'] == {}